@@ -5,27 +5,24 @@
 import sys
 import os
 import logging
-import requests
 import json
-import time
-import threading
-import apsw
-import apsw.ext
+import http_session
 import globals
+import utils
 
 from base64 import b64encode
-from Crypto.PublicKey import RSA
-from Crypto.Random import get_random_bytes
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA512
+
+# Heavy dependencies are loaded on first use (the RSA signing is only needed for Certificate authentication)
+requests = utils.lazy_import('requests')
+RSA = utils.lazy_import('Crypto.PublicKey.RSA')
+Random = utils.lazy_import('Crypto.Random')
+pkcs1_15 = utils.lazy_import('Crypto.Signature.pkcs1_15')
+SHA512 = utils.lazy_import('Crypto.Hash.SHA512')
 
 
 # Enable logger
 logger = logging.getLogger(__name__)
 
-# Forward SQLite logs to the logging module
-apsw.ext.log_sqlite()
-
 # ===  Login to Anaplan - Basic Auth  ===
 # Login into Anaplan with basic authentication
 def basic_authentication(uri, username, password):
@@ -50,6 +47,9 @@ def basic_authentication(uri, username, password):
         logger.info("Access Token and Refresh Token received")
         print("Access Token and Refresh Token received")
 
+        # Return the token details including the expiry (`expiresAt`)
+        return res['tokenInfo']
+
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
@@ -74,7 +74,7 @@ def cert_authentication(uri, public_cert_path, private_key_path):
         signer = pkcs1_15.new(myKey)
 
         # create random 100 byte message
-        message_bytes = get_random_bytes(100)
+        message_bytes = Random.get_random_bytes(100)
 
         # UNENCRYPTED message b64encoded
         message_bytes_b64e = b64encode(message_bytes)
@@ -109,6 +109,9 @@ def cert_authentication(uri, public_cert_path, private_key_path):
         # globals.Auth.refresh_token = res['tokenInfo']['refreshTokenId']    # Not used
         logger.info("Access Token and Refresh Token received")
         print("Access Token and Refresh Token received")
+
+        # Return the token details including the expiry (`expiresAt`)
+        return res['tokenInfo']
     
     except FileNotFoundError as file_err:
         print(f'Error: The Public Certificate or Private key file is not found: {file_err} in function "{sys._getframe().f_code.co_name}"')
@@ -156,75 +159,37 @@ def extract_certificate_string(pem_file_path):
 
 
 # ===  Fetch new Access Token  ===
-# Response returns an updated `access_token` and `refresh_token`
-def refresh_tokens(uri, delay):
-
-    # If delay is set then pause
-    if delay > 0:
-        time.sleep(delay)
+# Response returns an updated `access_token` and its expiry in epoch seconds (`None` if not provided)
+def refresh_tokens(uri, access_token):
 
-    # As this is a daemon thread, keep looping until main thread ends
-    while True:
-
-        # Set headers
-        headers = {
-            'Authorization': 'AnaplanAuthToken ' + globals.Auth.access_token,
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-        }
-
-        try:
-            logger.info("Requesting new Token")
-            print("Requesting new Token")
-            res = anaplan_api(uri=uri, headers=headers)
+    # Set headers
+    headers = {
+        'Authorization': 'AnaplanAuthToken ' + access_token,
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+    }
 
-            # Set new Access Token
-            globals.Auth.access_token = res['tokenInfo']['tokenValue']
+    logger.info("Requesting new Token")
+    print("Requesting new Token")
 
-            logger.info("Updated Access Token received")
-            print("Updated Access Token received")
+    # Errors are raised to the token provider, which retries while the current token is still valid
+    res = anaplan_api(uri=uri, headers=headers, exit_on_error=False)
 
-            # If delay is set then continue to refresh the token
-            if delay > 0:
-                time.sleep(delay)
-            else:
-                break
+    logger.info("Updated Access Token received")
+    print("Updated Access Token received")
 
-        except Exception as err:
-            print(f'{err} in function "{sys._getframe().f_code.co_name}"')
-            logging.error(
-                f'{err} in function "{sys._getframe().f_code.co_name}"')
-            sys.exit(1)
+    expires_at = res['tokenInfo'].get('expiresAt')
+    return res['tokenInfo']['tokenValue'], expires_at / 1000 if expires_at else None
 
-# ===  Refresh token class  ===
-# Pass in values to be used with the refresh_tokens function
-# Explicitly set the thread to be a subordinate daemon that will stop processing with main thread
-class refresh_token_thread (threading.Thread):
-    # Overriding the default `__init__`
-   def __init__(self, thread_id, name, delay, uri):
-      print('Refresh Token', thread_id, uri)
-      threading.Thread.__init__(self)
-      self.thread_id = thread_id
-      self.name = name
-      self.delay = delay
-      self.uri = uri
-      self.daemon = True
-
-   # Overriding the default subfunction `run()`
-   def run(self):
-      # Initiate the thread
-      print("Starting " + self.name)
-      refresh_tokens(self.uri, self.delay)
-      print("Exiting " + self.name)
 
 # === Interface with Anaplan REST API   ===
-def anaplan_api(uri, headers={}, body={}):
+def anaplan_api(uri, headers={}, body={}, exit_on_error=True):
 
     res = None
 
     try:
         # POST to the Anaplan REST API to authentication tokens
-        res = requests.post(uri, headers=headers, json=body)
+        res = http_session.get_session().post(uri, headers=headers, json=body)
 
         # Check for unfavorable status codes
         res.raise_for_status()
@@ -237,12 +202,18 @@ def anaplan_api(uri, headers={}, body={}):
             f'{err} in function "{sys._getframe().f_code.co_name}" with the following details: {err.response.text}')
         logging.error(
             f'{err} in function "{sys._getframe().f_code.co_name}" with the following details: {err.response.text}')
+        if not exit_on_error:
+            raise
         sys.exit(1)
     except requests.exceptions.RequestException as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        if not exit_on_error:
+            raise
         sys.exit(1)
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        if not exit_on_error:
+            raise
         sys.exit(1)
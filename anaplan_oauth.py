@@ -5,23 +5,21 @@
 import sys
 import os
 import logging
-import requests
 import json
 import time
-import threading
-import apsw
-import apsw.ext
-import jwt
+import http_session
 import globals
+import utils
 
+# Heavy dependencies are loaded on first use
+requests = utils.lazy_import('requests')
+apsw = utils.lazy_import('apsw')
+jwt = utils.lazy_import('jwt')
 
 
 # Enable logger
 logger = logging.getLogger(__name__)
 
-# Forward SQLite logs to the logging module
-apsw.ext.log_sqlite()
-
 
 # ===  Step #1 - Device grant - Get Verification URL  ===
 # Upon success, returns a Device ID and Verification URL
@@ -87,8 +85,8 @@ def get_tokens(uri, database):
 
 
 # ===  Step #3 - Device grant - Get new Access Token with Refresh Token  ===
-# Response returns an updated `access_token` and `refresh_token`
-def refresh_tokens(uri, database, delay, rotatable_token):
+# Response returns an updated `access_token` and `refresh_token`. Returns the `access_token` and its expiry in epoch seconds.
+def refresh_tokens(uri, database, rotatable_token, exit_on_error=True):
 
     # If the refresh_token is not available then read from from the token database
     if globals.Auth.refresh_token == "none":
@@ -105,52 +103,46 @@ def refresh_tokens(uri, database, delay, rotatable_token):
         globals.Auth.client_id = tokens['client_id']
         globals.Auth.refresh_token = tokens['refresh_token']
 
-    # If delay is set then pause 
-    if delay > 0:
-        time.sleep(delay)
-
-    # As this is a daemon thread, keep looping until main thread ends
-    while True:
-        get_body = {
-            "client_id": globals.Auth.client_id,
-            "refresh_token": globals.Auth.refresh_token,
-            "grant_type": "refresh_token"
-        }
-
-        try:
-            logger.info("Requesting new Token(s)")
-            print("Requesting new Token(s)")
-            res = anaplan_api(uri=uri, body=get_body)
-
-            # Set new Access Token
-            globals.Auth.access_token = res['access_token']
-
-            # Set values in AuthToken Dataclass
-            if rotatable_token:
-                globals.Auth.refresh_token = res['refresh_token']
-                logger.info("Updated Access Token and Refresh Token received")
-                print("Updated Access Token and Refresh Token received")
-
-                # Persist token values
-                write_token_db(database=database)
-            else:
-                logger.info("Updated Access Token received")
-                print("Updated Access Token received")
-
-            # If delay is set then continue to refresh the token
-            if delay > 0:
-                time.sleep(delay)
-            else:
-                break
-        
-        except Exception as err:
-            print(f'{err} in function "{sys._getframe().f_code.co_name}"')
-            logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
-            sys.exit(1)
+    get_body = {
+        "client_id": globals.Auth.client_id,
+        "refresh_token": globals.Auth.refresh_token,
+        "grant_type": "refresh_token"
+    }
+
+    try:
+        logger.info("Requesting new Token(s)")
+        print("Requesting new Token(s)")
+        res = anaplan_api(uri=uri, body=get_body, exit_on_error=exit_on_error)
+
+        # Set new Access Token
+        globals.Auth.access_token = res['access_token']
+
+        # Set values in AuthToken Dataclass
+        if rotatable_token:
+            globals.Auth.refresh_token = res['refresh_token']
+            logger.info("Updated Access Token and Refresh Token received")
+            print("Updated Access Token and Refresh Token received")
+
+            # Persist token values
+            write_token_db(database=database)
+        else:
+            logger.info("Updated Access Token received")
+            print("Updated Access Token received")
+
+        # Use `expires_in` from the response when provided, otherwise the token provider reads the JWT `exp` claim
+        expires_at = time.time() + res['expires_in'] if 'expires_in' in res else None
+        return res['access_token'], expires_at
+
+    except Exception as err:
+        print(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        if not exit_on_error:
+            raise
+        sys.exit(1)
 
 
 # === Interface with Anaplan REST API   ===
-def anaplan_api(uri, body={}):
+def anaplan_api(uri, body={}, exit_on_error=True):
 
     # Set Headers
     get_headers = {
@@ -162,7 +154,7 @@ def anaplan_api(uri, body={}):
 
     try:
         # POST to the Anaplan REST API to receive OAuth values
-        res = requests.post(uri, headers=get_headers, json=body)
+        res = http_session.get_session().post(uri, headers=get_headers, json=body)
 
         # Check for unfavorable status codes
         res.raise_for_status()
@@ -175,46 +167,31 @@ def anaplan_api(uri, body={}):
             f'{err} in function "{sys._getframe().f_code.co_name}" with the following details: {err.response.text} - check that `rotatableToken` is set properly in the `settings.json` file')
         logging.error(
             f'{err} in function "{sys._getframe().f_code.co_name}" with the following details: {err.response.text} - check that `rotatableToken` is set properly in the `settings.json` file')
+        if not exit_on_error:
+            raise
         sys.exit(1)
     except requests.exceptions.RequestException as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        if not exit_on_error:
+            raise
         sys.exit(1)
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        if not exit_on_error:
+            raise
         sys.exit(1)
 
-# ===  Refresh token class  ===
-# Pass in values to be used with the refresh token function
-# Explicitly set the thread to be a subordinate daemon that will stop processing with main thread
-class refresh_token_thread (threading.Thread):
-    # Overriding the default `__init__`
-   def __init__(self, thread_id, name, delay, database, uri, rotatable_token):
-      print('Refresh Token', thread_id, uri)
-      threading.Thread.__init__(self)
-      self.thread_id = thread_id
-      self.name = name
-      self.delay = delay
-      self.database = database
-      self.uri = uri
-      self.rotatable_token = rotatable_token
-      self.daemon = True
-
-   # Overriding the default subfunction `run()`
-   def run(self):
-      # Initiate the thread
-      print("Starting " + self.name)
-      refresh_tokens(self.uri, self.database, self.delay, self.rotatable_token)
-      print("Exiting " + self.name)
-
-
 # === Read a SQLite database ===
 def read_token_db(database):
 
     # Initialize variable
     tokens = {}
 
+    # Forward SQLite logs to the logging module
+    utils.forward_sqlite_logs()
+
     # Check if SQLite database exists
     if os.path.isfile(database):
         # Create connection to the existing database
@@ -243,6 +220,9 @@ def write_token_db(database):
         algorithm="HS256")
     values = (globals.Auth.client_id, encoded_token)
 
+    # Forward SQLite logs to the logging module
+    utils.forward_sqlite_logs()
+
     # Check if SQLite database exists
     if os.path.isfile(database):
         # Create connection to the existing database
@@ -3,40 +3,144 @@
 # ===============================================================================
 
 import logging
-import requests
-import pandas as pd
 import sqlite3
 import math
 import sys
 import json
 import time
 import re
+import os
 import csv
+import collections
+import contextvars
+import multiprocessing
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import globals
 import utils
 import database_ops as db
+import metadata_index
+import metadata_crawl
+import user_sync
+import token_provider
+import http_session
+import parquet_export
+import search
+import partitions
+import enrichment
+import event_store
+import event_filters
+import event_frames
+import structured_logging
+import profiling
+
+# Heavy dependencies are loaded on first use
+pd = utils.lazy_import('pandas')
+requests = utils.lazy_import('requests')
 
 # Enable logger
 logger = logging.getLogger(__name__)
 
+# `pipeline_state` keys holding the latest `eventDate` (epoch milliseconds) fetched from Anaplan and published to Anaplan.
+# The publish watermark mirrors `lastRun` in `settings.json`.
+INGEST_WATERMARK_KEY = 'ingest_watermark'
+PUBLISH_WATERMARK_KEY = 'publish_watermark'
+
+# Stages that only work on the SQLite database and do not call Anaplan
+OFFLINE_STAGES = {'enrich'}
+
+# Pages of a paged endpoint fetched at the same time once the first page has returned the total
+PAGE_WORKERS = 8
+
+# Processes serializing upload chunks to CSV when a file is uploaded in more than one chunk
+CSV_WORKERS = os.cpu_count() or 1
+
+
+# ===  Run the given stages in order. Without stages the full refresh (`run`) is executed  ===
+def run_stages(settings, stages=None):
+    database_file = f'{globals.Paths.databases}/{settings["database"]}'
+
+    for stage in stages or ['run']:
+        logger.info(f'Running the `{stage}` stage')
+        if stage == 'run':
+            refresh_events(settings=settings)
+        elif stage == 'ingest':
+            ingest_events(settings=settings, database_file=database_file)
+        elif stage == 'sync-metadata':
+            sync_metadata(settings=settings, database_file=database_file, uris=settings['uris'],
+                          targetModelObjects=settings['targetAnaplanModel']['targetModelObjects'])
+        elif stage == 'enrich':
+            enrichment.enrich_events(settings=settings, database_file=database_file)
+        elif stage == 'publish':
+            if publish_events(settings=settings, database_file=database_file, sync=False, enrich=False):
+                update_history(settings=settings, database_file=database_file)
+
+
+# ===  Authentication is only needed when one of the stages calls Anaplan  ===
+def requires_authentication(stages=None):
+    return not set(stages or ['run']) <= OFFLINE_STAGES
+
 
 # ===  Fetch audit events from Anaplan. If there are no events then stop process ===
 def refresh_events(settings):
+    # Set variables
+    database_file = f'{globals.Paths.databases}/{settings["database"]}'
+
+    # Get Events
+    latest_run = ingest_events(settings=settings, database_file=database_file)
+    
+    # If there are no events and last_run has not changed, then exit. Otherwise, continue on.
+    if latest_run > settings['lastRun']:
+
+        # Refresh metadata, enrich, upload to Anaplan and run the Processes
+        publish_events(settings=settings, database_file=database_file)
+        update_history(settings=settings, database_file=database_file)
+
+    else:
+        # Nothing changed, so just upload the timestamp
+        # Upload the latest time stamp to the `Refresh Log`
+        print(f'No new audit logs and only updating the time stamp')
+        logging.info(f'No new audit logs and only updating the time stamp')
+        upload_time_stamp(settings=settings, database_file=database_file)
+
+        print(f'There were no audit events since the last run')
+        logging.info(f'There were no audit events since the last run')
+
+
+# ===  Search index, Parquet history and retention, once the new events and their metadata are in SQLite  ===
+@profiling.phase('history')
+def update_history(settings, database_file):
+    # Add the new events to the full-text search index
+    search.update_index(database_file=database_file)
+
+    # Append the new enriched events to the Parquet history (if enabled)
+    parquet_export.run_export(settings=settings, database_file=database_file)
+
+    # Move cold months to the archive and compact the database
+    partitions.run_retention(settings=settings, database_file=database_file)
+
+
+# ===  Fetch the incremental audit events into SQLite and return the latest event date  ===
+# Ingest has its own watermark, so events can be fetched every few minutes and published in fewer, larger batches
+@profiling.phase('ingest')
+def ingest_events(settings, database_file):
     # Set variables
     uris = settings['uris']
     targetModelObjects = settings['targetAnaplanModel']['targetModelObjects']
-    database_file = f'{globals.Paths.databases}/{settings["database"]}'
+    ingest_watermark = stage_watermark(settings=settings, database_file=database_file, key=INGEST_WATERMARK_KEY)
 
-    # If toggled on, drop events table
-    if targetModelObjects['auditData']['tableDrop'] or settings['lastRun']==0:
-        db.drop_table(database_file=database_file,
-                      table=targetModelObjects['auditData']['table'])
+    # If toggled on, drop events table. With `tableDrop` the table is only dropped once everything ingested has been published.
+    if (targetModelObjects['auditData']['tableDrop'] and ingest_watermark == settings['lastRun']) or ingest_watermark == 0:
+        event_store.drop_events(database_file=database_file,
+                                table=targetModelObjects['auditData']['table'])
+        search.drop_index(database_file=database_file)
+        enrichment.reset(database_file=database_file, watermark=settings['lastRun'])
 
     # Get Events
     latest_run = get_incremental_audit_events(base_uri=uris['auditApi'], database_file=database_file, database_table=targetModelObjects['auditData']['table'],
-                                              add_unique_id=targetModelObjects['auditData']['addUniqueId'], mode=targetModelObjects['auditData']['mode'], record_path="response", json_path=['meta', 'paging'], last_run=settings['lastRun'], batch_size=settings['auditBatchSize'])
+                                              add_unique_id=targetModelObjects['auditData']['addUniqueId'], mode=targetModelObjects['auditData']['mode'], record_path="response", json_path=['meta', 'paging'], last_run=ingest_watermark, batch_size=settings['auditBatchSize'],
+                                              normalize=event_store.store_settings(settings)['enabled'], filters=event_filters.filter_settings(settings))
     logger.info(f'latest_run value: {latest_run}')
     print(f'latest_run value: {latest_run}')
 
@@ -45,126 +149,164 @@ def refresh_events(settings):
         print(f'latest run value contains a millisecond')
         logger.error(int(time.time()*1000))
         print(int(time.time()*1000))
-    
-    # If there are no events and last_run has not changed, then exit. Otherwise, continue on.
-    if latest_run > settings['lastRun']:
 
-        # Execute the refresh audit data
-        refresh_sequence(settings=settings,
-                         database_file=database_file,
-                         uris=uris,
-                         targetModelObjects=targetModelObjects)
-        
-        # If `lastRun` is 0, then clear `LOAD_ID` list with the `CT` lists 
-        if settings['lastRun']==0:
-            execute_process(uri=settings['uris']['integrationApi'],
-                            workspace=settings['targetAnaplanModel']['workspace'],
-                            model=settings['targetAnaplanModel']['model'],
-                            process=settings['targetAnaplanModel']['clearListProcess'],
-                            database_file=database_file)
-        else:
-            execute_process(uri=settings['uris']['integrationApi'],
-                            workspace=settings['targetAnaplanModel']['workspace'],
-                            model=settings['targetAnaplanModel']['model'],
-                            process=settings['targetAnaplanModel']['clearCtListProcess'],
-                            database_file=database_file)
+    if latest_run > ingest_watermark:
+        db.write_state(database_file=database_file, key=INGEST_WATERMARK_KEY, value=latest_run)
 
-        
-        # Execute the Process to reload audit data
-        execute_process(uri=settings["uris"]["integrationApi"],
-                        workspace=settings['targetAnaplanModel']['workspace'],
-                        model=settings['targetAnaplanModel']['model'],
-                        process=settings['targetAnaplanModel']['process'],
-                        database_file=database_file)
+    return latest_run
 
-        # Upload the latest time stamp to the `Refresh Log`
-        print(f'Updating time stamp and record count in Anaplan')
-        logging.info(f'Updating time stamp and record count in Anaplan')
-        upload_time_stamp(settings=settings, database_file=database_file)
 
-        # Update `setting.json` with lastRun Date (set by Get Events)
-        utils.update_configuration_settings(
-            object=settings, value=latest_run, key='lastRun')
-        
-        print(f'Audit log refresh is complete')
-        logging.info(f'Audit log refresh is complete')
+# ===  Watermark of the `ingest` or `enrich` stage, which is never behind the publish watermark (`lastRun`)  ===
+def stage_watermark(settings, database_file, key):
+    # `lastRun` lowered by hand (e.g. set to 0 to reload everything) restarts all stages from there
+    published = db.read_state(database_file=database_file, key=PUBLISH_WATERMARK_KEY)
+    if published is not None and settings['lastRun'] < published:
+        for stage_key in (INGEST_WATERMARK_KEY, enrichment.WATERMARK_KEY, PUBLISH_WATERMARK_KEY):
+            db.write_state(database_file=database_file, key=stage_key, value=settings['lastRun'])
+    return max(db.read_state(database_file=database_file, key=key, default=settings['lastRun']), settings['lastRun'])
+
 
+# ===  Upload the enriched audit events to Anaplan, run the Processes and advance `lastRun`  ===
+# The metadata crawl and the enrichment can be skipped when they ran separately (e.g. by the daemon or the `publish` command).
+def publish_events(settings, database_file, sync=True, enrich=True):
+    # Set variables
+    uris = settings['uris']
+    targetModelObjects = settings['targetAnaplanModel']['targetModelObjects']
+
+    if sync:
+        sync_metadata(settings=settings, database_file=database_file, uris=uris, targetModelObjects=targetModelObjects)
+    if enrich:
+        enrichment.enrich_events(settings=settings, database_file=database_file)
+    return publish_staged(settings=settings, database_file=database_file)
+
+
+# ===  Publish everything staged since the last publish. Returns `False` if there was nothing to publish.  ===
+@profiling.phase('publish')
+def publish_staged(settings, database_file):
+    # Set variables
+    uris = settings['uris']
+    targetModelObjects = settings['targetAnaplanModel']['targetModelObjects']
+
+    latest_run = enrichment.latest_staged(database_file=database_file, last_run=settings['lastRun'])
+    if latest_run is None:
+        print(f'There are no enriched audit events to publish')
+        logging.info(f'There are no enriched audit events to publish')
+        return False
+
+    upload_to_anaplan(settings=settings, database_file=database_file, uris=uris, targetModelObjects=targetModelObjects)
+    
+    # If `lastRun` is 0, then clear `LOAD_ID` list with the `CT` lists 
+    if settings['lastRun']==0:
+        execute_process(uri=settings['uris']['integrationApi'],
+                        workspace=settings['targetAnaplanModel']['workspace'],
+                        model=settings['targetAnaplanModel']['model'],
+                        process=settings['targetAnaplanModel']['clearListProcess'],
+                        database_file=database_file)
     else:
-        # Nothing changed, so just upload the timestamp
-        # Upload the latest time stamp to the `Refresh Log`
-        print(f'No new audit logs and only updating the time stamp')
-        logging.info(f'No new audit logs and only updating the time stamp')
-        upload_time_stamp(settings=settings, database_file=database_file)
+        execute_process(uri=settings['uris']['integrationApi'],
+                        workspace=settings['targetAnaplanModel']['workspace'],
+                        model=settings['targetAnaplanModel']['model'],
+                        process=settings['targetAnaplanModel']['clearCtListProcess'],
+                        database_file=database_file)
 
-        print(f'There were no audit events since the last run')
-        logging.info(f'There were no audit events since the last run')
+    
+    # Execute the Process to reload audit data
+    execute_process(uri=settings["uris"]["integrationApi"],
+                    workspace=settings['targetAnaplanModel']['workspace'],
+                    model=settings['targetAnaplanModel']['model'],
+                    process=settings['targetAnaplanModel']['process'],
+                    database_file=database_file)
+
+    # Upload the latest time stamp to the `Refresh Log`
+    print(f'Updating time stamp and record count in Anaplan')
+    logging.info(f'Updating time stamp and record count in Anaplan')
+    upload_time_stamp(settings=settings, database_file=database_file)
+
+    # Update `setting.json` with lastRun Date (the latest published event) and drop the published rows from the staging table
+    utils.update_configuration_settings(
+        object=settings, value=latest_run, key='lastRun')
+    db.write_state(database_file=database_file, key=PUBLISH_WATERMARK_KEY, value=latest_run)
+    enrichment.prune_staged(database_file=database_file, published_up_to=latest_run)
+
+    print(f'Audit log refresh is complete')
+    logging.info(f'Audit log refresh is complete')
+    return True
     
 
 # ===  Get Anaplan Audit Events ===
-def get_incremental_audit_events(base_uri, database_file, database_table, mode, record_path, add_unique_id, json_path, last_run, batch_size):
+def get_incremental_audit_events(base_uri, database_file, database_table, mode, record_path, add_unique_id, json_path, last_run, batch_size, normalize=False, filters=None):
     uri = f'{base_uri}/events/search?limit={batch_size}'
     res = None
     count = 1
+    filters = filters or event_filters.DEFAULT_SETTINGS
 
     try:
         # Set request with `last_run` value. If last_run is non-zero then increment by 1 millisecond
+        previous_run = last_run
         if last_run > 0:
             last_run = last_run + 1
 
-        # Initial endpoint query
-        logger.info(f'uri: {uri}   last run: {last_run}')
-        print(f'uri: {uri}   last run: {last_run}')
+        # Initial endpoint query, with the include filters the Audit API applies itself
+        body = event_filters.request_body(filters=filters, start=last_run)
+        logger.info(f'uri: {uri}   body: {body}')
+        print(f'uri: {uri}   body: {body}')
 
         # Retrieve first page of audit events
-        res = anaplan_api(uri=uri, verb='POST', body={"from": last_run}, token_type="AnaplanAuthToken ").json()
+        res = anaplan_api(uri=uri, verb='POST', body=body, token_type="AnaplanAuthToken ").json()
 
-        # Add response to data frame and normalize
-        df = pd.json_normalize(res, record_path)
-
-        # Append to the initialized Data Frame
-        df = pd.concat([initialize_data_frame(), df], ignore_index=True)
+        # Nothing new since the last run. Return before pandas is loaded or the database is touched.
+        if not res.get(record_path) and 'nextUrl' not in res.get(json_path[0], {}).get(json_path[1], {}):
+            globals.Counts.events_received = 0
+            logger.info(f'0 {database_table} records received with {count} API call(s)')
+            print(f'0 {database_table} records received with {count} API call(s)')
+            return previous_run
 
         # Fetch the total number of audit records 
         total_size = res[json_path[0]][json_path[1]]['totalSize']
+        progress = structured_logging.progress_reporter(description='Audit events', total=total_size, unit='events')
 
-        # Loop and get audit records until `nextUrl` is not found
+        # The filters are applied again on decode, for those the server could not apply. The latest event date
+        # received is tracked separately so filtered-out events are not fetched again.
+        pages = [initialize_data_frame()]
+        latest_event = previous_run
+        received = 0
         while True:
-            try:
-                # Find key in json path
-                next_uri = res[json_path[0]][json_path[1]]['nextUrl']
-
-                # Get the next request
-                print(next_uri)
-
-                # Retrieve the next page of audit events
-                res = anaplan_api(uri=next_uri, verb='POST', body={"from": last_run}, token_type="AnaplanAuthToken ").json()
-
-                # Create a temporary data from to hold the incremental records 
-                df_incremental = pd.json_normalize(res, record_path)
-
-                # Append to the incremental records to the existing Data Frame
-                df = pd.concat([df, df_incremental], ignore_index=True)
-                count += 1
-
-            # When `nextUrl` is not found, break the While loop    
-            except KeyError:
-                # Stop looping when key cannot be found
+            events = res.get(record_path) or []
+            if events:
+                latest_event = max(latest_event, max(event['eventDate'] for event in events))
+            received += len(events)
+            pages.append(event_frames.records_frame(event_filters.apply(filters=filters, events=events),
+                                                    categories=event_frames.EVENT_CATEGORIES))
+            progress.update(len(events))
+
+            # Loop and get audit records until `nextUrl` is not found
+            next_uri = res.get(json_path[0], {}).get(json_path[1], {}).get('nextUrl')
+            if next_uri is None:
                 break
+            logger.debug(f'API Endpoint: {next_uri}')
+
+            # Retrieve the next page of audit events
+            res = anaplan_api(uri=next_uri, verb='POST', body=body, token_type="AnaplanAuthToken ").json()
+            count += 1
 
-        # Once all audit records are fetched update the SQLite table
-        db.update_table(database_file=database_file, add_unique_id=add_unique_id,
-                        table=database_table, df=df, mode=mode)
+        # Once all audit records are fetched update the SQLite table (dictionary-encoded if enabled)
+        progress.finish()
+        df = event_frames.concat(pages, categories=event_frames.EVENT_CATEGORIES)
+        globals.Counts.events_received = df.shape[0]
+        logger.debug(f'{df.shape[0]} {database_table} records held in {event_frames.frame_bytes(df) / 2**20:.1f} MB')
+        event_store.write_events(database_file=database_file, add_unique_id=add_unique_id,
+                                 table=database_table, df=df, mode=mode, normalize=normalize)
 
         logger.info(
             f'{total_size} {database_table} records received with {count} API call(s)')
         print(
             f'{total_size} {database_table} records received with {count} API call(s)')
+        if df.shape[0] < received:
+            logger.info(f'{received - df.shape[0]} {database_table} records removed by the event filters')
+            print(f'{received - df.shape[0]} {database_table} records removed by the event filters')
 
         # Return last audit event date. If there were no records then simply return the prior last run date.
-        if df.shape[0] == 0:
-            return last_run
-        else:
-            return df['eventDate'].tolist()[-1]
+        return latest_event
 
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
@@ -184,77 +326,136 @@ def initialize_data_frame():
 
 # ===  If there are new events then refresh Anaplan object and upload the latest data to Anaplan ===
 def refresh_sequence(settings, database_file, uris, targetModelObjects):
+    sync_metadata(settings=settings, database_file=database_file, uris=uris, targetModelObjects=targetModelObjects)
+    upload_to_anaplan(settings=settings, database_file=database_file, uris=uris, targetModelObjects=targetModelObjects)
+
+
+# ===  Crawl the Anaplan metadata (users, workspaces, models, actions, files & CloudWorks) into SQLite ===
+# In the `targeted` crawl mode only the metadata referenced by the new events is crawled, until a full crawl is due.
+@profiling.phase('sync-metadata')
+def sync_metadata(settings, database_file, uris, targetModelObjects):
 
-    # Drop tables
+    if not metadata_crawl.full_crawl_due(settings=settings, database_file=database_file, targetModelObjects=targetModelObjects):
+        metadata_crawl.targeted_sync(settings=settings, database_file=database_file, uris=uris, targetModelObjects=targetModelObjects)
+        metadata_index.get_index(database_file).refresh()
+        return
+
+    # Drop tables. The users table is kept when it is synced incrementally.
     for key in targetModelObjects.values():
-        if key['tableDrop'] and key['acronym'] != 'AUDIT':
+        if key['tableDrop'] and key['acronym'] != 'AUDIT' and not (key is targetModelObjects['usersData'] and user_sync.incremental(settings)):
             db.drop_table(database_file=database_file, table=key['table'])
 
     # Load User Activity Codes
     get_usr_activity_codes(
         database_file=database_file, table=targetModelObjects['activityCodesData']['table'])
 
-    # Get Users
-    get_anaplan_paged_data(uri=f'{uris["scimApi"]}/Users', database_file=database_file,
-                           database_table=targetModelObjects['usersData']['table'], add_unique_id=targetModelObjects['usersData']['addUniqueId'], record_path="Resources", page_size_key=['itemsPerPage'], page_index_key=['startIndex'], total_results_key=['totalResults'])
+    # Get Users (only the modified users once they have been listed, see `userSync`)
+    user_sync.sync_users(settings=settings, database_file=database_file, uris=uris, targetModelObjects=targetModelObjects)
 
     # Get Workspaces
-    workspace_ids = get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces?tenantDetails=true', database_file=database_file,
-                                           database_table=targetModelObjects['workspacesData']['table'], add_unique_id=targetModelObjects['workspacesData']['addUniqueId'], record_path="workspaces", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], return_id=True)
+    workspace_ids = get_workspaces(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects)
 
     # Get Models in all Workspace
     for ws_id in workspace_ids:
-        model_ids = get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models?modelDetails=true', database_file=database_file,
-                                           database_table=targetModelObjects['modelsData']['table'], add_unique_id=targetModelObjects['modelsData']['addUniqueId'], record_path="models", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], return_id=True, workspace_id=1)
+        model_ids = get_models(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects, ws_id=ws_id)
 
         # Loop through each Model to get details
         for mod_id in model_ids:
+            if skip_model(settings=settings, ws_id=ws_id, mod_id=mod_id):
+                continue
 
-            # Check the filtering approach
-            if settings['workspaceModelFilterApproach'] == "skip":
-                # Check if the current WorkspaceId and ModelId are in skip_workspace_model_combos
-                if {"WorkspaceId": ws_id, "ModelId": mod_id} in settings['workspaceModelCombos']:
-                    print(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is listed to be SKIPPED in the workspace_model_combos")
-                    logging.info(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is listed to be SKIPPED in the workspace_model_combos")
-                    # Skip this iteration of the loop
-                    continue  
-            elif settings['workspaceModelFilterApproach'] == "select":
-                # Check if the current WorkspaceId and ModelId are in skip_workspace_model_combos
-                if {"WorkspaceId": ws_id, "ModelId": mod_id} not in settings['workspaceModelCombos']:
-                    if mod_id!=settings['targetAnaplanModel']['model']:
-                        print(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is NOT SELECTED in the workspace_model_combos")
-                        logging.info(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is NOT SELECTED in the workspace_model_combos")
-                        # Skip this iteration of the loop
-                        continue  
-
-
-            # Get Import Actions in all Models in all Workspaces
-            get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/imports', database_file=database_file,
-                                   database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="imports", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
-
-            # Get Export Actions in all Models in all Workspaces
-            get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/exports', database_file=database_file,
-                                   database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="exports", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
-
-            # Get Actions in all Models in all Workspaces
-            get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/actions', database_file=database_file,
-                                   database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="actions", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
-
-            # Get Processes in all Models in all Workspaces
-            get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/processes', database_file=database_file,
-                                   database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="processes", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
-
-            # Get Files in all Models in all Workspaces
-            get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/files', database_file=database_file,
-                                   database_table=targetModelObjects['filesData']['table'], add_unique_id=targetModelObjects['filesData']['addUniqueId'], record_path="files", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
+            # Get the Actions and Files of the Model
+            get_model_objects(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects, ws_id=ws_id, mod_id=mod_id)
 
     # Get CloudWorks Integrations
-    get_anaplan_paged_data(uri=f'{uris["cloudworksApi"]}/integrations', database_file=database_file,
-                           database_table=targetModelObjects['cloudWorksData']['table'], add_unique_id=targetModelObjects['cloudWorksData']['addUniqueId'], record_path="integrations", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'])
+    get_cloudworks(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects)
     
     # Get Model History
     # get_model_history(base_uri=uris['integrationApi'], database_file=database_file)
+
+    # Every ingested event is now resolved, so a targeted crawl continues from the latest one
+    metadata_crawl.record_full_crawl(database_file=database_file, events_table=targetModelObjects['auditData']['table'])
    
+    # Load the name <-> ID index once now that the metadata sync is complete
+    metadata_index.get_index(database_file).refresh()
+
+
+# ===  Resolve only the IDs of the events ingested since the last crawl, whatever the `metadataCrawl` mode  ===
+# Used by the daemon before each publish, between its full crawls.
+def sync_new_metadata(settings, database_file, uris, targetModelObjects):
+    metadata_crawl.targeted_sync(settings=settings, database_file=database_file, uris=uris, targetModelObjects=targetModelObjects)
+    metadata_index.get_index(database_file).refresh()
+
+
+# ===  Get Users  ===
+def get_users(uris, database_file, targetModelObjects):
+    get_anaplan_paged_data(uri=f'{uris["scimApi"]}/Users', database_file=database_file,
+                           database_table=targetModelObjects['usersData']['table'], add_unique_id=targetModelObjects['usersData']['addUniqueId'], record_path="Resources", page_size_key=['itemsPerPage'], page_index_key=['startIndex'], total_results_key=['totalResults'])
+
+
+# ===  Get Workspaces and return their IDs  ===
+def get_workspaces(uris, database_file, targetModelObjects):
+    return get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces?tenantDetails=true', database_file=database_file,
+                                  database_table=targetModelObjects['workspacesData']['table'], add_unique_id=targetModelObjects['workspacesData']['addUniqueId'], record_path="workspaces", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], return_id=True) or []
+
+
+# ===  Get the Models of a Workspace and return the IDs of the Models that are not archived  ===
+def get_models(uris, database_file, targetModelObjects, ws_id):
+    return get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models?modelDetails=true', database_file=database_file,
+                                  database_table=targetModelObjects['modelsData']['table'], add_unique_id=targetModelObjects['modelsData']['addUniqueId'], record_path="models", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], return_id=True, workspace_id=1) or []
+
+
+# ===  Check the `workspaceModelFilterApproach` to determine if the Model is skipped  ===
+def skip_model(settings, ws_id, mod_id):
+    # Check the filtering approach
+    if settings['workspaceModelFilterApproach'] == "skip":
+        # Check if the current WorkspaceId and ModelId are in skip_workspace_model_combos
+        if {"WorkspaceId": ws_id, "ModelId": mod_id} in settings['workspaceModelCombos']:
+            print(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is listed to be SKIPPED in the workspace_model_combos")
+            logging.info(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is listed to be SKIPPED in the workspace_model_combos")
+            return True
+    elif settings['workspaceModelFilterApproach'] == "select":
+        # Check if the current WorkspaceId and ModelId are in skip_workspace_model_combos
+        if {"WorkspaceId": ws_id, "ModelId": mod_id} not in settings['workspaceModelCombos']:
+            if mod_id!=settings['targetAnaplanModel']['model']:
+                print(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is NOT SELECTED in the workspace_model_combos")
+                logging.info(f"Skipping WorkspaceId: {ws_id}, ModelId: {mod_id} as it is NOT SELECTED in the workspace_model_combos")
+                return True
+    return False
+
+
+# ===  Get the Actions (imports, exports, actions & processes) and Files of a Model  ===
+def get_model_objects(uris, database_file, targetModelObjects, ws_id, mod_id):
+    # Get Import Actions in all Models in all Workspaces
+    get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/imports', database_file=database_file,
+                           database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="imports", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
+
+    # Get Export Actions in all Models in all Workspaces
+    get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/exports', database_file=database_file,
+                           database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="exports", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
+
+    # Get Actions in all Models in all Workspaces
+    get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/actions', database_file=database_file,
+                           database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="actions", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
+
+    # Get Processes in all Models in all Workspaces
+    get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/processes', database_file=database_file,
+                           database_table=targetModelObjects['actionsData']['table'], add_unique_id=targetModelObjects['actionsData']['addUniqueId'], record_path="processes", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
+
+    # Get Files in all Models in all Workspaces
+    get_anaplan_paged_data(uri=f'{uris["integrationApi"]}/workspaces/{ws_id}/models/{mod_id}/files', database_file=database_file,
+                           database_table=targetModelObjects['filesData']['table'], add_unique_id=targetModelObjects['filesData']['addUniqueId'], record_path="files", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'], workspace_id=ws_id, model_id=mod_id)
+
+
+# ===  Get CloudWorks Integrations  ===
+def get_cloudworks(uris, database_file, targetModelObjects):
+    get_anaplan_paged_data(uri=f'{uris["cloudworksApi"]}/integrations', database_file=database_file,
+                           database_table=targetModelObjects['cloudWorksData']['table'], add_unique_id=targetModelObjects['cloudWorksData']['addUniqueId'], record_path="integrations", page_size_key=['meta', 'paging', 'currentPageSize'], page_index_key=['meta', 'paging', 'offset'], total_results_key=['meta', 'paging', 'totalSize'])
+
+
+# ===  Upload the metadata and the new audit events to the target Anaplan Model ===
+def upload_to_anaplan(settings, database_file, uris, targetModelObjects):
+
     # Fetch ids for target Workspace and Model from the SQLite database
     print(f'Update Anaplan Audit Model')
     logging.info(f'Update Anaplan Audit Model')
@@ -325,64 +526,46 @@ def get_anaplan_paged_data(uri, database_file, database_table, add_unique_id, re
 
     try:
         # Initial endpoint query
-        logger.info(f'API Endpoint: {uri}')
-        print(f'API Endpoint: {uri}')
+        logger.debug(f'API Endpoint: {uri}')
 
         # Retrieve first page
         res = anaplan_api(uri=uri, verb="GET", token_type="Bearer ").json()
     
         # Add response to data frame and normalize
-        df = pd.json_normalize(res, record_path)
-
-        # Initialize paging variables
-        page_size = 0
-        page_index = 0
-        total_results = 0
+        df = event_frames.records_frame(res[record_path])
 
         # Set the depth of the key
         depth = len(page_size_key)
 
-        # Match array size for page_size, page_index, total_results
+        # Match array size for page_size, page_index, total_results. SCIM `startIndex` is 1-based, `offset` is 0-based.
         match depth:
             case 1:
                 page_size = res[page_size_key[0]]
-                page_index = res[page_index_key[0]] - 1
+                first_index = res[page_index_key[0]]
                 total_results = res[total_results_key[0]]
             case 3:
-                page_size = res[page_size_key[0]][page_size_key[1]][page_size_key[2]] 
-                page_index = res[page_index_key[0]][page_index_key[1]][page_index_key[2]]
+                page_size = res[page_size_key[0]][page_size_key[1]][page_size_key[2]]
+                first_index = res[page_index_key[0]][page_index_key[1]][page_index_key[2]]
                 total_results = res[total_results_key[0]][total_results_key[1]][total_results_key[2]]
 
-        # Loop and get records while less than total results of the query
-        while page_index + page_size < total_results:
-            try: 
-                # Get next page
-                if '?' in uri:
-                    next_uri = f'{uri}&{page_index_key[depth-1]}={page_index + page_size}'
-                else: 
-                    next_uri = f'{uri}?{page_index_key[depth-1]}={page_index + page_size}'
-
-                logger.info(f'API Endpoint: {next_uri}')
-                print(f'API Endpoint: {next_uri}')
-
-                # res = requests.get(next_uri, headers=get_headers)
-                res = anaplan_api(uri=next_uri, verb="GET", token_type="Bearer ").json()
+        progress = structured_logging.progress_reporter(description=f'Table `{database_table}`', total=total_results)
+        progress.update(len(df.index))
 
-                # Create a temporary data frame to hold the incremental records
-                df_incremental = pd.json_normalize(res, record_path)
+        # With the total known, the index of every remaining page is known as well
+        separator = '&' if '?' in uri else '?'
+        page_uris = [f'{uri}{separator}{page_index_key[depth - 1]}={index}'
+                     for index in range(first_index + page_size, first_index + total_results, page_size)] if page_size else []
 
-                # Append to the incremental records to the existing Data Frame
-                df = pd.concat([df, df_incremental], ignore_index=True)
-                count += 1
+        # Fetch the remaining pages concurrently and append them in page order
+        pages = [df]
+        for page in fetch_pages(page_uris):
+            if record_path in page:
+                pages.append(event_frames.records_frame(page[record_path]))
+            progress.update(len(page.get(record_path, [])))
+        df = pd.concat(pages, ignore_index=True)
+        count += len(page_uris)
 
-                # Get values to retrieve next page
-                match depth:
-                    case 1: page_index = res[page_index_key[0]]
-                    case 3: page_index = res[page_index_key[0]][page_index_key[1]][page_index_key[2]]
-
-            except KeyError | AttributeError as err:
-                print(err)
-                break
+        progress.finish()
 
         # Transform Data Frames columns before updating SQLite
         match database_table:
@@ -397,7 +580,7 @@ def get_anaplan_paged_data(uri, database_file, database_table, add_unique_id, re
             case "imports" | "exports" | "processes" | "actions" | "files":
                 df = df[['id', 'name']]
                 data = {'workspace_id': workspace_id, 'model_id': model_id}
-                df = df.assign(**data)
+                df = event_frames.compact(df.assign(**data), categories=event_frames.METADATA_CATEGORIES)
                 db.update_table(database_file=database_file,
                              table=database_table, add_unique_id=add_unique_id,df=df, mode='append')
             case "cloudworks":
@@ -434,6 +617,21 @@ def get_anaplan_paged_data(uri, database_file, database_table, add_unique_id, re
         sys.exit(1)
 
 
+# ===  GET pages concurrently (at most `PAGE_WORKERS` at a time) and return their JSON in the order of `uris`  ===
+def fetch_pages(uris):
+    if not uris:
+        return []
+
+    def fetch(next_uri):
+        logger.debug(f'API Endpoint: {next_uri}')
+        return anaplan_api(uri=next_uri, verb="GET", token_type="Bearer ").json()
+
+    # Each request runs in a copy of the caller's context so it uses the tenant's token
+    with ThreadPoolExecutor(max_workers=min(PAGE_WORKERS, http_session.POOL_SIZE, len(uris)), thread_name_prefix='Page') as executor:
+        futures = [executor.submit(contextvars.copy_context().run, fetch, next_uri) for next_uri in uris]
+        return [future.result() for future in futures]
+
+
 # === Get Model History ===
 def get_model_history(base_uri, database_file):
 
@@ -564,69 +762,48 @@ def make_sql_friendly_table_name(string1, string2):
 
 # === Fetch Anaplan object IDs used for uploading data to Anaplan  ===
 def fetch_ids(database_file, **kwargs):
-    # Establish connection to SQLite
-    connection = sqlite3.Connection(database_file)
-
-    # Create a cursor to perform operations on the database
-    cursor = connection.cursor()
+    # Lookups are served from the in-memory index, which reloads only when the metadata tables change
+    index = metadata_index.get_index(database_file)
 
-    # Initialize variables
-    sql = ""
-
-    # For each object execute specific SQL to identify the ID
+    # For each object look up the ID
     id = ""
     try:
         match kwargs["type"]:
             case 'workspaces':
-                sql = f'SELECT w.id FROM workspaces w where w.name = "{kwargs["workspace"]}";'
-                cursor.execute(sql)
-                row = cursor.fetchone()
-                if row is None:
+                id = index.workspace_id(kwargs["workspace"])
+                if id is None:
                     raise ValueError(
                         f'"{kwargs["workspace"]}" is an invalid Workspace name and not found in Anaplan.')
-                id = row[0]
                 print(
                     f'Found Workspace "{kwargs["workspace"]}" with the ID "{id}"')
                 logger.info(
                     f'Found Workspace "{kwargs["workspace"]}" with the ID "{id}"')
             case 'models':
-                sql = f'SELECT m.id from models m WHERE m.currentWorkspaceId = "{kwargs["workspace_id"]}" AND m.name = "{kwargs["model"]}";'
-                cursor.execute(sql)
-                row = cursor.fetchone()
-                if row is None:
+                id = index.model_id(kwargs["workspace_id"], kwargs["model"])
+                if id is None:
                     raise ValueError(
                         f'"{kwargs["model"]}" is an invalid Model name and not found in Anaplan.')
-                id = row[0]
                 print(f'Found Model "{kwargs["model"]}" with the ID "{id}"')
                 logger.info(
                     f'Found Model "{kwargs["model"]}" with the ID "{id}"')
             case 'actions':
-                sql = f'SELECT a.id FROM actions a WHERE a.workspace_id="{kwargs["workspace_id"]}" AND a.model_id="{kwargs["model_id"]}" AND a.name="{kwargs["action"]}";'
-                cursor.execute(sql)
-                row = cursor.fetchone()
-                if row is None:
+                id = index.action_id(kwargs["workspace_id"], kwargs["model_id"], kwargs["action"])
+                if id is None:
                     raise ValueError(
                         f'"{kwargs["action"]}" is an invalid Action name and not found in Anaplan.')
-                id = row[0]
                 print(
                     f'Found Import Action "{kwargs["action"]}" with the ID "{id}"')
                 logger.info(
                     f'Found Import Action "{kwargs["action"]}" with the ID "{id}"')
             case 'files':
-                sql = f'SELECT f.id FROM files f WHERE f.workspace_id="{kwargs["workspace_id"]}" AND f.model_id="{kwargs["model_id"]}" AND f.name="{kwargs["file"]}";'
-                cursor.execute(sql)
-                row = cursor.fetchone()
-                if row is None:
+                id = index.file_id(kwargs["workspace_id"], kwargs["model_id"], kwargs["file"])
+                if id is None:
                     raise ValueError(
                         f'"{kwargs["file"]}" is an invalid file name and not found in Anaplan.')
-                id = row[0]
                 print(f'Found Data File "{kwargs["file"]}" with the ID "{id}"')
                 logger.info(
                     f'Found Data File "{kwargs["file"]}" with the ID "{id}"')
 
-        # Close SQLite connection
-        connection.close()
-
         # Return ID
         return id
 
@@ -635,10 +812,6 @@ def fetch_ids(database_file, **kwargs):
         print(ve)
         return -1
 
-    except sqlite3.Error as err:
-        print(f'SQL error: {err.args} /  SQL Statement: {sql}')
-        logger.error(f'SQL error: {err.args} /  SQL Statement: {sql}')
-
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
@@ -647,8 +820,8 @@ def fetch_ids(database_file, **kwargs):
 
 # === Fetch Anaplan object IDs used for uploading data to Anaplan  ===
 def fetch_ids_list(database_file):
-    # Establish connection to SQLite
-    connection = sqlite3.Connection(database_file)
+    # Get the cached connection to SQLite
+    connection = db.connect(database_file)
 
     # Create a cursor to perform operations on the database
     cursor = connection.cursor()
@@ -663,9 +836,6 @@ def fetch_ids_list(database_file):
         cursor.execute(sql)
         rows = cursor.fetchall()
 
-        # Close SQLite connection
-        connection.close()
-
     except ValueError as ve:
         logger.error(ve)
         print(ve)
@@ -685,50 +855,32 @@ def fetch_ids_list(database_file):
 
 # === Fetch Anaplan object names of particular IDs  ===
 def fetch_names(database_file, **kwargs):
-    # Establish connection to SQLite
-    connection = sqlite3.Connection(database_file)
-
-    # Create a cursor to perform operations on the database
-    cursor = connection.cursor()
+    # Lookups are served from the in-memory index, which reloads only when the metadata tables change
+    index = metadata_index.get_index(database_file)
 
-    # Initialize variables
-    sql = ""
-
-    # For each object execute specific SQL to identify the ID
+    # For each object look up the name
     name = ""
     try:
         match kwargs["type"]:
             case 'workspaces':
-                sql = f'SELECT w.name FROM workspaces w where w.id = "{kwargs["workspace_id"]}";'
-                cursor.execute(sql)
-                row = cursor.fetchone()
-                if row is None:
+                name = index.workspace_name(kwargs["workspace_id"])
+                if name is None:
                     raise ValueError(
                         f'"{kwargs["workspace_id"]}" is an invalid Workspace ID and not found in Anaplan.')
-                name = row[0]
 
             case 'models':
-                sql = f'SELECT m.name from models m WHERE m.id = "{kwargs["model_id"]}";'
-                cursor.execute(sql)
-                row = cursor.fetchone()
-                if row is None:
+                name = index.model_name(kwargs["model_id"])
+                if name is None:
                     raise ValueError(
-                        f'"{kwargs["model"]}" is an invalid Model ID and not found in Anaplan.')
-                name = row[0]
+                        f'"{kwargs["model_id"]}" is an invalid Model ID and not found in Anaplan.')
 
             case 'actions':
-                sql = f'SELECT a.name FROM actions a WHERE a.workspace_id="{kwargs["workspace_id"]}" AND a.model_id="{kwargs["model_id"]}" AND a.id="{kwargs["action_id"]}";'
-                cursor.execute(sql)
-                row = cursor.fetchone()
-                if row is None:
+                name = index.action_name(kwargs["workspace_id"], kwargs["model_id"], kwargs["action_id"])
+                if name is None:
                     raise ValueError(
                         f'"{kwargs["action_id"]}" is an invalid Action ID and not found in Anaplan.')
-                name = row[0]
-
-        # Close SQLite connection
-        connection.close()
 
-        # Return ID
+        # Return name
         return name
 
     except ValueError as ve:
@@ -736,16 +888,40 @@ def fetch_names(database_file, **kwargs):
         print(ve)
         return -1
 
-    except sqlite3.Error as err:
-        print(f'SQL error: {err.args} /  SQL Statement: {sql}')
-        logger.error(f'SQL error: {err.args} /  SQL Statement: {sql}')
-
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
         sys.exit(1)
 
 
+# === Build the enriched audit query (`audit_query.sql`) for events after `last_run` ===
+# Returns the query and a matching record count query. `up_to` optionally bounds the events to a fixed range and
+# `condition` adds a further SQL condition on the `events e` table. `source` replaces the `events` table (e.g. with the
+# `events_all` view over the hot table and the archives).
+def build_audit_query(tenant_name, last_run, up_to=None, condition=None, source='events', extra_columns=None,
+                      query_file='audit_query.sql'):
+    # Open SQL File in read mode
+    with open(f'{globals.Paths.scripts}/{query_file}', 'r') as sql_file:
+        # read whole file to a string
+        sql = sql_file.read()
+
+    # Additional columns (e.g. the raw `eventDate`) ahead of the columns of the query
+    if extra_columns is not None:
+        sql = re.sub(r'^\s*SELECT', f'SELECT {extra_columns},', sql, count=1, flags=re.IGNORECASE)
+
+    # Update sql with tenant name
+    sql = sql.replace('{{tenant_name}}', tenant_name).replace('{{time_stamp}}', globals.Timestamps.gmt_epoch)
+    sql = sql.replace('FROM events e', f'FROM {source} e', 1)
+
+    # Update sql with the last run date increment by 1 millisecond
+    where = f'e.eventDate>{last_run + 1}'
+    if up_to is not None:
+        where = f'{where} AND e.eventDate<={up_to}'
+    if condition is not None:
+        where = f'{where} AND {condition}'
+    return f'{sql} \nWHERE {where}', f'SELECT count(*) FROM {source} e WHERE {where}'
+
+
 # === Query and Load data to Anaplan  ===
 def upload_records_to_anaplan(base_uri, database_file, write_sample_files, chunk_size=15000, **kwargs):
 
@@ -754,25 +930,10 @@ def upload_records_to_anaplan(base_uri, database_file, write_sample_files, chunk
         sql = f'SELECT * FROM {kwargs["table"]}'
         rc_sql = f'SELECT count(*) FROM {kwargs["table"]}'
     else:
-        # Open SQL File in read mode
-        sql_file = open(f'{globals.Paths.scripts}/audit_query.sql', 'r')
-        # read whole file to a string
-        sql = sql_file.read()
-
-        # Update sql with tenant name
-        sql = sql.replace('{{tenant_name}}',
-                          kwargs['tenant_name']).replace('{{time_stamp}}', globals.Timestamps.gmt_epoch)
+        sql, rc_sql = enrichment.staged_query(database_file=database_file, last_run=kwargs['last_run'])
 
-        # Update sql with the last run date increment by 1 millisecond
-        last_run = kwargs['last_run'] + 1
-        sql = f'{sql} \nWHERE e.eventDate>{last_run}'
-        rc_sql = f'SELECT count(*) FROM events e WHERE e.eventDate>{last_run}'
-
-        # close file
-        sql_file.close()
-
-    # Establish connection to SQLite
-    connection = sqlite3.Connection(database_file)
+    # Get the cached connection to SQLite
+    connection = db.connect(database_file)
 
     # Create a cursor to perform operations on the database
     cursor = connection.cursor()
@@ -799,65 +960,36 @@ def upload_records_to_anaplan(base_uri, database_file, write_sample_files, chunk
             logger.info(
                 f'{record_count} records will be uploaded in {chunk_count} chunks to "{kwargs["file_name"]}"')
 
-        # Fetch records and upload to Anaplan by chunk
-        count = 0
-        while count < chunk_count:
-            # Set offset and query chunk
-            offset = chunk_size * count
-            cursor.execute(f'{sql} \nLIMIT {chunk_size} OFFSET {offset};')
-
-            # Convert query to Pandas Data Frame
-            df = pd.DataFrame(cursor.fetchall())
-            chunk_row_count = len(df.index)
-
-            # For all object lists, add a unique ID column and start it at 1
-            if kwargs["add_unique_id"]:
-                df.index = df.index + 1
-                df.index.name = f'{kwargs["acronym"]}_CT'
-
-            # If samples files is toggled on, then limit to two records
-            if write_sample_files:
-                df = df.head(2000)
-
-            # Convert data frame to CSV with no index and if first chunk include the headers
-            # Create samples files if option is toggled on
-            if count == 0:
-                df.columns = [desc[0] for desc in cursor.description]
-                if kwargs["add_unique_id"]:
-                    if write_sample_files:
-                        csv_record_set = df.to_csv(
-                            f'./samples/{kwargs["file_name"]}', index=True)
-                        break
-                    else:
-                        csv_record_set = df.to_csv(index=True)
-                else:
-                    if write_sample_files:
-                        csv_record_set = df.to_csv(
-                            f'./samples/{kwargs["file_name"]}', index=False)
-                        break
-                    else:
-                        csv_record_set = df.to_csv(index=False)
-            else:
-                if kwargs["add_unique_id"]:
-                    csv_record_set = df.to_csv(index=True, header=False)
-                else:
-                    csv_record_set = df.to_csv(index=False, header=False)
+        # Read the chunks in order from one query
+        cursor.execute(sql)
+        columns = [desc[0] for desc in cursor.description]
+        chunks = iter(lambda: cursor.fetchmany(chunk_size), [])
 
-            # Upload chunk to Anaplan
+        # For all object lists, add a unique ID column and start it at 1
+        index_name = f'{kwargs["acronym"]}_CT' if kwargs["add_unique_id"] else None
+
+        # If samples files is toggled on, then write the first 2000 records and stop
+        if write_sample_files:
+            if chunk_count:
+                with open(f'./samples/{kwargs["file_name"]}', 'wb') as file:
+                    file.write(chunk_to_csv(rows=next(chunks)[:2000], columns=columns, first_row=0, index_name=index_name, header=True))
+            return
+
+        # Upload to Anaplan by chunk while the next chunks are serialized
+        progress = structured_logging.progress_reporter(description=f'Upload to "{kwargs["file_name"]}"', total=record_count)
+        csv_chunks = serialize_chunks(chunks=chunks, columns=columns, chunk_size=chunk_size, index_name=index_name,
+                                      parallel=chunk_count > 1)
+        for count, (chunk_row_count, csv_record_set) in enumerate(csv_chunks):
             uri = f'{base_uri}/workspaces/{kwargs["workspace_id"]}/models/{kwargs["model_id"]}/files/{kwargs["file_id"]}/chunks/{count}'
             res = anaplan_api(uri=uri, verb="PUT", data=csv_record_set)
 
             # If status code 204 is returned, then chunk upload is successful
             if res.status_code == 204:
-                print(f'Uploaded: {chunk_row_count} records to "{kwargs["file_name"]}"')
-                logger.info(f'Uploaded: {chunk_row_count} records to "{kwargs["file_name"]}"')
+                progress.update(chunk_row_count)
             else:
                 raise ValueError(f'Failed to upload chunk. Check network connection')
 
-            count += 1
-
-        # Close SQLite connection
-        connection.close()
+        progress.finish(echo=True)
 
     except ValueError as ve:
         logger.error(ve)
@@ -872,6 +1004,38 @@ def upload_records_to_anaplan(base_uri, database_file, write_sample_files, chunk
         sys.exit(1)
 
 
+# ===  Serialize one chunk of query rows to UTF-8 CSV, with the header for the first chunk  ===
+# With `index_name` the rows are numbered from `first_row` + 1 in an extra first column.
+def chunk_to_csv(rows, columns, first_row, index_name, header):
+    df = pd.DataFrame(rows, columns=columns)
+    if index_name:
+        df.index = df.index + first_row + 1
+        df.index.name = index_name
+    return df.to_csv(index=index_name is not None, header=header).encode('utf-8')
+
+
+# ===  Yield `(row count, CSV bytes)` for each chunk in chunk order  ===
+# With `parallel` the chunks are serialized by a process pool on all cores. At most one chunk per worker waits
+# ahead of the uploader, so memory stays bounded.
+def serialize_chunks(chunks, columns, chunk_size, index_name, parallel):
+    if not parallel:
+        for number, rows in enumerate(chunks):
+            yield len(rows), chunk_to_csv(rows=rows, columns=columns, first_row=number * chunk_size, index_name=index_name, header=number == 0)
+        return
+
+    # `spawn` so the workers do not inherit the logging and token refresh threads of this process
+    with ProcessPoolExecutor(max_workers=CSV_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pending = collections.deque()
+        for number, rows in enumerate(chunks):
+            pending.append((len(rows), executor.submit(chunk_to_csv, rows, columns, number * chunk_size, index_name, number == 0)))
+            if len(pending) > CSV_WORKERS:
+                row_count, future = pending.popleft()
+                yield row_count, future.result()
+        while pending:
+            row_count, future = pending.popleft()
+            yield row_count, future.result()
+
+
 # === Execute Process  ===
 def execute_process(uri, workspace, model, process, database_file):
 
@@ -904,19 +1068,25 @@ def execute_process(uri, workspace, model, process, database_file):
         # Isolate task_id
         task_id = json.loads(res.text)['task']['taskId']
 
-        # Monitor Process by looping until complete with a 1 second delay between each loop
+        # Monitor Process by looping until complete with a 1 second delay between each loop.
+        # The task reports its progress as a fraction, tracked in percent.
         uri = f'{uri}/{task_id}'
         state = 'NOT_STARTED'
+        progress = structured_logging.progress_reporter(description=f'Process "{process}"', total=100, unit='%',
+                                                       show_rate=False)
         while state != 'COMPLETE':
             # Fetch status
             res = anaplan_api(uri=uri, verb="GET")
 
             # Isolate task state
-            state = json.loads(res.text)['task']['taskState']
+            task = json.loads(res.text)['task']
+            state = task['taskState']
+            progress.update_to(100 if state == 'COMPLETE' else round(task.get('progress', 0) * 100))
 
             # Sleep for 1 second
-            print('Processing ...')
-            time.sleep(1)
+            if state != 'COMPLETE':
+                time.sleep(1)
+        progress.finish(echo=True)
 
         get_process_run_status(uri=uri, database_file=database_file, workspace_id=workspace_id, model_id=model_id)
 
@@ -981,76 +1151,141 @@ def upload_time_stamp(settings, database_file):
     
     # Construct base URI
     base_uri = f'{settings["uris"]["integrationApi"]}/workspaces/{workspace_id}/models/{model_id}'
-    
+
+    # Resolve the Module, Line Item and List IDs (cached per Workspace/Model) and write the time stamp
+    structure = get_model_structure(settings=settings, database_file=database_file, base_uri=base_uri,
+                                    workspace_id=workspace_id, model_id=model_id)
+    if not write_time_stamp(base_uri=base_uri, structure=structure):
+        # The cached IDs may be stale (e.g. the Reporting Model was changed), so invalidate, resolve again and retry once
+        logger.warning('Time stamp update failed with the cached Model structure. Refreshing the Model structure and retrying.')
+        print('Time stamp update failed with the cached Model structure. Refreshing the Model structure and retrying.')
+        db.delete_state(database_file=database_file, key=f'model_structure:{workspace_id}:{model_id}')
+        structure = get_model_structure(settings=settings, database_file=database_file, base_uri=base_uri,
+                                        workspace_id=workspace_id, model_id=model_id)
+        if not write_time_stamp(base_uri=base_uri, structure=structure):
+            db.delete_state(database_file=database_file, key=f'model_structure:{workspace_id}:{model_id}')
+            print('Unable to update the time stamp and record count in Anaplan')
+            logger.error('Unable to update the time stamp and record count in Anaplan')
+
+
+# === Resolve the IDs of the Refresh Log Module, Line Items and Batch ID List  ===
+def get_model_structure(settings, database_file, base_uri, workspace_id, model_id):
+    cache_key = f'model_structure:{workspace_id}:{model_id}'
+    line_item_names = settings['targetAnaplanModel']['refreshLogLineItems']
+    list_name = settings['targetAnaplanModel']['batchIdList']
+
+    # Use the cached IDs as long as they were resolved for the same Line Item and List names
+    structure = db.read_state(database_file=database_file, key=cache_key)
+    if structure is not None and structure['lineItemNames'] == line_item_names and structure['listName'] == list_name:
+        logger.info(f'Using cached Model structure for "{workspace_id}" / "{model_id}"')
+        return structure
+
     # Get ID of target Line Items
-    uri = f'{base_uri}/lineItems'
-    res = anaplan_api(uri, 'GET')
-    line_item_id1, line_item_id_2 = 0, 0
+    res = anaplan_api(f'{base_uri}/lineItems', 'GET')
+    module_id, line_item_id_1, line_item_id_2 = None, None, None
     for key in json.loads(res.text)['items']:
-        if key['name'] == settings['targetAnaplanModel']['refreshLogLineItems'][0]:
+        if key['name'] == line_item_names[0]:
             line_item_id_1 = key['id']
             module_id = key['moduleId']
-        if key['name'] == settings['targetAnaplanModel']['refreshLogLineItems'][1]:
+        if key['name'] == line_item_names[1]:
             line_item_id_2 = key['id']
 
     # Get ID of target List
-    uri = f'{base_uri}/lists'
-    res = anaplan_api(uri, 'GET')
-    list_id = 0
+    res = anaplan_api(f'{base_uri}/lists', 'GET')
+    list_id = None
     for key in json.loads(res.text)['lists']:
-        if key['name'] == settings['targetAnaplanModel']['batchIdList']:
+        if key['name'] == list_name:
             list_id = key['id']
 
+    structure = {'moduleId': module_id, 'lineItemIds': [line_item_id_1, line_item_id_2], 'listId': list_id,
+                 'lineItemNames': line_item_names, 'listName': list_name}
+
+    # Only persist a complete structure
+    if None in (module_id, line_item_id_1, line_item_id_2, list_id):
+        logger.error(f'Unable to find the Line Items {line_item_names} and/or the List "{list_name}" in the target Model')
+        print(f'Unable to find the Line Items {line_item_names} and/or the List "{list_name}" in the target Model')
+    else:
+        db.write_state(database_file=database_file, key=cache_key, value=structure)
+
+    return structure
+
+
+# === Add the Batch ID list item and write the time stamp and record count. Returns `False` on failure  ===
+def write_time_stamp(base_uri, structure):
+    list_id = structure['listId']
+    line_item_id_1, line_item_id_2 = structure['lineItemIds']
+
     # Add the new ID (epoch time) to the `LOAD_ID` list
     uri = f'{base_uri}/lists/{list_id}/items?action=add'
     res = anaplan_api(uri, 'POST', body={"items": [
-                      {"name": globals.Timestamps.gmt_epoch, "code": globals.Timestamps.gmt_epoch}]})
+                      {"name": globals.Timestamps.gmt_epoch, "code": globals.Timestamps.gmt_epoch}]}, exit_on_error=False)
+    if res is None or res.json().get('failures'):
+        return False
 
     # Inject data to the module
-    uri = f'{base_uri}/modules/{module_id}/data'
+    uri = f'{base_uri}/modules/{structure["moduleId"]}/data'
     res = anaplan_api(uri, 'POST', body=[{"lineItemId": line_item_id_1, "dimensions": [
                       {"dimensionId": list_id, "itemName": globals.Timestamps.gmt_epoch}], "value": globals.Timestamps.local_time_stamp}, {"lineItemId": line_item_id_2, "dimensions": [
-                          {"dimensionId": list_id, "itemName": globals.Timestamps.gmt_epoch}], "value": globals.Counts.audit_records}])
+                          {"dimensionId": list_id, "itemName": globals.Timestamps.gmt_epoch}], "value": globals.Counts.audit_records}], exit_on_error=False)
+    if res is None or res.json().get('failures'):
+        return False
+
+    return True
 
 
 # === Interface with Anaplan REST API   ===
-def anaplan_api(uri, verb, data=None, body={}, token_type="Bearer ", csv=False):
+def anaplan_api(uri, verb, data=None, body={}, token_type="Bearer ", csv=False, exit_on_error=True, retry_unauthorized=True,
+                allowed_statuses=()):
+
+    # Fetch the current `access_token` from the token provider
+    access_token = token_provider.get_access_token()
 
     # Set the header based upon the REST API verb    
     if verb == 'PUT':
         get_headers = {
             'Content-Type': 'application/octet-stream',
             'Accept': 'application/json',
-            'Authorization': token_type + globals.Auth.access_token
+            'Authorization': token_type + access_token
         }
     else: 
         if csv:
             get_headers = {
                 'Content-Type': 'text/plain',
                 'Accept': '*/*',
-                'Authorization': token_type + globals.Auth.access_token
+                'Authorization': token_type + access_token
             }
         else:
             get_headers = {
                 'Content-Type': 'application/json',
                 'Accept': 'application/json',
-                'Authorization': token_type + globals.Auth.access_token
+                'Authorization': token_type + access_token
             }
 
-    # Select operation based upon the the verb
+    # Select operation based upon the the verb. Requests go through the shared session to reuse pooled connections.
+    session = http_session.get_session()
     try:
         match verb:
             case 'GET':
-                res = requests.get(uri, headers=get_headers)
+                res = session.get(uri, headers=get_headers)
             case 'POST':
-                res = requests.post(uri, headers=get_headers, json=body)
+                res = session.post(uri, headers=get_headers, json=body)
             case 'PUT':
-                res = requests.put(uri, headers=get_headers, data=data)
+                res = session.put(uri, headers=get_headers, data=data)
             case 'DELETE':
-                res = requests.delete(uri, headers=get_headers)
+                res = session.delete(uri, headers=get_headers)
             case 'PATCH':
-                res = requests.patch(uri, headers=get_headers)
-        
+                res = session.patch(uri, headers=get_headers)
+
+        # A 401 means the token expired or was revoked mid-flight, so force a refresh and retry once
+        if res.status_code == 401 and retry_unauthorized and token_provider.force_refresh(stale_token=access_token):
+            logger.warning(f'401 received for url: {uri}. Retrying with a refreshed Access Token')
+            return anaplan_api(uri=uri, verb=verb, data=data, body=body, token_type=token_type, csv=csv,
+                               exit_on_error=exit_on_error, retry_unauthorized=False, allowed_statuses=allowed_statuses)
+
+        # Statuses the caller handles itself (e.g. a `404` for an object that has been deleted) are returned as is
+        if res.status_code in allowed_statuses:
+            return res
+
         res.raise_for_status()
 
         return res
@@ -1066,10 +1301,15 @@ def anaplan_api(uri, verb, data=None, body={}, token_type="Bearer ", csv=False):
                 f'{err} in function "{sys._getframe().f_code.co_name}" with the following details: {err.response.text}')
             logging.error(
                 f'{err} in function "{sys._getframe().f_code.co_name}" with the following details: {err.response.text}')
+            # Callers that can recover (e.g. by invalidating a cache) handle the failure themselves
+            if not exit_on_error:
+                return
             sys.exit(1)
     except requests.exceptions.RequestException as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logging.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        if not exit_on_error:
+            return
         sys.exit(1)
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
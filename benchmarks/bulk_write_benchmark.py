@@ -0,0 +1,98 @@
+# ===============================================================================
+# Description:    Compare `DataFrame.to_sql` with the bulk writer for the events, actions and models write patterns
+# ===============================================================================
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Run from the project folder or from `benchmarks`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import globals
+import utils
+import synthetic_data
+import database_ops as db
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark SQLite write throughput (rows/second)")
+    parser.add_argument('-e', '--events', action='store', type=int, default=200000,
+                        help="Number of audit events per write")
+    parser.add_argument('-b', '--batches', action='store', type=int, default=3,
+                        help="Number of appended event batches (the incremental ingest pattern)")
+    parser.add_argument('-m', '--models', action='store', type=int, default=50,
+                        help="Number of models, each with its own appended actions batch (the metadata crawl pattern)")
+    parser.add_argument('--seed', action='store', type=int, default=42,
+                        help="Random seed")
+    return parser.parse_args()
+
+
+# === Synthetic Data Frames shaped like the pipeline's `events`, `actions` and `models` writes ===
+def build_frames(args):
+    settings = utils.read_configuration_settings()
+    rng = np.random.default_rng(args.seed)
+    df_codes = pd.read_csv(f'{globals.Paths.scripts}/activity_events.csv')
+    tenant = synthetic_data.generate_tenant(rng, settings, workspaces=max(args.models // 5, 1), models=5, actions=40,
+                                            files=15, users=2000, integrations=100)
+    end_ms = int(time.time()) * 1000
+    events = [synthetic_data.generate_events(rng, tenant, df_codes, n * args.events, args.events,
+                                             end_ms - 86400000, end_ms, rng.bytes(16).hex()).drop(columns=['index'], errors='ignore')
+              for n in range(args.batches)]
+    actions = [group.drop(columns=['kind']) for _, group in tenant['actions'].groupby('model_id')]
+    models = [tenant['models']]
+    return {'events': events, 'actions': actions, 'models': models}
+
+
+# === Time one write pattern. Each frame is appended in its own call, as the pipeline does ===
+def time_writes(write, database_file, table, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        write(database_file, table, frame)
+    return time.perf_counter() - start
+
+
+def write_to_sql(database_file, table, df):
+    connection = sqlite3.connect(database_file)
+    df.to_sql(name=table, con=connection, if_exists='append', index=table == 'events')
+    connection.commit()
+    connection.close()
+
+
+def write_bulk(database_file, table, df):
+    db.update_table(database_file=database_file, table=table, df=df, mode='append', add_unique_id=table != 'events')
+
+
+def main():
+    utils.initialize()
+    args = read_cli_arguments()
+    frames = build_frames(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f'{"pattern":<10}{"rows":>10}{"to_sql rows/s":>18}{"bulk rows/s":>16}{"speed-up":>10}')
+        for table, table_frames in frames.items():
+            rows = sum(len(frame.index) for frame in table_frames)
+            baseline_file, bulk_file = f'{directory}/to_sql.db3', f'{directory}/bulk.db3'
+            baseline = time_writes(write_to_sql, baseline_file, table, table_frames)
+            bulk = time_writes(write_bulk, bulk_file, table, table_frames)
+            print(f'{table:<10}{rows:>10}{rows / baseline:>18,.0f}{rows / bulk:>16,.0f}{baseline / bulk:>9.1f}x')
+
+            # Both paths must store exactly the same rows
+            connection = db.connect(bulk_file)
+            connection.execute(f"ATTACH DATABASE '{baseline_file}' AS baseline")
+            difference = connection.execute(f'SELECT count(*) FROM (SELECT * FROM main."{table}" EXCEPT SELECT * FROM baseline."{table}")').fetchone()[0]
+            connection.execute('DETACH DATABASE baseline')
+            if difference:
+                print(f'  {difference} rows of `{table}` differ from `to_sql`')
+        db.close_connections()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# ===============================================================================
+# Description:    Compare the SQLite and DuckDB enrichment engines (`audit_query.sql`) at several data sizes
+# ===============================================================================
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+
+# Run from the project folder or from `benchmarks`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+import enrichment
+import synthetic_data
+import database_ops as db
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the enrichment engines (enriched rows/second)")
+    parser.add_argument('-e', '--events', action='store', type=int, nargs='+', default=[100000, 500000, 1000000],
+                        help="Numbers of audit events to enrich")
+    parser.add_argument('-t', '--threads', action='store', type=int, default=0,
+                        help="DuckDB threads (0 uses all cores)")
+    parser.add_argument('--seed', action='store', type=int, default=42,
+                        help="Random seed")
+    return parser.parse_args()
+
+
+# === Synthetic tenant with the same tables the pipeline creates ===
+def generate_database(database_file, settings, events, seed):
+    args = argparse.Namespace(workspaces=10, models=5, actions=40, files=15, users=2000, integrations=100,
+                              events=events, days=365, batch_size=200000, seed=seed)
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        synthetic_data.generate(database_file=database_file, settings=settings, args=args)
+
+
+# === Enrich every event with one engine into its own staging table and return the elapsed time ===
+def time_engine(engine, settings, database_file, table):
+    db.drop_table(database_file=database_file, table=enrichment.STAGING_TABLE)
+    start = time.perf_counter()
+    enrichment.ENGINES[engine](settings=settings, database_file=database_file, watermark=0, up_to=sys.maxsize)
+    elapsed = time.perf_counter() - start
+
+    connection = db.connect(database_file)
+    connection.execute(f'DROP TABLE IF EXISTS {table}')
+    connection.execute(f'ALTER TABLE {enrichment.STAGING_TABLE} RENAME TO {table}')
+    connection.commit()
+    return elapsed
+
+
+def main():
+    utils.initialize()
+    settings = utils.read_configuration_settings()
+    utils.set_time_stamps()
+    args = read_cli_arguments()
+    settings['enrichment'] = {**enrichment.enrichment_settings(settings), 'engine': 'duckdb', 'threads': args.threads}
+
+    print(f'{"events":>10}{"rows":>10}{"sqlite rows/s":>16}{"duckdb rows/s":>16}{"speed-up":>10}')
+    for events in args.events:
+        with tempfile.TemporaryDirectory() as directory:
+            database_file = f'{directory}/audit.db3'
+            generate_database(database_file=database_file, settings=settings, events=events, seed=args.seed)
+
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                sqlite = time_engine('sqlite', settings, database_file, 'enriched_sqlite')
+                duck = time_engine('duckdb', settings, database_file, 'enriched_duckdb')
+
+            # Both engines must produce exactly the same rows
+            connection = db.connect(database_file)
+            rows = connection.execute('SELECT count(*) FROM enriched_sqlite').fetchone()[0]
+            difference = abs(rows - connection.execute('SELECT count(*) FROM enriched_duckdb').fetchone()[0]) \
+                + connection.execute('SELECT count(*) FROM (SELECT * FROM enriched_sqlite EXCEPT SELECT * FROM enriched_duckdb)').fetchone()[0] \
+                + connection.execute('SELECT count(*) FROM (SELECT * FROM enriched_duckdb EXCEPT SELECT * FROM enriched_sqlite)').fetchone()[0]
+            print(f'{events:>10}{rows:>10}{rows / sqlite:>16,.0f}{rows / duck:>16,.0f}{sqlite / duck:>9.1f}x')
+            if difference:
+                print(f'  {difference} rows differ between the engines')
+            db.close_connections()
+
+    # The DuckDB engine attaches the SQLite file when its `sqlite` extension is installed and copies through Arrow otherwise
+    with contextlib.closing(enrichment.duckdb.connect()) as connection:
+        installed = connection.execute("SELECT installed FROM duckdb_extensions() WHERE extension_name = 'sqlite_scanner'").fetchone()[0]
+    print(f'DuckDB input: {"ATTACH through the sqlite extension" if installed else "Arrow copy (sqlite extension not installed)"}')
+
+
+if __name__ == '__main__':
+    main()
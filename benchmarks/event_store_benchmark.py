@@ -0,0 +1,108 @@
+# ===============================================================================
+# Description:    Compare the plain `events` table with the dictionary-encoded event store (size, scans, enrichment)
+# ===============================================================================
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+# Run from the project folder or from `benchmarks`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+import enrichment
+import event_store
+import synthetic_data
+import database_ops as db
+
+# Queries timed on both layouts. The enrichment runs `audit_query.sql` over every event.
+SCANS = {
+    'full scan': 'SELECT count(*), count(DISTINCT userAgent), count(DISTINCT "additionalAttributes.modelId") FROM events',
+    'recent day': 'SELECT count(*) FROM events WHERE eventDate > (SELECT max(eventDate) FROM events) - 86400000'
+}
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the dictionary-encoded event store")
+    parser.add_argument('-e', '--events', action='store', type=int, default=200000,
+                        help="Number of audit events")
+    parser.add_argument('--seed', action='store', type=int, default=42,
+                        help="Random seed")
+    return parser.parse_args()
+
+
+def database_size(database_file):
+    connection = db.connect(database_file)
+    connection.execute('VACUUM')
+    return os.path.getsize(database_file)
+
+
+def time_query(database_file, sql):
+    connection = db.connect(database_file)
+    start = time.perf_counter()
+    connection.execute(sql).fetchall()
+    return time.perf_counter() - start
+
+
+def time_enrichment(settings, database_file):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        enrichment.enrich_with_sqlite(settings=settings, database_file=database_file, watermark=0, up_to=sys.maxsize)
+    elapsed = time.perf_counter() - start
+    connection = db.connect(database_file)
+    connection.execute(f'DROP TABLE {enrichment.STAGING_TABLE}')
+    connection.commit()
+    return elapsed
+
+
+def main():
+    utils.initialize()
+    settings = utils.read_configuration_settings()
+    utils.set_time_stamps()
+    args = read_cli_arguments()
+
+    with tempfile.TemporaryDirectory() as directory:
+        plain_file, store_file = f'{directory}/plain.db3', f'{directory}/store.db3'
+        generate_args = argparse.Namespace(workspaces=10, models=5, actions=40, files=15, users=2000, integrations=100,
+                                           events=args.events, days=30, batch_size=200000, seed=args.seed)
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            synthetic_data.generate(database_file=plain_file, settings=settings, args=generate_args)
+            # Same indexes as the pipeline creates on the hot table
+            db.connect(plain_file).execute('CREATE INDEX events_event_date ON events (eventDate)')
+            db.connect(plain_file).commit()
+            db.close_connections()
+            shutil.copy(plain_file, store_file)
+            start = time.perf_counter()
+            event_store.migrate(database_file=store_file)
+            migration = time.perf_counter() - start
+
+        results = {}
+        for layout, database_file in (('plain', plain_file), ('store', store_file)):
+            results[layout] = {'size (MB)': database_size(database_file) / 2**20}
+            for name, sql in SCANS.items():
+                time_query(database_file, sql)
+                results[layout][f'{name} (s)'] = time_query(database_file, sql)
+            results[layout]['enrichment (s)'] = time_enrichment(settings, database_file)
+
+        # The view must return exactly the rows of the plain table
+        connection = db.connect(store_file)
+        connection.execute(f"ATTACH DATABASE '{plain_file}' AS plain")
+        difference = connection.execute('SELECT count(*) FROM (SELECT * FROM main.events EXCEPT SELECT * FROM plain.events)').fetchone()[0]
+        db.close_connections()
+
+    print(f'{args.events} events, migrated in {migration:.1f} s')
+    print(f'{"":<18}{"plain":>10}{"store":>10}{"ratio":>8}')
+    for metric in results['plain']:
+        plain, store = results['plain'][metric], results['store'][metric]
+        print(f'{metric:<18}{plain:>10.2f}{store:>10.2f}{store / plain:>8.2f}')
+    if difference:
+        print(f'{difference} rows of the `events` view differ from the plain table')
+
+
+if __name__ == '__main__':
+    main()
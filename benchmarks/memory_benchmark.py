@@ -0,0 +1,142 @@
+# ===============================================================================
+# Description:    Bytes per audit event held in memory by the ingest Data Frames, before and after the compact layout
+# ===============================================================================
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+# Run from the project folder or from `benchmarks`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import globals
+import utils
+import synthetic_data
+import anaplan_ops
+import event_frames
+import database_ops as db
+
+# How a page of the Audit API response is turned into a Data Frame and a batch is assembled
+#   object:          `pd.json_normalize` with object-dtype strings (pandas before 3.0, or without `pyarrow`)
+#   json_normalize:  `pd.json_normalize` with the default strings of the installed pandas (the previous ingest)
+#   compact:         `event_frames` with Arrow-backed strings and categoricals (the current ingest)
+VARIANTS = ['object', 'json_normalize', 'compact']
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(description="Measure the memory held per audit event by the ingest Data Frames")
+    parser.add_argument('-e', '--events', action='store', type=int, default=200000,
+                        help="Number of audit events in the batch")
+    parser.add_argument('--page_size', action='store', type=int, default=10000,
+                        help="Number of audit events per API page")
+    parser.add_argument('--seed', action='store', type=int, default=42,
+                        help="Random seed")
+    return parser.parse_args()
+
+
+# === Audit API response pages (JSON, one per line) for a synthetic tenant ===
+def write_pages(args, pages_file):
+    utils.initialize()
+    settings = utils.read_configuration_settings()
+    rng = np.random.default_rng(args.seed)
+    df_codes = pd.read_csv(f'{globals.Paths.scripts}/activity_events.csv')
+    tenant = synthetic_data.generate_tenant(rng, settings, workspaces=10, models=5, actions=40, files=15, users=2000,
+                                            integrations=100)
+    end_ms = int(time.time()) * 1000
+    events = synthetic_data.generate_events(rng, tenant, df_codes, 0, args.events, end_ms - 30 * 86400000, end_ms,
+                                            rng.bytes(16).hex())
+    rows = [synthetic_data.unflatten_event(row) for row in events.to_dict(orient='records')]
+    with open(pages_file, 'w') as file:
+        file.write('\n'.join(json.dumps({'response': rows[start:start + args.page_size]})
+                             for start in range(0, len(rows), args.page_size)))
+
+
+# === Peak resident memory of this process in bytes (`None` where the `resource` module is not available) ===
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+# === Build the batch the way `variant` does, in a fresh process, and store it for the comparison ===
+def run_variant(variant, pages_file, database_file):
+    utils.initialize()
+
+    # Pages are read one at a time, as they arrive from the API, so only the Data Frames accumulate
+    with pd.option_context('future.infer_string', variant != 'object'), open(pages_file) as pages:
+        rss_before = peak_rss()
+        start = time.perf_counter()
+        frames = [anaplan_ops.initialize_data_frame()]
+        for page in pages:
+            events = json.loads(page)['response']
+            if variant == 'compact':
+                frames.append(event_frames.records_frame(events, categories=event_frames.EVENT_CATEGORIES))
+            else:
+                frames.append(pd.json_normalize(events))
+        if variant == 'compact':
+            df = event_frames.concat(frames, categories=event_frames.EVENT_CATEGORIES)
+        else:
+            df = pd.concat(frames, ignore_index=True)
+        seconds = time.perf_counter() - start
+        rss_after = peak_rss()
+
+        db.update_table(database_file=database_file, table='events', df=df, mode='replace', add_unique_id=False)
+        db.close_connections()
+
+    return {'events': len(df.index), 'bytes': event_frames.frame_bytes(df), 'seconds': seconds,
+            'rss': None if rss_before is None else rss_after - rss_before}
+
+
+def main():
+    utils.initialize()
+    args = read_cli_arguments()
+
+    # The pages and each variant are built in their own process. The peak resident memory of a process is inherited
+    # by the processes it starts, so this one stays small and one variant cannot hide the next.
+    with tempfile.TemporaryDirectory() as directory:
+        pages_file = f'{directory}/pages.json'
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=1) as pool:
+            pool.apply(write_pages, (args, pages_file))
+
+        results = {}
+        for variant in VARIANTS:
+            with context.Pool(processes=1) as pool:
+                results[variant] = pool.apply(run_variant, (variant, pages_file, f'{directory}/{variant}.db3'))
+
+        print(f'{"variant":<16}{"events":>10}{"frame bytes/event":>20}{"peak RSS growth/event":>24}{"build s":>10}')
+        for variant, result in results.items():
+            rss = 'n/a' if result['rss'] is None else f'{result["rss"] / result["events"]:,.0f}'
+            print(f'{variant:<16}{result["events"]:>10}{result["bytes"] / result["events"]:>20,.0f}{rss:>24}'
+                  f'{result["seconds"]:>10.2f}')
+        baseline, compact = results['json_normalize'], results['compact']
+        print(f'compact holds {baseline["bytes"] / compact["bytes"]:.1f}x less than json_normalize and '
+              f'{results["object"]["bytes"] / compact["bytes"]:.1f}x less than object strings')
+
+        # Every variant must store exactly the same rows
+        connection = db.connect(f'{directory}/compact.db3')
+        for variant in VARIANTS[:-1]:
+            connection.execute(f"ATTACH DATABASE '{directory}/{variant}.db3' AS baseline")
+            difference = connection.execute('SELECT count(*) FROM (SELECT * FROM main.events EXCEPT SELECT * FROM baseline.events)').fetchone()[0]
+            difference += connection.execute('SELECT count(*) FROM (SELECT * FROM baseline.events EXCEPT SELECT * FROM main.events)').fetchone()[0]
+            types = connection.execute('PRAGMA main.table_info(events)').fetchall() == connection.execute('PRAGMA baseline.table_info(events)').fetchall()
+            connection.execute('DETACH DATABASE baseline')
+            if not types:
+                print(f'  The column types of the compact batch differ from `{variant}`')
+            if difference:
+                print(f'  {difference} rows of the compact batch differ from `{variant}`')
+        db.close_connections()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# ===============================================================================
+# Description:    Measure start-up cost: `import main` and a full run with no new audit events
+# ===============================================================================
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+# Project folder (one level up from `benchmarks`)
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs `main.py` in-process and reports on exit whether pandas was actually loaded (the lazy module placeholder
+# does not count). `SystemExit` from `main()` is expected.
+RUN_MAIN = """
+import sys, atexit, runpy
+atexit.register(lambda: print(f"pandas loaded: {'pandas.core' in sys.modules}", file=sys.stderr))
+sys.argv = ['main.py'] + sys.argv[1:]
+runpy.run_path('main.py', run_name='__main__')
+"""
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(description="Measure the start-up cost of the audit pipeline")
+    parser.add_argument('-n', '--repeat', action='store', type=int, default=10,
+                        help="Number of timed repetitions")
+    parser.add_argument('--run', action='store_true',
+                        help="Also time `main.py` end to end. Run this against a `settings.json` whose `lastRun` is current "
+                             "(e.g. the mock API from `synthetic_data.py --serve`) so no new events are returned")
+    parser.add_argument('main_args', nargs=argparse.REMAINDER,
+                        help="Arguments passed to `main.py` after `--` (e.g. `-- -u user -p password`)")
+    return parser.parse_args()
+
+
+# === Time a command in a fresh interpreter ===
+def time_command(command, repeat):
+    timings, stderr = [], ''
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=PROJECT, capture_output=True, text=True)
+        timings.append((time.perf_counter() - start) * 1000)
+        stderr = result.stderr
+    return timings, stderr
+
+
+def report(label, timings):
+    print(f'{label:<28} median {statistics.median(timings):8.1f} ms   min {min(timings):8.1f} ms   max {max(timings):8.1f} ms')
+
+
+def main():
+    args = read_cli_arguments()
+
+    baseline, _ = time_command([sys.executable, '-c', 'pass'], args.repeat)
+    report('python -c pass', baseline)
+
+    imports, _ = time_command([sys.executable, '-c', 'import main'], args.repeat)
+    report('python -c "import main"', imports)
+
+    if args.run:
+        main_args = [arg for arg in args.main_args if arg != '--']
+        runs, stderr = time_command([sys.executable, '-c', RUN_MAIN] + main_args, args.repeat)
+        report('main.py (no new events)', runs)
+        print(stderr.strip().splitlines()[-1] if stderr.strip() else 'pandas loaded: unknown')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# ===============================================================================
+# Description:    Long-running daemon that polls the Audit API and keeps state warm between cycles
+# ===============================================================================
+
+import sys
+import json
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import globals
+import utils
+import anaplan_ops
+import rate_governor
+import metadata_crawl
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `daemon` block in `settings.json`
+DEFAULT_SETTINGS = {
+    "pollInterval": 300,
+    "metadataRefreshInterval": 3600,
+    "healthHost": "127.0.0.1",
+    "healthPort": 8081
+}
+
+
+# ===  Counters exposed by the health and metrics endpoint  ===
+class DaemonMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.cycles = 0
+        self.cycle_failures = 0
+        self.events_ingested = 0
+        self.events_published = 0
+        self.metadata_syncs = 0
+        self.last_cycle_at = 0
+        self.last_cycle_seconds = 0
+        self.last_success_at = 0
+        self.metadata_synced_at = 0
+        self.last_error = None
+
+    def update(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                setattr(self, key, value)
+
+    def increment(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def snapshot(self):
+        with self.lock:
+            values = {key: value for key, value in vars(self).items() if key != 'lock'}
+        provider = globals.Auth.token_provider
+        values['token_expires_in'] = int(provider.time_to_expiry()) if provider is not None else None
+        values.update(rate_governor.totals())
+        return values
+
+
+# ===  `/health` returns JSON and `/metrics` returns the Prometheus text format  ===
+class health_handler(BaseHTTPRequestHandler):
+    metrics = None
+    poll_interval = 300
+
+    # Silence the default access log on the console
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        values = self.metrics.snapshot()
+        if self.path.startswith('/health'):
+            # Healthy while the last successful cycle is no older than three polling intervals
+            healthy = values['last_success_at'] > 0 and time.time() - values['last_success_at'] < 3 * self.poll_interval
+            body = json.dumps({'status': 'ok' if healthy else 'degraded', **values}).encode('utf-8')
+            self.send_response(200 if healthy else 503)
+            self.send_header('Content-Type', 'application/json')
+        elif self.path.startswith('/metrics'):
+            lines = []
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'anaplan_audit_{key} {value}')
+            body = ('\n'.join(lines) + '\n').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        else:
+            body = b'Not found'
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# ===  Start the health and metrics endpoint in a background thread  ===
+def start_health_server(metrics, host, port, poll_interval):
+    health_handler.metrics = metrics
+    health_handler.poll_interval = poll_interval
+    server = ThreadingHTTPServer((host, port), health_handler)
+    threading.Thread(target=server.serve_forever, name='Health Server', daemon=True).start()
+    print(f'Health and metrics endpoint listening on http://{host}:{port}/health and /metrics')
+    logger.info(f'Health and metrics endpoint listening on http://{host}:{port}/health and /metrics')
+    return server
+
+
+# ===  Crawl the metadata and record when it was last synced  ===
+def sync_metadata(settings, database_file, metrics):
+    anaplan_ops.sync_metadata(settings=settings, database_file=database_file, uris=settings['uris'],
+                              targetModelObjects=settings['targetAnaplanModel']['targetModelObjects'])
+    metrics.update(metadata_synced_at=time.time())
+    metrics.increment(metadata_syncs=1)
+
+
+# ===  One polling cycle: ingest new events and, if there are any, publish them to Anaplan  ===
+def run_cycle(settings, database_file, metrics, metadata_refresh_interval):
+    utils.set_time_stamps()
+    globals.Counts.audit_records = 0
+
+    latest_run = anaplan_ops.ingest_events(settings=settings, database_file=database_file)
+    metrics.increment(events_ingested=globals.Counts.events_received)
+
+    if latest_run > settings['lastRun']:
+        # Crawl all the metadata only when the idle-time refresh has fallen behind (or never ran). Otherwise resolve
+        # just the users, Workspaces, Models and objects of the new events, so they are enriched with current names.
+        targetModelObjects = settings['targetAnaplanModel']['targetModelObjects']
+        stale = time.time() - metrics.metadata_synced_at > metadata_refresh_interval
+        if stale or not metadata_crawl.targeted_ready(database_file=database_file, targetModelObjects=targetModelObjects):
+            sync_metadata(settings=settings, database_file=database_file, metrics=metrics)
+        else:
+            anaplan_ops.sync_new_metadata(settings=settings, database_file=database_file, uris=settings['uris'],
+                                          targetModelObjects=targetModelObjects)
+        anaplan_ops.publish_events(settings=settings, database_file=database_file, sync=False)
+        metrics.increment(events_published=globals.Counts.audit_records)
+        anaplan_ops.update_history(settings=settings, database_file=database_file)
+    else:
+        print('There were no audit events since the last poll')
+        logger.info('There were no audit events since the last poll')
+
+
+# ===  Daemon loop  ===
+def run(settings, interval=None):
+    daemon_settings = {**DEFAULT_SETTINGS, **settings.get('daemon', {})}
+    poll_interval = interval or daemon_settings['pollInterval']
+    metadata_refresh_interval = daemon_settings['metadataRefreshInterval']
+    database_file = f'{globals.Paths.databases}/{settings["database"]}'
+
+    metrics = DaemonMetrics()
+    server = start_health_server(metrics=metrics, host=daemon_settings['healthHost'],
+                                 port=daemon_settings['healthPort'], poll_interval=poll_interval)
+
+    print(f'Daemon started with a polling interval of {poll_interval} seconds')
+    logger.info(f'Daemon started with a polling interval of {poll_interval} seconds')
+
+    try:
+        while True:
+            cycle_start = time.time()
+            try:
+                run_cycle(settings=settings, database_file=database_file, metrics=metrics,
+                          metadata_refresh_interval=metadata_refresh_interval)
+                metrics.update(last_success_at=time.time(), last_error=None)
+            except (Exception, SystemExit) as err:
+                # A failed cycle is retried on the next poll instead of stopping the daemon
+                metrics.increment(cycle_failures=1)
+                metrics.update(last_error=f'{type(err).__name__}: {err}')
+                print(f'Polling cycle failed: {err}')
+                logger.error(f'Polling cycle failed: {err}')
+            metrics.increment(cycles=1)
+            metrics.update(last_cycle_at=cycle_start, last_cycle_seconds=round(time.time() - cycle_start, 3))
+
+            # Use idle time until the next poll to keep the metadata fresh
+            next_poll = cycle_start + poll_interval
+            if time.time() - metrics.metadata_synced_at > metadata_refresh_interval and time.time() < next_poll:
+                try:
+                    print('Refreshing metadata while idle')
+                    logger.info('Refreshing metadata while idle')
+                    sync_metadata(settings=settings, database_file=database_file, metrics=metrics)
+                except (Exception, SystemExit) as err:
+                    metrics.update(last_error=f'{type(err).__name__}: {err}')
+                    logger.error(f'Idle metadata refresh failed: {err}')
+
+            time.sleep(max(next_poll - time.time(), 0))
+
+    except KeyboardInterrupt:
+        print('Daemon stopped')
+        logger.info('Daemon stopped')
+        server.shutdown()
+        if globals.Auth.token_provider is not None:
+            globals.Auth.token_provider.stop()
+        db.close_connections()
+        sys.exit(0)
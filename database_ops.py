@@ -5,23 +5,78 @@
 import logging
 import sqlite3
 import sys
-import pandas as pd
+import json
+import threading
+
+import utils
+
+# Heavy dependencies are loaded on first use
+pd = utils.lazy_import('pandas')
+apsw = utils.lazy_import('apsw')
 
 # Enable logger
 logger = logging.getLogger(__name__)
 
+# Version counter per (database file, table) that is bumped on every write so in-memory caches know when to reload
+table_versions = {}
+
+
+# Connections are cached per thread and per database file so they stay warm between calls
+connections = threading.local()
+
+
+# ===  Quote a table or column name for SQL  ===
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# ===  Get the cached connection to a database file  ===
+def connect(database_file):
+    cache = connections.__dict__.setdefault('cache', {})
+    if database_file not in cache:
+        cache[database_file] = sqlite3.Connection(database_file)
+    return cache[database_file]
+
+
+# ===  Get the cached APSW connection used for bulk writes  ===
+# APSW's `executemany` binds rows about three times faster than the `sqlite3` module
+def bulk_connect(database_file):
+    cache = connections.__dict__.setdefault('bulk_cache', {})
+    if database_file not in cache:
+        utils.forward_sqlite_logs()
+        cache[database_file] = apsw.Connection(database_file)
+        cache[database_file].set_busy_timeout(5000)
+    return cache[database_file]
+
+
+# ===  Close the cached connections of the current thread  ===
+def close_connections():
+    for key in ('cache', 'bulk_cache'):
+        cache = connections.__dict__.setdefault(key, {})
+        for connection in cache.values():
+            connection.close()
+        cache.clear()
+
+
+# ===  Mark a table as changed  ===
+def bump_table_version(database_file, table):
+    key = (database_file, table)
+    table_versions[key] = table_versions.get(key, 0) + 1
+
+
+# ===  Current version of a table  ===
+def table_version(database_file, table):
+    return table_versions.get((database_file, table), 0)
+
 # ===  Read from tables in the SQLite Database  ===
 def read_table(database_file, table):
     try:
-        # Establish connection to SQLite
-        connection = sqlite3.Connection(database_file)
+        # Get the cached connection to SQLite
+        connection = connect(database_file)
 
         # Read the contents of the table into a Data Frame
         df = pd.read_sql_query(f"SELECT * FROM {table}", connection)
 
-        # Close connection
-        connection.close()
-
         return df
 
     except sqlite3.Error as err:
@@ -36,20 +91,17 @@ def read_table(database_file, table):
 # ===  Write to tables in the SQLite Database  ===
 def update_table(database_file, table, df, mode, add_unique_id=True):
     try:
-        # Establish connection to SQLite
-        connection = sqlite3.Connection(database_file)
+        # Commit pending work on the cached connection so the bulk writer can take the write lock
+        connection = connect(database_file)
+        connection.commit()
 
         # Write the contents of Data Frame to the SQLlite table. If unique_id is false, then a new ID will be generated when uploaded to Anaplan
-        if add_unique_id:
-            df.to_sql(name=table, con=connection, if_exists=mode, index=False)
-        else:
-            df.to_sql(name=table, con=connection, if_exists=mode, index=True)
+        bulk_write(connection=bulk_connect(database_file), table=table, df=df, mode=mode, index=not add_unique_id)
+        bump_table_version(database_file, table)
 
-        # Commit data and close connection
-        connection.commit()
-        connection.close()
-
-    except sqlite3.Error as err:
+    except (sqlite3.Error, apsw.Error) as err:
+        # Discard the partial write so it is not committed by a later call on the cached connection
+        connect(database_file).rollback()
         print(err)
         logger.warning(f'Table `{table}` does not exist')
         print(f'Table `{table}` does not exist')
@@ -59,12 +111,66 @@ def update_table(database_file, table, df, mode, add_unique_id=True):
         logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
         sys.exit(1)
 
+# ===  SQLite column type for a Data Frame column (the same types `DataFrame.to_sql` declares)  ===
+# A categorical column is declared from the type of its categories.
+def sqlite_type(dtype):
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    match dtype.kind:
+        case 'i' | 'u' | 'b':
+            return 'INTEGER'
+        case 'f':
+            return 'REAL'
+        case 'M':
+            return 'TIMESTAMP'
+        case _:
+            return 'TEXT'
+
+
+# ===  Column values as Python objects SQLite can bind, with missing values as NULL  ===
+def column_values(series):
+    if series.dtype.kind in 'iub' and not series.hasnans:
+        return series.tolist()
+    if series.dtype.kind == 'M':
+        series = series.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    return series.to_numpy(dtype=object, na_value=None).tolist()
+
+
+# ===  Write a Data Frame with one prepared `executemany` inside a single transaction (APSW connection)  ===
+# `mode` is `replace` (recreate the table) or `append` (create it if needed and add any new columns). The table is
+# declared from the Data Frame types. With `index` the Data Frame index is written to an `index` column, as `to_sql` does.
+def bulk_write(connection, table, df, mode, index=False):
+    columns = {}
+    if index:
+        columns['index'] = ('INTEGER', df.index.tolist())
+    for name in df.columns:
+        columns[str(name)] = (sqlite_type(df[name].dtype), column_values(df[name]))
+
+    quoted = {name: quote(name) for name in columns}
+
+    # Committed on success and rolled back on any error
+    with connection:
+        if mode == 'replace':
+            connection.execute(f'DROP TABLE IF EXISTS {quote(table)}')
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {quote(table)} ('
+                           + ', '.join(f'{quoted[name]} {column_type}' for name, (column_type, _) in columns.items()) + ')')
+
+        # Columns that appeared since the table was created (e.g. new audit event attributes)
+        existing = {row[1] for row in connection.execute(f'PRAGMA table_info({quote(table)})')}
+        for name, (column_type, _) in columns.items():
+            if name not in existing:
+                connection.execute(f'ALTER TABLE {quote(table)} ADD COLUMN {quoted[name]} {column_type}')
+
+        connection.executemany(f'INSERT INTO {quote(table)} ({", ".join(quoted.values())}) VALUES ({", ".join("?" * len(columns))})',
+                               zip(*(values for _, values in columns.values())))
+
+
 # ===  Drop existing tables in the SQLite Database  ===
 def drop_table(database_file, table):
 
     try:
-        # Establish connection to SQLite
-        connection = sqlite3.Connection(database_file)
+        # Get the cached connection to SQLite
+        connection = connect(database_file)
 
         # Create a cursor to perform operations on the database
         cursor = connection.cursor()
@@ -74,9 +180,9 @@ def drop_table(database_file, table):
         logger.info(f'Table `{table}` has been dropped')
         print(f'Table `{table}` has been dropped')
 
-        # Commit data and close connection
+        # Commit data
         connection.commit()
-        connection.close()
+        bump_table_version(database_file, table)
 
     except sqlite3.Error as err:
         logger.warning(f'Table `{table}` does not exist')
@@ -91,8 +197,8 @@ def drop_table(database_file, table):
 def create_table(database_file, table, columns):
     
         try:
-            # Establish connection to SQLite
-            connection = sqlite3.Connection(database_file)
+            # Get the cached connection to SQLite
+            connection = connect(database_file)
     
             # Create a cursor to perform operations on the database
             cursor = connection.cursor()
@@ -102,9 +208,8 @@ def create_table(database_file, table, columns):
             logger.info(f'Table `{table}` has been created')
             print(f'Table `{table}` has been created')
     
-            # Commit data and close connection
+            # Commit data
             connection.commit()
-            connection.close()
     
         except sqlite3.Error as err:
             logger.warning(f'Table `{table}` already exists')
@@ -118,8 +223,8 @@ def create_table(database_file, table, columns):
 # === Check if a table exists in the SQLite Database ===
 def table_exists(database_file, table):
     try:
-        # Establish connection to SQLite
-        connection = sqlite3.Connection(database_file)
+        # Get the cached connection to SQLite
+        connection = connect(database_file)
 
         # Create a cursor to perform operations on the database
         cursor = connection.cursor()
@@ -128,9 +233,8 @@ def table_exists(database_file, table):
         cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'")
         table_exists = cursor.fetchone()
 
-        # Commit data and close connection
+        # Commit data
         connection.commit()
-        connection.close()
 
         return table_exists
 
@@ -146,8 +250,8 @@ def table_exists(database_file, table):
 # === Truncate a table in the SQLite Database ===
 def truncate_table(database_file, table):
     try:
-        # Establish connection to SQLite
-        connection = sqlite3.Connection(database_file)
+        # Get the cached connection to SQLite
+        connection = connect(database_file)
 
         # Create a cursor to perform operations on the database
         cursor = connection.cursor()
@@ -157,9 +261,9 @@ def truncate_table(database_file, table):
         logger.info(f'Table `{table}` has been truncated')
         print(f'Table `{table}` has been truncated')
 
-        # Commit data and close connection
+        # Commit data
         connection.commit()
-        connection.close()
+        bump_table_version(database_file, table)
 
     except sqlite3.Error as err:
         logger.warning(f'Table `{table}` does not exist')
@@ -168,4 +272,72 @@ def truncate_table(database_file, table):
     except Exception as err:
         print(f'{err} in function "{sys._getframe().f_code.co_name}"')
         logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
+
+# === Read a value from the pipeline state table ===
+def read_state(database_file, key, default=None):
+    try:
+        # Get the cached connection to SQLite
+        connection = connect(database_file)
+
+        # Create the state table on first use
+        connection.execute("CREATE TABLE IF NOT EXISTS pipeline_state (key TEXT PRIMARY KEY, value TEXT, updated INTEGER)")
+        row = connection.execute("SELECT value FROM pipeline_state WHERE key = ?", (key,)).fetchone()
+
+        return default if row is None else json.loads(row[0])
+
+    except sqlite3.Error as err:
+        logger.warning(f'Unable to read state `{key}`: {err}')
+        print(f'Unable to read state `{key}`: {err}')
+        return default
+
+    except Exception as err:
+        print(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+
+# === Write a value to the pipeline state table ===
+def write_state(database_file, key, value):
+    try:
+        # Get the cached connection to SQLite
+        connection = connect(database_file)
+
+        # Create the state table on first use and upsert the JSON encoded value
+        connection.execute("CREATE TABLE IF NOT EXISTS pipeline_state (key TEXT PRIMARY KEY, value TEXT, updated INTEGER)")
+        connection.execute("INSERT INTO pipeline_state (key, value, updated) VALUES (?, ?, strftime('%s','now')) "
+                           "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                           (key, json.dumps(value)))
+
+        # Commit data
+        connection.commit()
+
+    except sqlite3.Error as err:
+        logger.warning(f'Unable to write state `{key}`: {err}')
+        print(f'Unable to write state `{key}`: {err}')
+
+    except Exception as err:
+        print(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+
+# === Delete a value from the pipeline state table ===
+def delete_state(database_file, key):
+    try:
+        # Get the cached connection to SQLite
+        connection = connect(database_file)
+
+        # Remove the key
+        connection.execute("CREATE TABLE IF NOT EXISTS pipeline_state (key TEXT PRIMARY KEY, value TEXT, updated INTEGER)")
+        connection.execute("DELETE FROM pipeline_state WHERE key = ?", (key,))
+
+        # Commit data
+        connection.commit()
+
+    except sqlite3.Error as err:
+        logger.warning(f'Unable to delete state `{key}`: {err}')
+        print(f'Unable to delete state `{key}`: {err}')
+
+    except Exception as err:
+        print(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
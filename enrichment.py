@@ -0,0 +1,210 @@
+# ===============================================================================
+# Description:    Enrich stage: materialize `audit_query.sql` output into a staging table for publishing
+# ===============================================================================
+
+import sys
+import logging
+import sqlite3
+import importlib.util
+
+import globals
+import utils
+import anaplan_ops
+import profiling
+import database_ops as db
+
+# Loaded on first use. DuckDB is optional and only needed for `"engine": "duckdb"`.
+pd = utils.lazy_import('pandas')
+pa = utils.lazy_import('pyarrow')
+apsw = utils.lazy_import('apsw')
+duckdb = utils.lazy_import('duckdb')
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `enrichment` block in `settings.json`. `threads` 0 uses all cores.
+DEFAULT_SETTINGS = {
+    "engine": "sqlite",
+    "threads": 0,
+    "chunkSize": 50000
+}
+
+# Enriched audit events awaiting publication. `EVENT_DATE_MS` (epoch milliseconds) drives the publish watermark
+# and is not uploaded to Anaplan.
+STAGING_TABLE = 'audit_enriched'
+STAGING_KEY_COLUMN = 'EVENT_DATE_MS'
+
+# `pipeline_state` key holding the latest `eventDate` (epoch milliseconds) already enriched
+WATERMARK_KEY = 'enrich_watermark'
+
+# Metadata tables joined by `audit_query_duckdb.sql`, copied into DuckDB next to the new events
+JOINED_TABLES = ['users', 'workspaces', 'models', 'cloudworks', 'act_codes', 'actions']
+
+
+# ===  Enrichment settings merged with the defaults  ===
+def enrichment_settings(settings):
+    return {**DEFAULT_SETTINGS, **settings.get('enrichment', {})}
+
+
+# ===  Enrich the events ingested since the last enrichment and append them to the staging table  ===
+@profiling.phase('enrich')
+def enrich_events(settings, database_file):
+    watermark = anaplan_ops.stage_watermark(settings=settings, database_file=database_file, key=WATERMARK_KEY)
+    connection = db.connect(database_file)
+
+    try:
+        # Fix the upper bound so events ingested while enriching are picked up by the next run
+        up_to = connection.execute('SELECT max(eventDate) FROM events WHERE eventDate > ?', (watermark,)).fetchone()[0]
+        if up_to is None:
+            print('No new audit events to enrich')
+            logger.info('No new audit events to enrich')
+            return 0
+
+        engine = enrichment_settings(settings)['engine']
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown enrichment engine "{engine}". Use one of {", ".join(ENGINES)}')
+        ENGINES[engine](settings=settings, database_file=database_file, watermark=watermark, up_to=up_to)
+        db.bump_table_version(database_file, STAGING_TABLE)
+
+        enriched = connection.execute(f'SELECT count(*) FROM {STAGING_TABLE} WHERE {STAGING_KEY_COLUMN} > ?', (watermark,)).fetchone()[0]
+        db.write_state(database_file=database_file, key=WATERMARK_KEY, value=up_to)
+
+        print(f'{enriched} enriched audit records staged for publishing')
+        logger.info(f'{enriched} enriched audit records staged for publishing')
+        return enriched
+
+    except (sqlite3.Error, apsw.Error) as err:
+        connection.rollback()
+        print(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+    except Exception as err:
+        print(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+
+
+# ===  SQLite engine: `audit_query.sql` runs inside the database and appends to the staging table directly  ===
+def enrich_with_sqlite(settings, database_file, watermark, up_to):
+    sql, _ = anaplan_ops.build_audit_query(tenant_name=settings['anaplanTenantName'], last_run=watermark - 1, up_to=up_to,
+                                           extra_columns=f'e.eventDate AS {STAGING_KEY_COLUMN}')
+    connection = db.connect(database_file)
+    if db.table_exists(database_file=database_file, table=STAGING_TABLE):
+        connection.execute(f'INSERT INTO {STAGING_TABLE} {sql}')
+    else:
+        connection.execute(f'CREATE TABLE {STAGING_TABLE} AS {sql}')
+    connection.commit()
+
+
+# ===  DuckDB engine: `audit_query_duckdb.sql` runs multi-threaded over an in-memory copy of the new events and metadata  ===
+# The result is streamed back in `chunkSize` batches and appended to the staging table in a single transaction.
+def enrich_with_duckdb(settings, database_file, watermark, up_to):
+    if importlib.util.find_spec('duckdb') is None:
+        raise ModuleNotFoundError('The DuckDB enrichment engine needs the `duckdb` package (`pip install duckdb`)')
+
+    engine = enrichment_settings(settings)
+    connection = duckdb.connect()
+    try:
+        if engine['threads']:
+            connection.execute(f'SET threads = {int(engine["threads"])}')
+        if not attach_source(connection=connection, database_file=database_file, watermark=watermark, up_to=up_to):
+            copy_source(connection=connection, database_file=database_file, watermark=watermark, up_to=up_to)
+
+        sql, _ = anaplan_ops.build_audit_query(tenant_name=settings['anaplanTenantName'], last_run=watermark - 1, up_to=up_to,
+                                               extra_columns=f'e.eventDate AS {STAGING_KEY_COLUMN}',
+                                               query_file='audit_query_duckdb.sql')
+        reader = connection.execute(sql).fetch_record_batch(engine['chunkSize'])
+
+        # Release the `sqlite3` connection's transaction before writing through APSW
+        db.connect(database_file).commit()
+        bulk_connection = db.bulk_connect(database_file)
+        with bulk_connection:
+            for batch in reader:
+                db.bulk_write(connection=bulk_connection, table=STAGING_TABLE, df=batch.to_pandas(types_mapper=pd.ArrowDtype),
+                              mode='append')
+    finally:
+        connection.close()
+
+
+# ===  Load the new events and the metadata through DuckDB's `sqlite` extension. Returns `False` if it is not installed  ===
+def attach_source(connection, database_file, watermark, up_to):
+    try:
+        connection.execute('LOAD sqlite')
+    except duckdb.Error:
+        return False
+
+    connection.execute(f"ATTACH '{database_file.replace(chr(39), chr(39) * 2)}' AS source (TYPE sqlite, READ_ONLY)")
+    connection.execute('CREATE TABLE events AS SELECT * FROM source.events WHERE eventDate > ? AND eventDate <= ?', [watermark, up_to])
+    for table in JOINED_TABLES:
+        connection.execute(f'CREATE TABLE "{table}" AS SELECT * FROM source."{table}"')
+    connection.execute('DETACH source')
+    return True
+
+
+# ===  Load the new events and the metadata through Arrow when the `sqlite` extension is not available  ===
+def copy_source(connection, database_file, watermark, up_to):
+    source = db.connect(database_file)
+    copy_table(connection=connection, source=source, table='events',
+               sql='SELECT * FROM events WHERE eventDate > ? AND eventDate <= ?', parameters=(watermark, up_to))
+    for table in JOINED_TABLES:
+        copy_table(connection=connection, source=source, table=table, sql=f'SELECT * FROM "{table}"')
+
+
+def copy_table(connection, source, table, sql, parameters=()):
+    # Arrow types from the declared column types. Columns holding mixed values are copied as text.
+    arrow_types = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+    declared = {row[1]: arrow_types.get(row[2].upper(), pa.string()) for row in source.execute(f'PRAGMA table_info("{table}")')}
+
+    cursor = source.execute(sql, parameters)
+    columns = [desc[0] for desc in cursor.description]
+    rows = cursor.fetchall()
+    arrays = []
+    for column, values in zip(columns, zip(*rows) if rows else [()] * len(columns)):
+        try:
+            arrays.append(pa.array(values, type=declared[column]))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array([None if value is None else str(value) for value in values], type=pa.string()))
+
+    connection.register('arrow_source', pa.Table.from_arrays(arrays, names=columns))
+    connection.execute(f'CREATE TABLE "{table}" AS SELECT * FROM arrow_source')
+    connection.unregister('arrow_source')
+
+
+# Enrichment engines selected by `enrichment.engine`
+ENGINES = {'sqlite': enrich_with_sqlite, 'duckdb': enrich_with_duckdb}
+
+
+# ===  Latest staged event after `last_run`, or `None` if there is nothing to publish  ===
+def latest_staged(database_file, last_run):
+    if not db.table_exists(database_file=database_file, table=STAGING_TABLE):
+        return None
+    return db.connect(database_file).execute(
+        f'SELECT max({STAGING_KEY_COLUMN}) FROM {STAGING_TABLE} WHERE {STAGING_KEY_COLUMN} > ?', (last_run,)).fetchone()[0]
+
+
+# ===  Query and record count query for the staged rows after `last_run`, stamped with the current Batch ID  ===
+def staged_query(database_file, last_run):
+    connection = db.connect(database_file)
+    connection.execute(f'UPDATE {STAGING_TABLE} SET BATCH_ID = ? WHERE {STAGING_KEY_COLUMN} > ?',
+                       (int(globals.Timestamps.gmt_epoch), last_run))
+    connection.commit()
+
+    columns = [row[1] for row in connection.execute(f'PRAGMA table_info({STAGING_TABLE})') if row[1] != STAGING_KEY_COLUMN]
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    where = f'{STAGING_KEY_COLUMN} > {last_run}'
+    return (f'SELECT {column_list} FROM {STAGING_TABLE} WHERE {where} ORDER BY rowid',
+            f'SELECT count(*) FROM {STAGING_TABLE} WHERE {where}')
+
+
+# ===  Remove published rows from the staging table  ===
+def prune_staged(database_file, published_up_to):
+    connection = db.connect(database_file)
+    connection.execute(f'DELETE FROM {STAGING_TABLE} WHERE {STAGING_KEY_COLUMN} <= ?', (published_up_to,))
+    connection.commit()
+    db.bump_table_version(database_file, STAGING_TABLE)
+
+
+# ===  Start over, e.g. when the `events` table is reloaded from scratch  ===
+def reset(database_file, watermark):
+    db.drop_table(database_file=database_file, table=STAGING_TABLE)
+    db.write_state(database_file=database_file, key=WATERMARK_KEY, value=watermark)
@@ -0,0 +1,82 @@
+# ===============================================================================
+# Description:    Include/exclude filters for audit events, pushed into the search request and applied on decode
+# ===============================================================================
+
+import fnmatch
+import logging
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `eventFilters` block in `settings.json`. Empty lists do not filter.
+# Event types accept wildcards (e.g. `USR-*`). Workspace and Model filters only apply to events that carry a
+# Workspace or Model ID, so tenant-level events (e.g. logins) are kept.
+DEFAULT_SETTINGS = {
+    "includeEventTypes": [],
+    "excludeEventTypes": [],
+    "includeWorkspaces": [],
+    "excludeWorkspaces": [],
+    "includeModels": [],
+    "excludeModels": [],
+    "serverSide": False
+}
+
+# Search request fields for the include filters, sent only with `serverSide`. They are not documented for the Audit
+# API, and a server-side Workspace or Model filter may drop the tenant-level events the decode filter keeps.
+REQUEST_FIELDS = {
+    "includeEventTypes": "eventTypeIds",
+    "includeWorkspaces": "workspaceIds",
+    "includeModels": "modelIds"
+}
+
+
+# ===  Event filter settings merged with the defaults  ===
+def filter_settings(settings):
+    return {**DEFAULT_SETTINGS, **settings.get('eventFilters', {})}
+
+
+def is_active(filters):
+    return any(filters[key] for key in DEFAULT_SETTINGS if key != 'serverSide')
+
+
+# ===  Body of the `/events/search` request with the include filters the server can apply  ===
+# Event type patterns with wildcards cannot be sent and are only applied on decode.
+def request_body(filters, start):
+    body = {"from": start}
+    if filters['serverSide']:
+        for key, field in REQUEST_FIELDS.items():
+            values = filters[key]
+            if values and not any(any(character in value for character in '*?[') for value in values):
+                body[field] = values
+    return body
+
+
+def matches(value, patterns):
+    return any(fnmatch.fnmatchcase(value, pattern) for pattern in patterns)
+
+
+# ===  True if the decoded event passes the filters  ===
+def keep(event, filters):
+    event_type = event.get('eventTypeId') or ''
+    if filters['includeEventTypes'] and not matches(event_type, filters['includeEventTypes']):
+        return False
+    if filters['excludeEventTypes'] and matches(event_type, filters['excludeEventTypes']):
+        return False
+
+    attributes = event.get('additionalAttributes') or {}
+    for key, value in (('Workspaces', attributes.get('workspaceId')), ('Models', attributes.get('modelId'))):
+        if value is None:
+            continue
+        if filters[f'include{key}'] and value not in filters[f'include{key}']:
+            return False
+        if value in filters[f'exclude{key}']:
+            return False
+    return True
+
+
+# ===  Drop the events of one page that do not pass the filters, before they are normalized and stored  ===
+# The same filters are applied whether or not the server has applied them already.
+def apply(filters, events):
+    if not is_active(filters):
+        return events
+    return [event for event in events if keep(event, filters)]
@@ -0,0 +1,81 @@
+# ===============================================================================
+# Description:    Compact in-memory Data Frames for audit events and metadata (Arrow-backed strings and categoricals)
+# ===============================================================================
+
+import logging
+
+import utils
+
+# Heavy dependencies are loaded on first use
+pd = utils.lazy_import('pandas')
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Event columns with few distinct values. They are held as categoricals: one small integer code per event and each
+# distinct value once. The other text columns are held as Arrow-backed strings.
+EVENT_CATEGORIES = [
+    'eventTypeId', 'message', 'success', 'errorNumber', 'userId', 'tenantId', 'userAgent', 'hostName',
+    'serviceVersion', 'eventTimeZone', 'createdTimeZone', 'objectTypeId', 'objectTenantId',
+    'additionalAttributes.workspaceId', 'additionalAttributes.modelId', 'additionalAttributes.actionId',
+    'additionalAttributes.name', 'additionalAttributes.type', 'additionalAttributes.modelAccessLevel',
+    'additionalAttributes.modelRoleName', 'additionalAttributes.modelRoleId', 'additionalAttributes.active',
+    'additionalAttributes.nux_visible', 'additionalAttributes.roleId', 'additionalAttributes.roleName',
+    'additionalAttributes.objectTypeId', 'additionalAttributes.objectTenantId'
+]
+
+# Metadata columns repeated on every row of a Model's actions and files
+METADATA_CATEGORIES = ['workspace_id', 'model_id']
+
+# Arrow-backed string type (the pandas default `str` when `pyarrow` is installed)
+STRING_DTYPE = 'str'
+
+
+# ===  Flatten nested objects into `parent.child` keys, as `pd.json_normalize` does, without copying the record  ===
+def flatten(record, prefix=''):
+    row = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            row.update(flatten(value, prefix=f'{prefix}{key}.'))
+        else:
+            row[f'{prefix}{key}'] = value
+    return row
+
+
+# ===  Data Frame of a page of API records (same columns and values as `pd.json_normalize`) in the compact layout  ===
+def records_frame(records, categories=()):
+    return compact(pd.DataFrame([flatten(record) for record in records]), categories=categories)
+
+
+# ===  Hold text columns as Arrow-backed strings and `categories` as categoricals  ===
+# Columns holding anything but text (e.g. booleans with gaps) are left as they are, so the stored values do not change.
+def compact(df, categories=()):
+    for column in df.columns:
+        series = df[column]
+        if column in categories and not isinstance(series.dtype, pd.CategoricalDtype):
+            df[column] = series.astype('category')
+        elif series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) in ('string', 'empty'):
+            df[column] = series.astype(STRING_DTYPE)
+    return df
+
+
+# ===  Concatenate the pages of a batch without expanding the categoricals  ===
+# Each page holds its own categories, so they are first extended to the categories of all pages.
+def concat(frames, categories=()):
+    frames = [compact(frame, categories=categories) for frame in frames]
+    for column in categories:
+        dtypes = [frame[column].dtype for frame in frames if column in frame.columns]
+        if not dtypes:
+            continue
+        combined = dtypes[0].categories
+        for dtype in dtypes[1:]:
+            combined = combined.union(dtype.categories)
+        for frame in frames:
+            if column in frame.columns:
+                frame[column] = frame[column].cat.set_categories(combined)
+    return pd.concat(frames, ignore_index=True)
+
+
+# ===  Bytes held by a Data Frame, including the strings and the Arrow buffers  ===
+def frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
@@ -0,0 +1,222 @@
+# ===============================================================================
+# Description:    Dictionary-encoded storage of the audit events with an `events` compatibility view
+# ===============================================================================
+
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+
+import globals
+import utils
+import database_ops as db
+
+# Heavy dependencies are loaded on first use
+apsw = utils.lazy_import('apsw')
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `eventStore` block in `settings.json`
+DEFAULT_SETTINGS = {
+    "enabled": False
+}
+
+# The events are stored in `events_store` with the repeated strings replaced by integer keys into dimension tables.
+# `events` becomes a view with the original columns, so `audit_query.sql` and every reader keep working.
+STORE_TABLE = 'events_store'
+EVENTS_VIEW = 'events'
+INCOMING_TABLE = 'events_incoming'
+
+# Encoded column -> dimension table. Columns holding the same kind of value share a dimension.
+DIMENSIONS = {
+    'userAgent': 'dim_user_agent',
+    'hostName': 'dim_host_name',
+    'serviceVersion': 'dim_service_version',
+    'tenantId': 'dim_tenant',
+    'objectTenantId': 'dim_tenant',
+    'eventTimeZone': 'dim_time_zone',
+    'createdTimeZone': 'dim_time_zone',
+    'additionalAttributes.workspaceId': 'dim_workspace',
+    'additionalAttributes.modelId': 'dim_model'
+}
+
+
+# ===  Event store settings merged with the defaults  ===
+def store_settings(settings):
+    return {**DEFAULT_SETTINGS, **settings.get('eventStore', {})}
+
+
+# ===  True when the database uses the dictionary-encoded layout  ===
+def is_normalized(connection):
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (STORE_TABLE,)).fetchone() is not None
+
+
+# ===  Physical table holding the hot events (`events_store` or the plain `events` table)  ===
+def events_table(connection):
+    return STORE_TABLE if is_normalized(connection) else EVENTS_VIEW
+
+
+# ===  (Re)create the `events` view decoding the dimension keys, with the columns in the stored order  ===
+def create_view(connection):
+    select_list, joins = [], []
+    for position, name, *_ in connection.execute(f'PRAGMA table_info({STORE_TABLE})').fetchall():
+        if name in DIMENSIONS:
+            alias = f'd{position}'
+            select_list.append(f'{alias}.value AS {db.quote(name)}')
+            joins.append(f'LEFT JOIN {DIMENSIONS[name]} {alias} ON {alias}.id = s.{db.quote(name)}')
+        else:
+            select_list.append(f's.{db.quote(name)}')
+    connection.execute(f'DROP VIEW IF EXISTS {EVENTS_VIEW}')
+    connection.execute(f'CREATE VIEW {EVENTS_VIEW} AS SELECT {", ".join(select_list)} FROM {STORE_TABLE} s {" ".join(joins)}')
+
+
+# ===  Move the rows of `source` (same columns as `events`, with plain strings) into the store  ===
+# Runs inside the caller's transaction. New values are added to the dimensions and new columns to the store.
+def encode_rows(connection, source):
+    columns = [(row[1], row[2]) for row in connection.execute(f'PRAGMA table_info({db.quote(source)})').fetchall()]
+
+    for dimension in set(DIMENSIONS.values()):
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {dimension} (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)')
+    for name, _ in columns:
+        if name in DIMENSIONS:
+            connection.execute(f'INSERT OR IGNORE INTO {DIMENSIONS[name]} (value) '
+                               f'SELECT DISTINCT {db.quote(name)} FROM {db.quote(source)} WHERE {db.quote(name)} IS NOT NULL')
+
+    # Create the store, or add the columns the API has introduced since it was created
+    declared = [(name, 'INTEGER' if name in DIMENSIONS else column_type) for name, column_type in columns]
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {STORE_TABLE} ('
+                       + ', '.join(f'{db.quote(name)} {column_type}' for name, column_type in declared) + ')')
+    existing = {row[1] for row in connection.execute(f'PRAGMA table_info({STORE_TABLE})').fetchall()}
+    for name, column_type in declared:
+        if name not in existing:
+            connection.execute(f'ALTER TABLE {STORE_TABLE} ADD COLUMN {db.quote(name)} {column_type}')
+    connection.execute(f'CREATE INDEX IF NOT EXISTS {STORE_TABLE}_event_date ON {STORE_TABLE} (eventDate)')
+    connection.execute(f'CREATE INDEX IF NOT EXISTS {STORE_TABLE}_id ON {STORE_TABLE} (id)')
+
+    select_list = [f'(SELECT id FROM {DIMENSIONS[name]} WHERE value = i.{db.quote(name)})' if name in DIMENSIONS else f'i.{db.quote(name)}'
+                   for name, _ in columns]
+    connection.execute(f'INSERT INTO {STORE_TABLE} ({", ".join(db.quote(name) for name, _ in columns)}) '
+                       f'SELECT {", ".join(select_list)} FROM {db.quote(source)} i')
+    create_view(connection)
+
+
+# ===  Append a batch of events received from the Audit API  ===
+# Without the store (and without `normalize`) this is a plain append to the `events` table.
+def write_events(database_file, table, df, mode, add_unique_id, normalize=False):
+    connection = db.connect(database_file)
+    if not (normalize or is_normalized(connection)):
+        db.update_table(database_file=database_file, table=table, df=df, mode=mode, add_unique_id=add_unique_id)
+        return
+
+    try:
+        # An existing plain `events` table is converted first
+        if not is_normalized(connection) and db.table_exists(database_file=database_file, table=EVENTS_VIEW):
+            migrate(database_file=database_file)
+
+        connection.commit()
+        bulk_connection = db.bulk_connect(database_file)
+        with bulk_connection:
+            if mode == 'replace' and is_normalized(bulk_connection):
+                bulk_connection.execute(f'DELETE FROM {STORE_TABLE}')
+            db.bulk_write(connection=bulk_connection, table=INCOMING_TABLE, df=df, mode='replace', index=not add_unique_id)
+            encode_rows(connection=bulk_connection, source=INCOMING_TABLE)
+            bulk_connection.execute(f'DROP TABLE {INCOMING_TABLE}')
+        db.bump_table_version(database_file, table)
+
+    except (sqlite3.Error, apsw.Error) as err:
+        connection.rollback()
+        print(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+
+
+# ===  Drop the events, e.g. before a full reload. The dimensions are kept so keys stay stable.  ===
+def drop_events(database_file, table):
+    connection = db.connect(database_file)
+    if not is_normalized(connection):
+        db.drop_table(database_file=database_file, table=table)
+        return
+
+    connection.execute(f'DROP VIEW IF EXISTS {EVENTS_VIEW}')
+    connection.execute(f'DROP TABLE {STORE_TABLE}')
+    connection.commit()
+    db.bump_table_version(database_file, table)
+    print(f'Table `{table}` has been dropped')
+    logger.info(f'Table `{table}` has been dropped')
+
+
+# ===  Convert a plain `events` table to the dictionary-encoded layout in one transaction  ===
+def migrate(database_file):
+    connection = db.connect(database_file)
+    if is_normalized(connection) or not db.table_exists(database_file=database_file, table=EVENTS_VIEW):
+        return False
+
+    start = time.time()
+    connection.commit()
+    bulk_connection = db.bulk_connect(database_file)
+    with bulk_connection:
+        bulk_connection.execute(f'ALTER TABLE {EVENTS_VIEW} RENAME TO {INCOMING_TABLE}')
+        encode_rows(connection=bulk_connection, source=INCOMING_TABLE)
+        bulk_connection.execute(f'DROP TABLE {INCOMING_TABLE}')
+    db.bump_table_version(database_file, EVENTS_VIEW)
+
+    print(f'`{EVENTS_VIEW}` converted to the dictionary-encoded layout in {round(time.time() - start, 2)} seconds')
+    logger.info(f'`{EVENTS_VIEW}` converted to the dictionary-encoded layout in {round(time.time() - start, 2)} seconds')
+    return True
+
+
+# ===  Convert back to a plain `events` table  ===
+def revert(database_file):
+    connection = db.connect(database_file)
+    if not is_normalized(connection):
+        return False
+
+    connection.commit()
+    bulk_connection = db.bulk_connect(database_file)
+    with bulk_connection:
+        bulk_connection.execute(f'CREATE TABLE {INCOMING_TABLE} AS SELECT * FROM {EVENTS_VIEW}')
+        bulk_connection.execute(f'DROP VIEW {EVENTS_VIEW}')
+        bulk_connection.execute(f'DROP TABLE {STORE_TABLE}')
+        for dimension in set(DIMENSIONS.values()):
+            bulk_connection.execute(f'DROP TABLE IF EXISTS {dimension}')
+        bulk_connection.execute(f'ALTER TABLE {INCOMING_TABLE} RENAME TO {EVENTS_VIEW}')
+    db.bump_table_version(database_file, EVENTS_VIEW)
+
+    print(f'`{EVENTS_VIEW}` converted back to a plain table')
+    logger.info(f'`{EVENTS_VIEW}` converted back to a plain table')
+    return True
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(description="Convert the `events` table to or from the dictionary-encoded layout")
+    parser.add_argument('--revert', action='store_true',
+                        help='Convert back to a plain `events` table')
+    return parser.parse_args()
+
+
+# ===  Standalone migration. Reclaims the freed pages and reports the size of the database.  ===
+def main():
+    utils.initialize()
+    settings = utils.read_configuration_settings()
+    args = read_cli_arguments()
+    database_file = f'{globals.Paths.databases}/{settings["database"]}'
+
+    connection = db.connect(database_file)
+    size_before = connection.execute('PRAGMA page_count').fetchone()[0] * connection.execute('PRAGMA page_size').fetchone()[0]
+    changed = revert(database_file) if args.revert else migrate(database_file)
+    if not changed:
+        print('Nothing to convert')
+        return
+
+    db.close_connections()
+    connection = db.connect(database_file)
+    connection.execute('VACUUM')
+    size_after = connection.execute('PRAGMA page_count').fetchone()[0] * connection.execute('PRAGMA page_size').fetchone()[0]
+    print(f'Database size: {size_before / 2**20:.1f} MB -> {size_after / 2**20:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,30 +3,78 @@
 # ===============================================================================
 
 
-from dataclasses import dataclass
+import contextvars
+from dataclasses import dataclass, field
 
 @dataclass
-class Auth:
-    client_id: str
-    device_code: str
-    access_token: str
+class AuthState:
+    client_id: str = None
+    device_code: str = None
+    access_token: str = None
     refresh_token: str = "none"  # Set default to `none`
-    token_ttl: int = 2000 # Set default to 2000 seconds (33 minutes)
+    token_ttl: int = 2000 # Set default to 2000 seconds (33 minutes). Only used when the token expiry is unknown
+    token_provider: object = None # Set by `main` to a `token_provider.TokenProvider`
 
 
 @dataclass
-class Paths:
-    scripts: str
-    databases: str
-    logs: str
+class PathsState:
+    scripts: str = None # Set by `utils.initialize`
+    databases: str = None
+    logs: str = None
+    settings: str = None # `settings.json` of the current tenant
 
 
 @dataclass
-class Timestamps:
-    gmt_epoch: str
-    local_time_stamp: str
+class TimestampsState:
+    gmt_epoch: str = None
+    local_time_stamp: str = None
 
 
 @dataclass
-class Counts:
+class CountsState:
     audit_records: int = 0 # Set default ot 0 records
+    events_received: int = 0 # Audit events received by the last fetch
+
+
+# ===  State of one tenant. A single-tenant run only ever uses the default state  ===
+@dataclass
+class TenantState:
+    name: str = "default"
+    auth: AuthState = field(default_factory=AuthState)
+    paths: PathsState = field(default_factory=PathsState)
+    timestamps: TimestampsState = field(default_factory=TimestampsState)
+    counts: CountsState = field(default_factory=CountsState)
+
+
+default_state = TenantState()
+current_state = contextvars.ContextVar('tenant_state', default=default_state)
+
+
+# ===  Forward attribute access to the state of the tenant running in the current context  ===
+class StateProxy:
+    def __init__(self, attribute):
+        object.__setattr__(self, 'attribute', attribute)
+
+    def __getattr__(self, name):
+        return getattr(getattr(current_state.get(), self.attribute), name)
+
+    def __setattr__(self, name, value):
+        setattr(getattr(current_state.get(), self.attribute), name, value)
+
+
+# ===  Start a new tenant state in the current context. Paths default to the ones set by `utils.initialize`  ===
+def activate_tenant(name, settings_file, databases):
+    state = TenantState(name=name)
+    state.paths.scripts = default_state.paths.scripts
+    state.paths.logs = default_state.paths.logs
+    state.paths.databases = databases
+    state.paths.settings = settings_file
+    current_state.set(state)
+    return state
+
+
+# Used throughout as `globals.Auth.access_token` etc.
+Auth = StateProxy('auth')
+Paths = StateProxy('paths')
+Timestamps = StateProxy('timestamps')
+Counts = StateProxy('counts')
@@ -0,0 +1,55 @@
+# ===============================================================================
+# Description:    Shared HTTP session so TCP/TLS connections are pooled and reused
+# ===============================================================================
+
+import threading
+
+import rate_governor
+
+# Number of pooled connections kept per host
+POOL_SIZE = 16
+
+session = None
+session_lock = threading.Lock()
+
+
+# ===  Get (or create) the shared session  ===
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            # Imported here so `requests` is only loaded once the first HTTP call is made
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = governed_adapter(HTTPAdapter)(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+
+# ===  Adapter that takes a token from the rate governor before each request is sent  ===
+# Every call through the shared session (and every redirect it follows) is governed. A `429` pauses the host and the
+# request is sent again once the pause is over.
+def governed_adapter(base):
+    class adapter(base):
+        def send(self, request, **kwargs):
+            for attempt in range(rate_governor.config['maxRetries'] + 1):
+                rate_governor.acquire(request.url)
+                res = super().send(request, **kwargs)
+                if res.status_code != 429 or attempt == rate_governor.config['maxRetries'] or not rate_governor.config['enabled']:
+                    return res
+                rate_governor.throttle(request.url, retry_after=res.headers.get('Retry-After'))
+                res.close()
+            return res
+
+    return adapter
+
+
+# ===  Close all pooled connections  ===
+def close_session():
+    global session
+    with session_lock:
+        if session is not None:
+            session.close()
+            session = None
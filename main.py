@@ -3,40 +3,79 @@
 # ===============================================================================
 
 import sys
-import logging
-import datetime
-import pytz
 import time
+import logging
 
 
 import utils
 import anaplan_oauth
 import anaplan_auth_api
+import token_provider
+import token_cache
 import globals
 import anaplan_ops
+import daemon
+import tail
+import multi_tenant
+import profiling
+import rate_governor
 
 # TODO - Add Model History
-# TODO - Add option not to load to Anaplan
 # TODO - Add ability to execute export actions of users in a particular model to get visiting users
 
 
 def main():
+    # Set paths and start the logger
+    utils.initialize()
+
     # Clear the console
     utils.clear_console()
 
-    # Enable logging
-    logger = logging.getLogger(__name__)
+    # Get configurations from the CLI
+    args = utils.read_cli_arguments()
+
+    # Refresh several tenants, each with its own `settings.json`
+    if args.tenants:
+        sys.exit(multi_tenant.run(args=args))
 
     # Get configurations from `settings.json` file
     settings = utils.read_configuration_settings()
 
+    # Limit the request rate to each Anaplan host
+    rate_governor.configure(settings=settings)
+
     # Get and set current time stamp
-    ts = datetime.datetime.now(pytz.timezone("US/Eastern"))
-    globals.Timestamps.local_time_stamp = ts.strftime("%d-%m-%Y %H:%M:%S %Z")
-    globals.Timestamps.gmt_epoch = str(int(time.time()))
+    utils.set_time_stamps()
 
-    # Get configurations from the CLI
-    args = utils.read_cli_arguments()
+    # Profile each phase of this run
+    if args.profile is not None:
+        profiling.start(directory=args.profile or f'{globals.Paths.logs}/profiles/{time.strftime("%Y%m%d-%H%M%S")}')
+
+    # Events streamed by `--tail` to standard output are the only output there; messages go to standard error
+    if args.tail and (args.sink or tail.tail_settings(settings)['sink']) == 'stdout':
+        sys.stdout = sys.stderr
+
+    # Authenticate and start the token provider
+    if args.daemon or args.tail or anaplan_ops.requires_authentication(args.stages):
+        authenticate(settings=settings, args=args)
+
+    # Invoke functional Anaplan operations, either once (all or only the given stages) or continuously as a daemon,
+    # or stream new events to a local sink
+    if args.daemon:
+        daemon.run(settings=settings, interval=args.interval)
+    elif args.tail:
+        tail.run(settings=settings, interval=args.interval, sink=args.sink)
+    else:
+        anaplan_ops.run_stages(settings=settings, stages=args.stages)
+
+    # Exit with return code 0
+    sys.exit(0)
+
+
+# ===  Authenticate with Anaplan and start the token provider  ===
+def authenticate(settings, args):
+    # Enable logging
+    logger = logging.getLogger(__name__)
     register = args.register
 
     # Set SQLite database for token database
@@ -47,7 +86,7 @@ def main():
         print("Authorization via OAuth API")
         # Set OAuth Client ID and if the TTL is provided via the CLI, then override the default in the `dataclass`
         globals.Auth.client_id = args.client_id
-        if args.token_ttl == "":
+        if args.token_ttl:
             globals.Auth.token_ttl = int(args.token_ttl)
 
         # If register flag is set, then request the user to authenticate with Anaplan to create device code
@@ -58,60 +97,111 @@ def main():
                 uri=f'{settings["uris"]["oauthService"]}/device/code')
             anaplan_oauth.get_tokens(
                 uri=f'{settings["uris"]["oauthService"]}/token', database=token_db)
+            access_token, expires_at = globals.Auth.access_token, None
 
         else:
             print('Skipping device registration and refreshing the access_token')
             logger.info(
                 'Skipping device registration and refreshing the access_token')
-            anaplan_oauth.refresh_tokens(
+            access_token, expires_at = anaplan_oauth.refresh_tokens(
                 uri=f'{settings["uris"]["oauthService"]}/token',
                 database=token_db,
-                delay=0,
                 rotatable_token=settings['rotatableToken'])
 
-        # Start background thread to refresh the `access_token`
-        refresh_token = anaplan_oauth.refresh_token_thread(
-            thread_id=1,
-            name="Refresh Token",
-            delay=globals.Auth.token_ttl,
-            uri=f'{settings["uris"]["oauthService"]}/token', database=token_db,
-            rotatable_token=settings['rotatableToken']
-        )
-        refresh_token.start()
+        # Token provider that refreshes the `access_token` before it expires
+        provider = token_provider.TokenProvider(
+            refresh_function=lambda current_token: anaplan_oauth.refresh_tokens(
+                uri=f'{settings["uris"]["oauthService"]}/token',
+                database=token_db,
+                rotatable_token=settings['rotatableToken'],
+                exit_on_error=False),
+            token_ttl=globals.Auth.token_ttl)
     else:   									# User Basic or Cert Auth
         # Set authentication base URI
         auth_uri = f'{settings["uris"]["authenticationApi"]}/authenticate'
+        refresh_uri = f'{settings["uris"]["authenticationApi"]}/refresh'
 
-        if settings["authenticationMode"] == "basic":
-            print("Using Basic Authentication")
-            # Set variables
-            anaplan_auth_api.basic_authentication(
-                uri=auth_uri, username=args.user, password=args.password)
-        elif settings["authenticationMode"] == "cert_auth":
-            print("Using Certificate Authentication")
-            anaplan_auth_api.cert_authentication(
-                uri=auth_uri, public_cert_path=settings["publicCertPath"], private_key_path=settings["privateKeyPath"])
+        # Encrypted cache of the `access_token` so frequent runs can skip the authentication (`"cacheTokens": false` disables it)
+        cache = get_token_cache(settings=settings, args=args, auth_uri=auth_uri) if settings.get('cacheTokens', True) else None
+        cached = cache.load() if cache is not None else None
+
+        if cached is not None:
+            access_token, expires_at = reuse_cached_token(cached=cached, refresh_uri=refresh_uri, cache=cache)
         else:
-            print("Please update the `settings.json` file with an authentication mode of `basic`, `cert_aut`, or `OAuth`")
-            logging.error(
-                "Please update the `settings.json` file with an authentication mode of `basic`, `cert_aut`, or `OAuth`")
-            sys.exit(1)
-
-        # Start background thread to refresh the `access_token`
-        refresh_token = anaplan_auth_api.refresh_token_thread(
-            thread_id=1,
-            name="Refresh Token",
-            delay=globals.Auth.token_ttl,
-            uri=f'{settings["uris"]["authenticationApi"]}/refresh'
-        )
-        refresh_token.start()
-
-    # Invoke functional Anaplan operations
-    anaplan_ops.refresh_events(settings=settings)
+            access_token, expires_at = None, None
+
+        if access_token is None:
+            if settings["authenticationMode"] == "basic":
+                print("Using Basic Authentication")
+                # Set variables
+                token_info = anaplan_auth_api.basic_authentication(
+                    uri=auth_uri, username=args.user, password=args.password)
+            elif settings["authenticationMode"] == "cert_auth":
+                print("Using Certificate Authentication")
+                token_info = anaplan_auth_api.cert_authentication(
+                    uri=auth_uri, public_cert_path=settings["publicCertPath"], private_key_path=settings["privateKeyPath"])
+            else:
+                print("Please update the `settings.json` file with an authentication mode of `basic`, `cert_aut`, or `OAuth`")
+                logging.error(
+                    "Please update the `settings.json` file with an authentication mode of `basic`, `cert_aut`, or `OAuth`")
+                sys.exit(1)
+
+            access_token = token_info['tokenValue']
+            expires_at = token_info['expiresAt'] / 1000 if token_info.get('expiresAt') else None
+            if cache is not None:
+                cache.store(access_token, expires_at or time.time() + globals.Auth.token_ttl)
+
+        # Token provider that refreshes the `access_token` before it expires and keeps the cache up to date
+        provider = token_provider.TokenProvider(
+            refresh_function=lambda current_token: anaplan_auth_api.refresh_tokens(
+                uri=refresh_uri, access_token=current_token),
+            token_ttl=globals.Auth.token_ttl,
+            on_refresh=cache.store if cache is not None else None)
+
+    # Start background thread to refresh the `access_token`
+    provider.set_token(access_token, expires_at)
+    globals.Auth.token_provider = provider
+    provider.start()
+
+    return provider
+
+
+# ===  Token cache for Basic or Cert Auth. Returns `None` if the mode is not cached or the key material is missing  ===
+def get_token_cache(settings, args, auth_uri):
+    token_cache_db = f'{globals.Paths.databases}/token_cache.db3'
+    try:
+        if settings["authenticationMode"] == "basic" and args.user and args.password:
+            return token_cache.basic_cache(database=token_cache_db, uri=auth_uri, username=args.user, password=args.password)
+        elif settings["authenticationMode"] == "cert_auth":
+            return token_cache.cert_cache(database=token_cache_db, uri=auth_uri, public_cert_path=settings["publicCertPath"],
+                                          private_key_path=settings["privateKeyPath"])
+    except OSError:
+        # Reported by the Cert Auth login
+        pass
+    return None
 
-    # Exit with return code 0
-    sys.exit(0)
 
+# ===  Reuse a cached token as is, or refresh it through `/refresh` when it is close to expiry  ===
+# Returns (`access_token`, `expires_at`), or (`None`, `None`) when a full authentication is required
+def reuse_cached_token(cached, refresh_uri, cache):
+    logger = logging.getLogger(__name__)
+    access_token, issued_at, expires_at = cached
+    lifetime = max(expires_at - issued_at, 1)
+
+    # Still inside the window before the token provider would refresh it
+    if time.time() < issued_at + lifetime * 0.8:
+        print("Reusing the cached Access Token")
+        logger.info("Reusing the cached Access Token")
+        return access_token, expires_at
+
+    try:
+        access_token, expires_at = anaplan_auth_api.refresh_tokens(uri=refresh_uri, access_token=access_token)
+        cache.store(access_token, expires_at or time.time() + globals.Auth.token_ttl)
+        return access_token, expires_at
+    except Exception as err:
+        logger.warning(f'Unable to refresh the cached Access Token: {err}')
+        cache.clear()
+        return None, None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,223 @@
+# ===============================================================================
+# Description:    Targeted metadata crawl driven by the IDs in the new audit events, with a cache of deleted objects
+# ===============================================================================
+
+import sys
+import time
+import logging
+import sqlite3
+
+import anaplan_ops
+import user_sync
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `metadataCrawl` block in `settings.json`. With `"mode": "targeted"` only the metadata the
+# new events refer to is crawled, and a full crawl still runs every `fullCrawlHours` to pick up renamed objects.
+DEFAULT_SETTINGS = {
+    "mode": "full",
+    "fullCrawlHours": 24,
+    "deletedCacheDays": 30
+}
+
+MODES = ['full', 'targeted']
+
+# `pipeline_state` keys holding the latest `eventDate` (epoch milliseconds) whose IDs have been resolved and the time
+# (epoch milliseconds) of the last full crawl
+WATERMARK_KEY = 'metadata_watermark'
+FULL_CRAWL_KEY = 'metadata_full_crawl'
+
+# Objects referenced by events but confirmed missing from the authoritative Anaplan listing. They are not looked up
+# again until the entry expires.
+DELETED_TABLE = 'metadata_deleted'
+
+# Tables the targeted crawl updates in place (and the activity codes loaded by the full crawl). Without any of them a
+# full crawl runs instead.
+CRAWLED_TABLES = ['activityCodesData', 'usersData', 'workspacesData', 'modelsData', 'actionsData', 'filesData', 'cloudWorksData']
+
+
+# ===  Metadata crawl settings merged with the defaults  ===
+def crawl_settings(settings):
+    return {**DEFAULT_SETTINGS, **settings.get('metadataCrawl', {})}
+
+
+# ===  True when the next crawl has to be a full one  ===
+def full_crawl_due(settings, database_file, targetModelObjects):
+    config = crawl_settings(settings)
+    if config['mode'] not in MODES:
+        raise ValueError(f'Unknown metadata crawl mode "{config["mode"]}". Use one of {", ".join(MODES)}')
+    if config['mode'] == 'full':
+        return True
+
+    if not targeted_ready(database_file=database_file, targetModelObjects=targetModelObjects):
+        return True
+    last_full_crawl = db.read_state(database_file=database_file, key=FULL_CRAWL_KEY, default=0)
+    return time.time() * 1000 - last_full_crawl >= config['fullCrawlHours'] * 3600 * 1000
+
+
+# ===  True once a full crawl has stored every crawled table, so only the new events need to be resolved  ===
+def targeted_ready(database_file, targetModelObjects):
+    if not all(db.table_exists(database_file=database_file, table=targetModelObjects[key]['table']) for key in CRAWLED_TABLES):
+        return False
+    return db.read_state(database_file=database_file, key=WATERMARK_KEY) is not None
+
+
+# ===  After a full crawl every ingested event is resolved  ===
+def record_full_crawl(database_file, events_table):
+    up_to = latest_event(database_file=database_file, events_table=events_table)
+    db.write_state(database_file=database_file, key=WATERMARK_KEY, value=up_to or 0)
+    db.write_state(database_file=database_file, key=FULL_CRAWL_KEY, value=int(time.time() * 1000))
+
+
+# ===  Latest `eventDate` of the events table, or of the `events` view over the event store  ===
+def latest_event(database_file, events_table):
+    connection = db.connect(database_file)
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (events_table,)).fetchone() is None:
+        return None
+    return connection.execute(f'SELECT max(eventDate) FROM {db.quote(events_table)}').fetchone()[0]
+
+
+# ===  Create the deleted object cache and drop the expired entries  ===
+def prepare_deleted_cache(settings, database_file):
+    connection = db.connect(database_file)
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {DELETED_TABLE} (object_type TEXT NOT NULL, object_id TEXT NOT NULL, '
+                       f'scope TEXT NOT NULL DEFAULT "", confirmed INTEGER, PRIMARY KEY (object_type, object_id, scope))')
+    expiry = int(time.time()) - crawl_settings(settings)['deletedCacheDays'] * 86400
+    connection.execute(f'DELETE FROM {DELETED_TABLE} WHERE confirmed < ?', (expiry,))
+    connection.commit()
+
+
+def cache_deleted(database_file, object_type, keys):
+    connection = db.connect(database_file)
+    connection.executemany(f'INSERT OR REPLACE INTO {DELETED_TABLE} (object_type, object_id, scope, confirmed) '
+                           f"VALUES ('{object_type}', ?, ?, strftime('%s','now'))", keys)
+    connection.commit()
+    if keys:
+        print(f'{len(keys)} deleted {object_type}(s) cached and no longer looked up')
+        logger.info(f'{len(keys)} deleted {object_type}(s) cached and no longer looked up')
+
+
+# ===  IDs (and their scope) referenced by the new events that are neither in `table` nor cached as deleted  ===
+def unresolved(connection, events_table, watermark, up_to, object_type, id_column, scope_column, table, match):
+    return connection.execute(
+        f'SELECT DISTINCT {id_column}, {scope_column} FROM {db.quote(events_table)} e '
+        f'WHERE e.eventDate > ? AND e.eventDate <= ? AND {id_column} IS NOT NULL '
+        f'AND NOT EXISTS (SELECT 1 FROM {db.quote(table)} t WHERE {match}) '
+        f'AND NOT EXISTS (SELECT 1 FROM {DELETED_TABLE} d WHERE d.object_type = ? AND d.object_id = {id_column} '
+        f'AND d.scope = {scope_column})',
+        (watermark, up_to, object_type)).fetchall()
+
+
+# ===  Crawl only the metadata referenced by the events ingested since the last crawl  ===
+# Tenant-level listings (users, workspaces, CloudWorks) are only fetched when a new event refers to an ID they do not
+# hold. The Models of the Workspaces and the actions and files of the Models with new activity are crawled again.
+# An ID still missing after its authoritative listing was fetched is cached as deleted.
+def targeted_sync(settings, database_file, uris, targetModelObjects):
+    tables = {key: value['table'] for key, value in targetModelObjects.items()}
+    events_table = tables['auditData']
+    watermark = db.read_state(database_file=database_file, key=WATERMARK_KEY, default=0)
+    connection = db.connect(database_file)
+
+    try:
+        up_to = latest_event(database_file=database_file, events_table=events_table)
+        if up_to is None or up_to <= watermark:
+            print('No new audit events and the metadata is up to date')
+            logger.info('No new audit events and the metadata is up to date')
+            return
+
+        prepare_deleted_cache(settings=settings, database_file=database_file)
+        start = time.time()
+        listed = set()
+
+        def find(object_type, id_column, scope_column, table, match):
+            return unresolved(connection=connection, events_table=events_table, watermark=watermark, up_to=up_to,
+                              object_type=object_type, id_column=id_column, scope_column=scope_column, table=table, match=match)
+
+        def list_again(name, function, **kwargs):
+            function(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects, **kwargs)
+            listed.add(name)
+
+        # Users acting in the new events. An incremental user sync upserts the modified users and looks up the unknown
+        # IDs on every crawl, otherwise all users are listed again when an ID is unknown.
+        users = ('user', 'e.userId', "''", tables['usersData'], 't.id = e.userId')
+        if user_sync.incremental(settings):
+            list_again('users', user_sync.sync_users, settings=settings)
+        elif find(*users):
+            list_again('users', anaplan_ops.get_users)
+            cache_deleted(database_file=database_file, object_type='user', keys=find(*users))
+
+        # Workspaces
+        workspaces = ('workspace', 'e."additionalAttributes.workspaceId"', "''", tables['workspacesData'],
+                      't.id = e."additionalAttributes.workspaceId"')
+        if find(*workspaces):
+            list_again('workspaces', anaplan_ops.get_workspaces)
+            cache_deleted(database_file=database_file, object_type='workspace', keys=find(*workspaces))
+
+        # Models, listed again for each existing Workspace with activity in a Model not cached as deleted. Listing them
+        # refreshes the names and the archived state, and the actions of a deleted Model are never requested.
+        active_workspaces = [row[0] for row in connection.execute(
+            f'SELECT DISTINCT e."additionalAttributes.workspaceId" FROM {db.quote(events_table)} e '
+            f'JOIN {db.quote(tables["workspacesData"])} w ON w.id = e."additionalAttributes.workspaceId" '
+            f'WHERE e.eventDate > ? AND e.eventDate <= ? AND e."additionalAttributes.modelId" IS NOT NULL '
+            f"AND e.\"additionalAttributes.modelId\" NOT IN (SELECT object_id FROM {DELETED_TABLE} WHERE object_type = 'model') "
+            f'ORDER BY 1', (watermark, up_to))]
+        for ws_id in active_workspaces:
+            connection.execute(f'DELETE FROM {db.quote(tables["modelsData"])} WHERE currentWorkspaceId = ?', (ws_id,))
+            connection.commit()
+            list_again(ws_id, anaplan_ops.get_models, ws_id=ws_id)
+
+        # A Model missing from the listing of its Workspace, or whose Workspace has been deleted, has been deleted
+        models = ('model', 'e."additionalAttributes.modelId"', 'coalesce(e."additionalAttributes.workspaceId", \'\')',
+                  tables['modelsData'], 't.id = e."additionalAttributes.modelId"')
+        cache_deleted(database_file=database_file, object_type='model', keys=[key for key in find(*models) if key[1]])
+
+        # Actions and files of the existing, unarchived Models with new activity
+        active_models = connection.execute(
+            f'SELECT DISTINCT m.currentWorkspaceId, m.id FROM {db.quote(events_table)} e '
+            f'JOIN {db.quote(tables["modelsData"])} m ON m.id = e."additionalAttributes.modelId" '
+            f"WHERE e.eventDate > ? AND e.eventDate <= ? AND m.activeState != 'ARCHIVED'", (watermark, up_to)).fetchall()
+        crawled = set()
+        for ws_id, mod_id in active_models:
+            if anaplan_ops.skip_model(settings=settings, ws_id=ws_id, mod_id=mod_id):
+                continue
+            for key in ('actionsData', 'filesData'):
+                connection.execute(f'DELETE FROM {db.quote(tables[key])} WHERE model_id = ?', (mod_id,))
+            connection.commit()
+            anaplan_ops.get_model_objects(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects,
+                                          ws_id=ws_id, mod_id=mod_id)
+            crawled.add(mod_id)
+
+        # Action IDs still missing from a freshly crawled Model have been deleted (`-1` is an unsaved action)
+        actions = ('action', 'e."additionalAttributes.actionId"', 'e.objectId', tables['actionsData'],
+                   't.id = e."additionalAttributes.actionId" AND t.model_id = e.objectId')
+        cache_deleted(database_file=database_file, object_type='action',
+                      keys=[key for key in find(*actions) if key[1] in crawled and key[0] != '-1'])
+
+        # Objects of the new events that are neither a known user, Model nor CloudWorks integration
+        objects = ('object', 'e.objectId', "''", tables['cloudWorksData'],
+                   f't.integrationId = e.objectId OR e.objectId IN (SELECT id FROM {db.quote(tables["usersData"])}) '
+                   f'OR e.objectId IN (SELECT id FROM {db.quote(tables["modelsData"])}) '
+                   f"OR e.objectId IN (SELECT object_id FROM {DELETED_TABLE} WHERE object_type IN ('user', 'model'))")
+        if find(*objects):
+            list_again('cloudworks', anaplan_ops.get_cloudworks)
+            if 'users' not in listed:
+                list_again('users', anaplan_ops.get_users)
+            cache_deleted(database_file=database_file, object_type='object', keys=find(*objects))
+
+        db.write_state(database_file=database_file, key=WATERMARK_KEY, value=up_to)
+
+        seconds = round(time.time() - start, 2)
+        print(f'Targeted metadata crawl: {len(listed)} listing(s) and {len(crawled)} of {len(active_models)} '
+              f'active Model(s) in {seconds} seconds')
+        logger.info(f'Targeted metadata crawl: {len(listed)} listing(s) and {len(crawled)} of {len(active_models)} '
+                    f'active Model(s) in {seconds} seconds',
+                    extra={'crawl': {'listings': len(listed), 'models': len(crawled), 'activeModels': len(active_models),
+                                     'seconds': seconds, 'watermark': up_to}})
+
+    except sqlite3.Error as err:
+        connection.rollback()
+        print(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
@@ -0,0 +1,125 @@
+# ===============================================================================
+# Description:    In-memory name <-> ID index over the Anaplan metadata tables
+# ===============================================================================
+
+import logging
+import sqlite3
+import threading
+
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Tables backing the index
+INDEXED_TABLES = ('workspaces', 'models', 'actions', 'files')
+
+# One index per database file
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+# ===  Get (or create) the index for a database file  ===
+def get_index(database_file):
+    with indexes_lock:
+        if database_file not in indexes:
+            indexes[database_file] = MetadataIndex(database_file)
+        return indexes[database_file]
+
+
+# ===  Name <-> ID hash maps, loaded once and reloaded only when a backing table changes  ===
+class MetadataIndex:
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self.lock = threading.Lock()
+        self.versions = None
+        self.workspace_ids, self.workspace_names = {}, {}
+        self.model_ids, self.model_names = {}, {}
+        self.action_ids, self.action_names = {}, {}
+        self.file_ids = {}
+
+    # Snapshot of the table versions maintained by `database_ops`
+    def current_versions(self):
+        return tuple(db.table_version(self.database_file, table) for table in INDEXED_TABLES)
+
+    # Reload the hash maps if any of the backing tables changed since the last load
+    def refresh(self, force=False):
+        with self.lock:
+            versions = self.current_versions()
+            if not force and versions == self.versions:
+                return
+            self.load()
+            self.versions = versions
+
+    # Drop the loaded maps so the next lookup reloads (e.g. after another process updated the database)
+    def invalidate(self):
+        with self.lock:
+            self.versions = None
+
+    def load(self):
+        workspace_ids, workspace_names = {}, {}
+        model_ids, model_names = {}, {}
+        action_ids, action_names = {}, {}
+        file_ids = {}
+
+        connection = db.connect(self.database_file)
+
+        # The first row wins, matching the previous `fetchone()` lookups
+        for id, name in self.rows(connection, 'SELECT id, name FROM workspaces'):
+            workspace_ids.setdefault(name, id)
+            workspace_names.setdefault(id, name)
+        for id, name, ws_id in self.rows(connection, 'SELECT id, name, currentWorkspaceId FROM models'):
+            model_ids.setdefault((ws_id, name), id)
+            model_names.setdefault(id, name)
+        for id, name, ws_id, mod_id in self.rows(connection, 'SELECT id, name, workspace_id, model_id FROM actions'):
+            action_ids.setdefault((ws_id, mod_id, name), id)
+            action_names.setdefault((ws_id, mod_id, id), name)
+        for id, name, ws_id, mod_id in self.rows(connection, 'SELECT id, name, workspace_id, model_id FROM files'):
+            file_ids.setdefault((ws_id, mod_id, name), id)
+
+        # Swap in the new maps in one step so concurrent readers never see a partial load
+        self.workspace_ids, self.workspace_names = workspace_ids, workspace_names
+        self.model_ids, self.model_names = model_ids, model_names
+        self.action_ids, self.action_names = action_ids, action_names
+        self.file_ids = file_ids
+
+        logger.info(f'Metadata index loaded: {len(workspace_ids)} workspaces, {len(model_names)} models, '
+                    f'{len(action_names)} actions, {len(file_ids)} files')
+
+    # Tables may not exist yet (e.g. before the first metadata sync)
+    @staticmethod
+    def rows(connection, sql):
+        try:
+            return connection.execute(sql).fetchall()
+        except sqlite3.Error as err:
+            logger.warning(f'Unable to index metadata: {err}')
+            return []
+
+    # === Lookups. Each returns `None` when the object is not found ===
+    def workspace_id(self, name):
+        self.refresh()
+        return self.workspace_ids.get(name)
+
+    def workspace_name(self, workspace_id):
+        self.refresh()
+        return self.workspace_names.get(workspace_id)
+
+    def model_id(self, workspace_id, name):
+        self.refresh()
+        return self.model_ids.get((workspace_id, name))
+
+    def model_name(self, model_id):
+        self.refresh()
+        return self.model_names.get(model_id)
+
+    def action_id(self, workspace_id, model_id, name):
+        self.refresh()
+        return self.action_ids.get((workspace_id, model_id, name))
+
+    def action_name(self, workspace_id, model_id, action_id):
+        self.refresh()
+        return self.action_names.get((workspace_id, model_id, action_id))
+
+    def file_id(self, workspace_id, model_id, name):
+        self.refresh()
+        return self.file_ids.get((workspace_id, model_id, name))
@@ -0,0 +1,124 @@
+# ===============================================================================
+# Description:    Run the audit refresh for several tenants concurrently from one process
+# ===============================================================================
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import globals
+import anaplan_ops
+import http_session
+import rate_governor
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Default number of tenants refreshed at the same time
+DEFAULT_MAX_WORKERS = 4
+
+
+# ===  Prefix log records with the tenant that wrote them  ===
+class tenant_filter(logging.Filter):
+    def filter(self, record):
+        state = globals.current_state.get()
+        if state is not globals.default_state:
+            record.msg = f'[{state.name}] {record.msg}'
+            record.tenant = state.name
+        return True
+
+
+# ===  Read the tenants file  ===
+# {"maxWorkers": 4, "rateLimits": {...}, "tenants": [{"name": "...", "settings": "tenants/acme/settings.json", "user": "...", ...}]}
+# `settings` is relative to the tenants file. The SQLite databases of a tenant are kept next to its `settings.json`.
+# `user`, `password`, `clientId` and `tokenTtl` are optional and default to the CLI arguments.
+def read_tenants(tenants_file):
+    try:
+        with open(tenants_file, 'r') as file:
+            config = json.load(file)
+        base_path = os.path.dirname(os.path.abspath(tenants_file))
+        for tenant in config['tenants']:
+            tenant['settings'] = os.path.join(base_path, tenant['settings'])
+            tenant.setdefault('name', os.path.basename(os.path.dirname(tenant['settings'])))
+        return config
+
+    except Exception as err:
+        print(f'Unable to read the tenants file `{tenants_file}`: {err} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'Unable to read the tenants file `{tenants_file}`: {err} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+
+
+# ===  Refresh one tenant. Runs in its own context so `globals` resolve to this tenant's state  ===
+def run_tenant(tenant, args):
+    # Imported here as `main` imports this module
+    import main
+    import utils
+
+    start = time.time()
+    globals.activate_tenant(name=tenant['name'], settings_file=tenant['settings'],
+                            databases=os.path.dirname(tenant['settings']))
+    try:
+        settings = utils.read_configuration_settings()
+        utils.set_time_stamps()
+        tenant_args = argparse.Namespace(**{**vars(args),
+                                            'user': tenant.get('user', args.user),
+                                            'password': tenant.get('password', args.password),
+                                            'client_id': tenant.get('clientId', args.client_id),
+                                            'token_ttl': tenant.get('tokenTtl', args.token_ttl)})
+        if anaplan_ops.requires_authentication(args.stages):
+            main.authenticate(settings=settings, args=tenant_args)
+        anaplan_ops.run_stages(settings=settings, stages=args.stages)
+        status = 'succeeded'
+
+    # The pipeline exits on errors. Contain it to the failing tenant.
+    except (Exception, SystemExit) as err:
+        status = f'failed ({type(err).__name__}: {err})'
+
+    finally:
+        if globals.Auth.token_provider is not None:
+            globals.Auth.token_provider.stop()
+        db.close_connections()
+
+    seconds = round(time.time() - start, 1)
+    print(f'Tenant {status} in {seconds} seconds')
+    logger.info(f'Tenant {status} in {seconds} seconds')
+    return tenant['name'], status, seconds
+
+
+# ===  Refresh all tenants with a shared worker budget and HTTP connection pool. Returns the exit code  ===
+def run(args):
+    config = read_tenants(args.tenants)
+    max_workers = args.workers or config.get('maxWorkers', DEFAULT_MAX_WORKERS)
+
+    # All tenants share one session, so size its pool for the concurrent tenants
+    http_session.POOL_SIZE = max(http_session.POOL_SIZE, max_workers)
+
+    # The request rate to each host is limited across all tenants by the `rateLimits` block of the tenants file
+    rate_governor.configure(settings=config)
+
+    tenant_log_filter = tenant_filter()
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(tenant_log_filter)
+
+    print(f'Refreshing {len(config["tenants"])} tenants with {max_workers} workers')
+    logger.info(f'Refreshing {len(config["tenants"])} tenants with {max_workers} workers')
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='Tenant') as executor:
+        # Each tenant runs in a fresh copy of the context so its state does not leak into the next tenant on the thread
+        futures = [executor.submit(contextvars.copy_context().run, run_tenant, tenant, args)
+                   for tenant in config['tenants']]
+        results = [future.result() for future in futures]
+
+    print(f'\nAll tenants finished in {round(time.time() - start, 1)} seconds')
+    for name, status, seconds in results:
+        print(f'  {name}: {status} in {seconds} seconds')
+        logger.info(f'{name}: {status} in {seconds} seconds')
+
+    return 0 if all(status == 'succeeded' for _, status, _ in results) else 1
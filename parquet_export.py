@@ -0,0 +1,125 @@
+# ===============================================================================
+# Description:    Export the enriched audit history to Parquet files partitioned by event date
+# ===============================================================================
+
+import os
+import sys
+import logging
+import sqlite3
+
+import globals
+import utils
+import anaplan_ops
+import partitions
+import database_ops as db
+
+# Loaded on first use
+pa = utils.lazy_import('pyarrow')
+pc = utils.lazy_import('pyarrow.compute')
+ds = utils.lazy_import('pyarrow.dataset')
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `parquetExport` block in `settings.json`
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "path": "parquet",
+    "compression": "zstd",
+    "compressionLevel": 9,
+    "batchSize": 100000
+}
+
+# `pipeline_state` key holding the latest `eventDate` (epoch milliseconds) already exported
+WATERMARK_KEY = 'parquet_watermark'
+
+
+# ===  Export settings merged with the defaults  ===
+def export_settings(settings):
+    return {**DEFAULT_SETTINGS, **settings.get('parquetExport', {})}
+
+
+# ===  Append the events received since the last export  ===
+# Each run adds new files to the `EVENT_DAY=YYYY-MM-DD` partitions it touches and never rewrites existing files.
+# The watermark only advances once all files are written, so a failed export is retried in full on the next run.
+def export_events(settings, database_file):
+    export = export_settings(settings)
+    output_path = os.path.join(globals.Paths.databases, export['path'])
+    watermark = db.read_state(database_file=database_file, key=WATERMARK_KEY, default=0)
+
+    try:
+        connection = db.connect(database_file)
+
+        # Read the hot table and the archived months (e.g. for a backfill) through the `events_all` view
+        source = partitions.EVENTS_VIEW if partitions.attach_archives(connection, database_file) else partitions.EVENTS_TABLE
+
+        # Fix the upper bound first so events ingested during the export are picked up by the next run
+        up_to = connection.execute(f'SELECT max(eventDate) FROM {source} WHERE eventDate > ?', (watermark,)).fetchone()[0]
+        if up_to is None:
+            print('No new audit events to export to Parquet')
+            logger.info('No new audit events to export to Parquet')
+            return 0
+
+        # `build_audit_query` adds 1 millisecond to `last_run`
+        sql, _ = anaplan_ops.build_audit_query(tenant_name=settings['anaplanTenantName'], last_run=watermark - 1, up_to=up_to,
+                                           source=source)
+        cursor = connection.execute(sql)
+        columns = [desc[0] for desc in cursor.description]
+
+        # Unique file names per run so appends never overwrite earlier files in the same partition
+        file_format = ds.ParquetFileFormat()
+        write_options = file_format.make_write_options(compression=export['compression'],
+                                                       compression_level=export['compressionLevel'],
+                                                       use_dictionary=True)
+        record_count = 0
+        batch_number = 0
+        while True:
+            rows = cursor.fetchmany(export['batchSize'])
+            if not rows:
+                break
+
+            # Build the Arrow table column by column and derive the partition key from `EVENT_DATE`
+            table = pa.Table.from_arrays([pa.array(column) for column in zip(*rows)], names=columns)
+            # Columns that are empty in this batch are typed as strings so all files share one schema
+            table = table.cast(pa.schema([pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                                          for field in table.schema]))
+            table = table.append_column('EVENT_DAY', pc.utf8_slice_codeunits(table['EVENT_DATE'], 0, 10))
+
+            ds.write_dataset(table, output_path, format=file_format, file_options=write_options,
+                             partitioning=ds.partitioning(pa.schema([('EVENT_DAY', pa.string())]), flavor='hive'),
+                             basename_template=f'part-{globals.Timestamps.gmt_epoch}-{batch_number}-{{i}}.parquet',
+                             existing_data_behavior='overwrite_or_ignore')
+            record_count += len(rows)
+            batch_number += 1
+
+        db.write_state(database_file=database_file, key=WATERMARK_KEY, value=up_to)
+        print(f'{record_count} audit records exported to Parquet in "{output_path}"')
+        logger.info(f'{record_count} audit records exported to Parquet in "{output_path}"')
+        return record_count
+
+    except sqlite3.Error as err:
+        print(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+    except Exception as err:
+        print(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+
+
+# ===  Export stage of the pipeline. Does nothing unless `parquetExport.enabled` is set  ===
+def run_export(settings, database_file):
+    if export_settings(settings)['enabled']:
+        export_events(settings=settings, database_file=database_file)
+
+
+# ===  Standalone export of everything not yet exported (e.g. to backfill from the existing events and archives)  ===
+def main():
+    utils.initialize()
+    settings = utils.read_configuration_settings()
+    utils.set_time_stamps()
+    export_events(settings=settings, database_file=f'{globals.Paths.databases}/{settings["database"]}')
+
+
+if __name__ == '__main__':
+    main()
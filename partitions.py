@@ -0,0 +1,222 @@
+# ===============================================================================
+# Description:    Time-based partitioning, retention and compaction of the `events` table
+# ===============================================================================
+
+import os
+import re
+import sys
+import glob
+import time
+import logging
+import sqlite3
+import datetime
+
+import event_store
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `retention` block in `settings.json`. Archiving is off until `hotDays` is set.
+DEFAULT_SETTINGS = {
+    "hotDays": 0,
+    "archiveRetentionMonths": 0,
+    "maintenanceInterval": 86400,
+    "vacuumPages": 10000
+}
+
+# Hot table (a view over `events_store` with the dictionary-encoded layout) and the view over it and all attached archives
+EVENTS_TABLE = 'events'
+EVENTS_VIEW = 'events_all'
+
+# SQLite allows 10 attached databases by default. One yearly archive is attached per schema.
+MAX_ATTACHED = 10
+
+# `pipeline_state` key holding the time of the last VACUUM/ANALYZE
+MAINTENANCE_KEY = 'maintenance_last_run'
+
+
+# ===  Retention settings merged with the defaults  ===
+def retention_settings(settings):
+    return {**DEFAULT_SETTINGS, **settings.get('retention', {})}
+
+
+# ===  Archives are kept next to the database, one SQLite file per year with one table per month  ===
+def archive_directory(database_file):
+    return f'{os.path.splitext(database_file)[0]}_archive'
+
+
+def archive_files(database_file):
+    return sorted(glob.glob(os.path.join(archive_directory(database_file), 'events_[0-9][0-9][0-9][0-9].db3')), reverse=True)
+
+
+# ===  Epoch milliseconds at the start of a month  ===
+def month_start(year, month):
+    if month > 12:
+        year, month = year + 1, 1
+    return int(datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def columns(connection, schema, table):
+    return [row[1] for row in connection.execute(f'PRAGMA {schema}.table_info({db.quote(table)})')]
+
+
+# ===  Attach a database file to the connection unless it is already attached  ===
+def attach(connection, path, schema):
+    if schema not in {row[1] for row in connection.execute('PRAGMA database_list')}:
+        connection.execute(f'ATTACH DATABASE ? AS {schema}', (path,))
+
+
+# ===  Indexes used by the incremental and search queries. Recreated after the `events` table is reloaded  ===
+def create_indexes(connection, schema, table):
+    connection.execute(f'CREATE INDEX IF NOT EXISTS {schema}.{table}_event_date ON {db.quote(table)} (eventDate)')
+    connection.execute(f'CREATE INDEX IF NOT EXISTS {schema}.{table}_id ON {db.quote(table)} (id)')
+
+
+# ===  Attach the archives and (re)create the TEMP `events_all` view over the hot table and every archived month  ===
+# Columns missing from older partitions are returned as NULL so the view always has the columns of the hot table.
+def attach_archives(connection, database_file):
+    hot_columns = columns(connection, 'main', EVENTS_TABLE)
+    if not hot_columns:
+        return False
+    create_indexes(connection, 'main', event_store.events_table(connection))
+
+    column_list = ', '.join(db.quote(column) for column in hot_columns)
+    selects = [f'SELECT {column_list} FROM main.{EVENTS_TABLE}']
+    for path in archive_files(database_file)[:MAX_ATTACHED]:
+        schema = f'archive_{os.path.basename(path)[7:11]}'
+        attach(connection, path, schema)
+        for (table,) in connection.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table' AND name LIKE 'events_%' ORDER BY name DESC"):
+            archived_columns = set(columns(connection, schema, table))
+            select_list = ', '.join(db.quote(column) if column in archived_columns else f'NULL AS {db.quote(column)}' for column in hot_columns)
+            selects.append(f'SELECT {select_list} FROM {schema}.{db.quote(table)}')
+
+    if len(archive_files(database_file)) > MAX_ATTACHED:
+        logger.warning(f'Only the {MAX_ATTACHED} most recent yearly archives are included in `{EVENTS_VIEW}`')
+
+    connection.execute(f'DROP VIEW IF EXISTS temp.{EVENTS_VIEW}')
+    connection.execute(f'CREATE TEMP VIEW {EVENTS_VIEW} AS ' + ' UNION ALL '.join(selects))
+    return True
+
+
+# ===  Move whole months older than `hotDays` from the hot table into the yearly archives  ===
+def archive_partitions(settings, database_file):
+    retention = retention_settings(settings)
+    if not retention['hotDays']:
+        return 0
+
+    # Only complete months before the month containing the cut-off are archived
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=retention['hotDays'])
+    cutoff_ms = month_start(cutoff.year, cutoff.month)
+
+    connection = db.connect(database_file)
+    try:
+        months = [row[0] for row in connection.execute(
+            f"SELECT DISTINCT strftime('%Y_%m', eventDate / 1000, 'unixepoch') FROM {EVENTS_TABLE} WHERE eventDate < ?", (cutoff_ms,))]
+    except sqlite3.Error:
+        # No `events` table yet
+        return 0
+    if not months:
+        return 0
+
+    archived = 0
+    hot_columns = columns(connection, 'main', EVENTS_TABLE)
+    column_list = ', '.join(db.quote(column) for column in hot_columns)
+    os.makedirs(archive_directory(database_file), exist_ok=True)
+
+    try:
+        for month in sorted(months):
+            year, month_number = int(month[:4]), int(month[5:])
+            schema, table = f'archive_{year}', f'events_{month}'
+            attach(connection, os.path.join(archive_directory(database_file), f'events_{year}.db3'), schema)
+
+            # Create the monthly table, or add the columns the API has introduced since it was created
+            archived_columns = columns(connection, schema, table)
+            if not archived_columns:
+                connection.execute(f'CREATE TABLE {schema}.{db.quote(table)} AS SELECT * FROM main.{EVENTS_TABLE} WHERE 0')
+                create_indexes(connection, schema, table)
+            for column in hot_columns:
+                if archived_columns and column not in archived_columns:
+                    connection.execute(f'ALTER TABLE {schema}.{db.quote(table)} ADD COLUMN {db.quote(column)}')
+
+            # Copy and delete in one transaction so an event is never in both or neither partition
+            bounds = (month_start(year, month_number), month_start(year, month_number + 1))
+            cursor = connection.execute(f'INSERT INTO {schema}.{db.quote(table)} ({column_list}) SELECT {column_list} '
+                                        f'FROM main.{EVENTS_TABLE} WHERE eventDate >= ? AND eventDate < ?', bounds)
+            connection.execute(f'DELETE FROM main.{event_store.events_table(connection)} WHERE eventDate >= ? AND eventDate < ?', bounds)
+            connection.commit()
+            archived += cursor.rowcount
+
+            print(f'{cursor.rowcount} audit events from {month.replace("_", "-")} moved to the archive')
+            logger.info(f'{cursor.rowcount} audit events from {month.replace("_", "-")} moved to the archive')
+
+        db.bump_table_version(database_file, EVENTS_TABLE)
+        return archived
+
+    except sqlite3.Error as err:
+        connection.rollback()
+        print(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+
+
+# ===  Drop archived months older than `archiveRetentionMonths` (0 keeps the archive forever)  ===
+def expire_archives(settings, database_file):
+    retention = retention_settings(settings)
+    if not retention['archiveRetentionMonths']:
+        return
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    months_since_epoch = now.year * 12 + now.month - 1 - retention['archiveRetentionMonths']
+    oldest_kept = f'events_{months_since_epoch // 12}_{months_since_epoch % 12 + 1:02d}'
+
+    connection = db.connect(database_file)
+    for path in archive_files(database_file):
+        schema = f'archive_{os.path.basename(path)[7:11]}'
+        attach(connection, path, schema)
+        tables = [row[0] for row in connection.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table' AND name LIKE 'events_%'")]
+        expired = [table for table in tables if re.match(r'^events_\d{4}_\d{2}$', table) and table < oldest_kept]
+        for table in expired:
+            connection.execute(f'DROP TABLE {schema}.{db.quote(table)}')
+            print(f'Archived audit events of {table[7:].replace("_", "-")} removed by the retention policy')
+            logger.info(f'Archived audit events of {table[7:].replace("_", "-")} removed by the retention policy')
+        connection.commit()
+
+        # Remove the yearly file once it is empty, otherwise reclaim the space of the dropped months
+        if expired and len(expired) == len(tables):
+            connection.execute(f'DETACH DATABASE {schema}')
+            os.remove(path)
+        elif expired:
+            connection.execute(f'VACUUM {schema}')
+
+
+# ===  Incremental VACUUM and ANALYZE of the hot database, at most once per `maintenanceInterval`  ===
+def maintain(settings, database_file):
+    retention = retention_settings(settings)
+    last_run = db.read_state(database_file=database_file, key=MAINTENANCE_KEY, default=0)
+    if time.time() - last_run < retention['maintenanceInterval']:
+        return
+
+    start = time.time()
+    connection = db.connect(database_file)
+    connection.commit()
+
+    # Incremental vacuum needs `auto_vacuum=INCREMENTAL`, which only takes effect after one full VACUUM
+    if connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        connection.execute('VACUUM')
+    else:
+        connection.execute(f'PRAGMA incremental_vacuum({int(retention["vacuumPages"])})').fetchall()
+    connection.execute('ANALYZE')
+    connection.commit()
+
+    db.write_state(database_file=database_file, key=MAINTENANCE_KEY, value=time.time())
+    print(f'Database maintenance (VACUUM/ANALYZE) completed in {round(time.time() - start, 2)} seconds')
+    logger.info(f'Database maintenance (VACUUM/ANALYZE) completed in {round(time.time() - start, 2)} seconds')
+
+
+# ===  Retention stage of the pipeline: archive cold months, expire old archives and compact  ===
+def run_retention(settings, database_file):
+    archive_partitions(settings=settings, database_file=database_file)
+    expire_archives(settings=settings, database_file=database_file)
+    maintain(settings=settings, database_file=database_file)
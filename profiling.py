@@ -0,0 +1,100 @@
+# ===============================================================================
+# Description:    Opt-in per-phase profiling (cProfile and tracemalloc) enabled with `--profile`
+# ===============================================================================
+
+import os
+import io
+import time
+import atexit
+import json
+import pstats
+import logging
+import cProfile
+import functools
+import threading
+import tracemalloc
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Number of functions and allocation sites listed in each report
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+run_directory = None
+phases = []
+active = threading.local()
+
+
+# ===  Start profiling the phases of this run. Reports are written to `directory`.  ===
+def start(directory):
+    global run_directory
+    os.makedirs(directory, exist_ok=True)
+    run_directory = directory
+    tracemalloc.start()
+    atexit.register(finish)
+    print(f'Profiling enabled. Reports are written to `{directory}`')
+    logger.info(f'Profiling enabled. Reports are written to `{directory}`')
+
+
+# ===  Profile the decorated function as the phase `name`  ===
+# A no-op unless profiling was started. A phase called from inside another phase is part of the outer report.
+def phase(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if run_directory is None or getattr(active, 'phase', None) is not None:
+                return function(*args, **kwargs)
+
+            active.phase = name
+            profiler = cProfile.Profile()
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            start_time = time.perf_counter()
+            try:
+                profiler.enable()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    profiler.disable()
+            finally:
+                seconds = time.perf_counter() - start_time
+                peak = tracemalloc.get_traced_memory()[1]
+                write_report(name=name, profiler=profiler, seconds=seconds, peak=peak, before=before,
+                             after=tracemalloc.take_snapshot())
+                active.phase = None
+        return wrapper
+    return decorator
+
+
+# ===  Write `<n>-<phase>.txt` (top functions and allocations) and `<n>-<phase>.prof` (for pstats or snakeviz)  ===
+def write_report(name, profiler, seconds, peak, before, after):
+    prefix = f'{run_directory}/{len(phases) + 1:02d}-{name}'
+    profiler.dump_stats(f'{prefix}.prof')
+
+    functions = io.StringIO()
+    stats = pstats.Stats(profiler, stream=functions)
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+
+    allocations = [str(statistic) for statistic in after.compare_to(before, 'lineno')[:TOP_ALLOCATIONS]]
+    with open(f'{prefix}.txt', 'w') as report:
+        report.write(f'Phase: {name}\nWall time: {seconds:.3f} s\nPeak traced memory: {peak / 2**20:.1f} MB\n\n')
+        report.write(f'Top {TOP_FUNCTIONS} functions by cumulative time\n{functions.getvalue()}\n')
+        report.write(f'Top {TOP_ALLOCATIONS} allocation sites by memory growth\n' + '\n'.join(allocations) + '\n')
+
+    phases.append({'phase': name, 'seconds': round(seconds, 3), 'peakMB': round(peak / 2**20, 1), 'report': f'{prefix}.txt'})
+    logger.info(f'Profiled phase `{name}` in {seconds:.3f} s with a peak of {peak / 2**20:.1f} MB',
+                extra={'profile': phases[-1]})
+
+
+# ===  Write `summary.json` and print the time and peak memory of every phase. Runs at exit.  ===
+def finish():
+    if run_directory is None:
+        return
+    tracemalloc.stop()
+    with open(f'{run_directory}/summary.json', 'w') as summary:
+        json.dump(phases, summary, indent=4)
+
+    print(f'\nProfile of {len(phases)} phase(s) in `{run_directory}`')
+    for entry in phases:
+        print(f'  {entry["phase"]:<16}{entry["seconds"]:>10.2f} s{entry["peakMB"]:>10.1f} MB')
@@ -0,0 +1,161 @@
+# ===============================================================================
+# Description:    Token-bucket rate governor shared by every HTTP call, with one bucket per host
+# ===============================================================================
+
+import time
+import atexit
+import logging
+import threading
+from urllib.parse import urlparse
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `rateLimits` block in `settings.json`. A host without an entry in `hosts` uses `default`.
+# `requestsPerSecond` is the sustained rate and `burst` the number of requests that may be sent at once after a quiet
+# period. A `429 Too Many Requests` pauses the host for its `Retry-After` (or `throttledPause` seconds) and the request is
+# sent again up to `maxRetries` times.
+DEFAULT_SETTINGS = {
+    "enabled": True,
+    "default": {"requestsPerSecond": 10, "burst": 10},
+    "hosts": {},
+    "throttledPause": 5,
+    "maxRetries": 3
+}
+
+config = DEFAULT_SETTINGS
+buckets = {}
+buckets_lock = threading.Lock()
+reported = False
+
+
+# ===  Rate governor settings merged with the defaults. A `default` may set only the rate or only the burst.  ===
+def rate_settings(settings):
+    config = {**DEFAULT_SETTINGS, **settings.get('rateLimits', {})}
+    config['default'] = {**DEFAULT_SETTINGS['default'], **config['default']}
+    return config
+
+
+# ===  Token bucket of one host. Callers on any thread wait their turn in `acquire`.  ===
+class token_bucket:
+    def __init__(self, host, rate, burst):
+        self.host = host
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+
+    # Take a token, sleeping until one is available. Returns the seconds waited.
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) if self.rate > 0 else self.burst
+            self.updated = now
+
+            # Tokens are reserved in order, so the balance may go negative and each caller sleeps for its own slot
+            # A rate of 0 leaves the host unlimited apart from the pauses after a `429`.
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate if self.rate > 0 else 0.0, self.paused_until - now, 0.0)
+            self.requests += 1
+            if wait > 0:
+                self.waits += 1
+                self.wait_seconds += wait
+                self.max_wait = max(self.max_wait, wait)
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    # The host answered `429`: send nothing more until the pause is over
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttled += 1
+
+    def stats(self):
+        with self.lock:
+            return {'host': self.host, 'requests': self.requests, 'waits': self.waits,
+                    'waitSeconds': round(self.wait_seconds, 3), 'maxWaitSeconds': round(self.max_wait, 3),
+                    'throttled': self.throttled}
+
+
+# ===  Apply the `rateLimits` settings. Existing buckets are replaced so new limits take effect at once.  ===
+def configure(settings):
+    global config
+    config = rate_settings(settings)
+    with buckets_lock:
+        buckets.clear()
+    atexit.register(report)
+
+
+def get_bucket(host):
+    with buckets_lock:
+        bucket = buckets.get(host)
+        if bucket is None:
+            limits = {**config['default'], **config['hosts'].get(host, {})}
+            bucket = token_bucket(host=host, rate=limits['requestsPerSecond'], burst=limits['burst'])
+            buckets[host] = bucket
+        return bucket
+
+
+# ===  Wait for a token of the host of `uri`. Returns the seconds waited.  ===
+def acquire(uri):
+    if not config['enabled']:
+        return 0.0
+    host = urlparse(uri).hostname or ''
+    wait = get_bucket(host).acquire()
+    if wait > 0:
+        logger.debug(f'Waited {wait:.3f} s for a request token of {host}')
+    return wait
+
+
+# ===  Pause the host of a throttled response. Returns the pause in seconds.  ===
+def throttle(uri, retry_after=None):
+    try:
+        seconds = float(retry_after)
+    except (TypeError, ValueError):
+        seconds = float(config['throttledPause'])
+    host = urlparse(uri).hostname or ''
+    get_bucket(host).pause(seconds)
+    print(f'{host} is throttling requests. Pausing it for {seconds:.1f} seconds')
+    logger.warning(f'{host} is throttling requests. Pausing it for {seconds:.1f} seconds')
+    return seconds
+
+
+# ===  Requests, waits and throttled responses per host  ===
+def snapshot():
+    with buckets_lock:
+        return [bucket.stats() for bucket in buckets.values()]
+
+
+# ===  Totals over all hosts (exposed by the daemon's metrics endpoint)  ===
+def totals():
+    stats = snapshot()
+    return {'rate_governor_requests': sum(entry['requests'] for entry in stats),
+            'rate_governor_waits': sum(entry['waits'] for entry in stats),
+            'rate_governor_wait_seconds': round(sum(entry['waitSeconds'] for entry in stats), 3),
+            'rate_governor_throttled': sum(entry['throttled'] for entry in stats)}
+
+
+# ===  Print and log the wait times of every host. Runs at exit.  ===
+def report():
+    global reported
+    stats = snapshot()
+    if reported or not stats:
+        return
+    reported = True
+
+    print('\nRate governor')
+    for entry in stats:
+        print(f'  {entry["host"]:<32}{entry["requests"]:>8} requests{entry["waits"]:>8} waited'
+              f'{entry["waitSeconds"]:>10.2f} s total{entry["maxWaitSeconds"]:>8.2f} s max{entry["throttled"]:>5} throttled')
+        logger.info(f'Rate governor: {entry["requests"]} requests to {entry["host"]} waited {entry["waitSeconds"]} s '
+                    f'in total', extra={'rateGovernor': entry})
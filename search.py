@@ -0,0 +1,166 @@
+# ===============================================================================
+# Description:    Full-text search over the audit events (SQLite FTS5) and the search CLI
+# ===============================================================================
+
+import sys
+import csv
+import json
+import time
+import logging
+import sqlite3
+import argparse
+import contextlib
+import datetime
+
+import globals
+import utils
+import anaplan_ops
+import partitions
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Name of the FTS5 index over the `events` table and its archives. Rows are joined back to the events by `event_id`.
+FTS_TABLE = 'events_fts'
+
+# `pipeline_state` key holding the latest `eventDate` (epoch milliseconds) already indexed
+WATERMARK_KEY = 'search_watermark'
+
+
+# ===  Create the index if it does not exist  ===
+def create_index(connection):
+    connection.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        event_id UNINDEXED, event_date UNINDEXED, message, user_agent, name, object_name,
+        tokenize = 'unicode61 remove_diacritics 2')""")
+
+
+# ===  Drop the index, e.g. when the `events` table is reloaded from scratch  ===
+def drop_index(database_file):
+    connection = db.connect(database_file)
+    connection.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    connection.commit()
+    db.delete_state(database_file=database_file, key=WATERMARK_KEY)
+
+
+# ===  Index the events received since the last update  ===
+# Object names are resolved from the metadata tables, so the update runs after the metadata sync. After a rebuild the
+# archived months are indexed as well.
+def update_index(database_file):
+    start = time.time()
+    connection = db.connect(database_file)
+    watermark = db.read_state(database_file=database_file, key=WATERMARK_KEY, default=0)
+    try:
+        create_index(connection)
+        if not partitions.attach_archives(connection, database_file):
+            return 0
+        # New events always land in the hot table
+        up_to = connection.execute(f'SELECT max(eventDate) FROM {partitions.EVENTS_TABLE}').fetchone()[0] or watermark
+
+        # The metadata tables are de-duplicated by ID so each event is indexed exactly once
+        cursor = connection.execute(f"""
+            INSERT INTO {FTS_TABLE} (event_id, event_date, message, user_agent, name, object_name)
+            SELECT e.id, e.eventDate, e.message, e.userAgent, e."additionalAttributes.name",
+                   COALESCE(m.name, cw.name, u.userName)
+            FROM {partitions.EVENTS_VIEW} e
+            LEFT JOIN (SELECT id, min(name) AS name FROM models GROUP BY id) m ON e.objectId = m.id
+            LEFT JOIN (SELECT integrationId, min(name) AS name FROM cloudworks GROUP BY integrationId) cw ON e.objectId = cw.integrationId
+            LEFT JOIN (SELECT id, min(userName) AS userName FROM users GROUP BY id) u ON e.objectId = u.id
+            WHERE e.eventDate > ? AND e.eventDate <= ?""", (watermark, up_to))
+        indexed = cursor.rowcount
+        connection.commit()
+        db.write_state(database_file=database_file, key=WATERMARK_KEY, value=up_to)
+
+        print(f'{indexed} audit events added to the search index in {round(time.time() - start, 2)} seconds')
+        logger.info(f'{indexed} audit events added to the search index in {round(time.time() - start, 2)} seconds')
+        return indexed
+
+    except sqlite3.Error as err:
+        # Search is an add-on. A failure (e.g. metadata tables not yet created) must not stop the pipeline.
+        connection.rollback()
+        print(f'Unable to update the search index: {err}')
+        logger.warning(f'Unable to update the search index: {err}')
+        return 0
+
+
+# ===  Search the events and return the enriched rows (the columns of `audit_query.sql`)  ===
+# `query` uses the FTS5 syntax, e.g. `"Chrome"`, `user_agent:python*`, `object_name:"Model 1.2" AND message:deleted`.
+def search(database_file, tenant_name, query, since=None, until=None, limit=100):
+    # Pick the most recent matches inside the index first, so only `limit` rows go through the enrichment joins
+    matches = (f'SELECT event_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ? AND event_date >= ? AND event_date <= ? '
+               f'ORDER BY event_date DESC LIMIT {int(limit)}')
+    connection = db.connect(database_file)
+    partitions.attach_archives(connection, database_file)
+    sql, _ = anaplan_ops.build_audit_query(tenant_name=tenant_name, last_run=-2, condition=f'e.id IN ({matches})',
+                                           source=partitions.EVENTS_VIEW)
+    cursor = connection.execute(f'{sql} \nORDER BY e.eventDate DESC', (query, since or 0, until or sys.maxsize))
+    columns = [desc[0] for desc in cursor.description]
+    return columns, cursor.fetchall()
+
+
+# ===  Date (YYYY-MM-DD) to epoch milliseconds  ===
+def to_epoch_ms(value):
+    return int(datetime.datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(description="Search the audit events by message, user agent, name and object name")
+    parser.add_argument('query', action='store', type=str,
+                        help='FTS5 query, e.g. \'user_agent:python*\' or \'object_name:"Model 1.2"\'')
+    parser.add_argument('-s', '--since', action='store', type=str,
+                        help='Only events on or after this date (YYYY-MM-DD)')
+    parser.add_argument('-e', '--until', action='store', type=str,
+                        help='Only events before this date (YYYY-MM-DD)')
+    parser.add_argument('-l', '--limit', action='store', type=int, default=100,
+                        help='Maximum number of rows (most recent first)')
+    parser.add_argument('-f', '--format', action='store', choices=['table', 'csv', 'json'], default='table',
+                        help='Output format')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the search index from the `events` table before searching')
+    return parser.parse_args()
+
+
+def main():
+    utils.initialize()
+    settings = utils.read_configuration_settings()
+    utils.set_time_stamps()
+    args = read_cli_arguments()
+    database_file = f'{globals.Paths.databases}/{settings["database"]}'
+
+    # Keep the output clean for `csv` and `json` by sending the index messages to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.rebuild:
+            drop_index(database_file)
+        update_index(database_file)
+
+    try:
+        start = time.time()
+        columns, rows = search(database_file=database_file, tenant_name=settings['anaplanTenantName'], query=args.query,
+                               since=to_epoch_ms(args.since) if args.since else None,
+                               until=to_epoch_ms(args.until) - 1 if args.until else None, limit=args.limit)
+        elapsed = round((time.time() - start) * 1000, 1)
+
+    except sqlite3.Error as err:
+        print(f'Search failed: {err}')
+        logger.error(f'Search failed: {err}')
+        sys.exit(1)
+
+    if args.format == 'json':
+        for row in rows:
+            print(json.dumps(dict(zip(columns, row))))
+    elif args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        shown = ['EVENT_DATE', 'EVENT_ID', 'USER_NAME', 'OBJECT_NAME', 'MESSAGE', 'USER_AGENT']
+        positions = [columns.index(column) for column in shown]
+        print(' | '.join(shown))
+        for row in rows:
+            print(' | '.join(str(row[position]) for position in positions))
+    print(f'{len(rows)} rows in {elapsed} ms', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
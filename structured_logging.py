@@ -0,0 +1,124 @@
+# ===============================================================================
+# Description:    JSON-lines logging through a background queue and throttled progress reporting
+# ===============================================================================
+
+import json
+import time
+import queue
+import atexit
+import logging
+import datetime
+import logging.handlers
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between two progress lines of the same operation
+PROGRESS_INTERVAL = 5
+
+# Attributes of every `LogRecord`. Anything else was passed with `extra=` and is written as a field.
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+listener = None
+
+
+# ===  Format each record as one JSON object per line  ===
+class json_formatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# ===  Route the root logger through a queue so callers never wait on the log file  ===
+# The file is written by a background thread. Records still queued at exit are flushed before the logging
+# module shuts down.
+def start(log_file, level=logging.INFO):
+    global listener
+    if listener is not None:
+        return
+
+    file_handler = logging.FileHandler(log_file, mode='a', encoding='utf-8')
+    file_handler.setFormatter(json_formatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+# ===  Progress of a long operation, printed and logged at most every `interval` seconds with its rate and ETA  ===
+# `total` may be unknown (`None`). The log records carry the counters as fields for later analysis. Without `show_rate`
+# (e.g. for a percentage) only the progress and the elapsed time are reported.
+class progress_reporter:
+    def __init__(self, description, total=None, unit='records', interval=PROGRESS_INTERVAL, show_rate=True):
+        self.description = description
+        self.total = total
+        self.unit = unit
+        self.show_rate = show_rate
+        self.interval = interval
+        self.done = 0
+        self.calls = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    # Add `count` units of completed work (one API call)
+    def update(self, count=1):
+        self.done += count
+        self.calls += 1
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(self.status(), echo=True)
+
+    # Set the completed work, e.g. from a task's own progress
+    def update_to(self, done):
+        self.update(done - self.done)
+
+    def fields(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rate if self.total is not None and rate > 0 else None
+        return {'operation': self.description, 'done': self.done, 'total': self.total, 'unit': self.unit,
+                'calls': self.calls, 'elapsed': round(elapsed, 3),
+                'rate': round(rate, 1) if self.show_rate else None,
+                'eta': None if eta is None or not self.show_rate else round(eta, 1)}
+
+    def status(self):
+        fields = self.fields()
+        if not self.show_rate:
+            return f'{self.description}: {fields["done"]:,} {self.unit} after {fields["elapsed"]:.0f} s'
+        done = f'{fields["done"]:,}' if fields['total'] is None else f'{fields["done"]:,}/{fields["total"]:,}'
+        eta = '' if fields['eta'] is None else f', ETA {fields["eta"]:.0f} s'
+        return f'{self.description}: {done} {self.unit} ({fields["rate"]:,.0f} {self.unit}/s{eta})'
+
+    def report(self, message, echo):
+        if echo:
+            print(message)
+        logger.info(message, extra={'progress': self.fields()})
+
+    # Log the final counters. `echo` also prints the summary when the caller does not print its own.
+    def finish(self, echo=False):
+        fields = self.fields()
+        rate = f' ({fields["rate"]:,.0f} {self.unit}/s)' if self.show_rate else ''
+        self.report(f'{self.description}: {fields["done"]:,} {self.unit} with {fields["calls"]} call(s) in '
+                    f'{fields["elapsed"]:.1f} s{rate}', echo=echo)
@@ -0,0 +1,519 @@
+# ===============================================================================
+# Description:    Generate synthetic Anaplan tenants and audit events for scale testing
+# ===============================================================================
+
+import sys
+import re
+import json
+import time
+import logging
+import argparse
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import globals
+import utils
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Weighted share of each event family. Logins, model access and action runs dominate real tenants.
+EVENT_WEIGHTS = {"USR-8": 30, "USR-10": 20, "USR-12": 8, "USR-13": 25, "USR-19": 20,
+                 "USR-20": 15, "USR-41": 8, "USR-9": 2, "INT-06": 3, "PIQ-14": 1}
+USER_AGENTS = ["Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+               "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
+               "python-requests/2.32.5", "Anaplan Connect/4.2.0", "CloudWorks/2.0"]
+HOST_NAMES = [f'core{n:05d}.anaplan.com' for n in range(10280, 10296)]
+SERVICE_VERSIONS = ["CORE-35.0.353", "CORE-35.1.012", "AUTH-12.4.2", "SCIM-3.2.0"]
+TIME_ZONES = ["UTC", "America/New_York", "Europe/London", "Asia/Tokyo"]
+
+
+# === Read CLI Arguments ===
+def read_cli_arguments():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Anaplan tenant into the SQLite schema and optionally serve it through a mock API")
+    parser.add_argument('-d', '--database', action='store', type=str, default='synthetic.db3',
+                        help="SQLite database file to create (relative to the project folder)")
+    parser.add_argument('-w', '--workspaces', action='store', type=int, default=10,
+                        help="Number of workspaces")
+    parser.add_argument('-m', '--models', action='store', type=int, default=5,
+                        help="Number of models per workspace")
+    parser.add_argument('-a', '--actions', action='store', type=int, default=40,
+                        help="Number of import/export/process actions per model")
+    parser.add_argument('-f', '--files', action='store', type=int, default=15,
+                        help="Number of files per model")
+    parser.add_argument('-u', '--users', action='store', type=int, default=2000,
+                        help="Number of users")
+    parser.add_argument('-i', '--integrations', action='store', type=int, default=100,
+                        help="Number of CloudWorks integrations")
+    parser.add_argument('-e', '--events', action='store', type=int, default=1000000,
+                        help="Number of audit events")
+    parser.add_argument('--days', action='store', type=int, default=30,
+                        help="Number of days of history the audit events are spread over")
+    parser.add_argument('--batch_size', action='store', type=int, default=200000,
+                        help="Number of audit events generated and written per batch")
+    parser.add_argument('--seed', action='store', type=int, default=42,
+                        help="Random seed so runs are reproducible")
+    parser.add_argument('--serve', action='store_true',
+                        help="Serve the generated database through a mock Anaplan API")
+    parser.add_argument('--skip_generate', action='store_true',
+                        help="Do not generate data and only serve an existing database")
+    parser.add_argument('--host', action='store', type=str, default='127.0.0.1',
+                        help="Mock API host")
+    parser.add_argument('--port', action='store', type=int, default=8080,
+                        help="Mock API port")
+    return parser.parse_args()
+
+
+# === Generate a 32 character hex ID in the Anaplan style ===
+def make_ids(rng, count, upper=False):
+    ids = [rng.bytes(16).hex() for _ in range(count)]
+    return [i.upper() for i in ids] if upper else ids
+
+
+# === Build the tenant metadata (workspaces, models, actions, files, users & CloudWorks) ===
+def generate_tenant(rng, settings, workspaces, models, actions, files, users, integrations):
+    target = settings['targetAnaplanModel']
+
+    # Workspaces. Reuse the target Workspace ID from `settings.json` so the upload path resolves against the mock.
+    workspace_ids = make_ids(rng, workspaces)
+    if re.match(r'^[a-z0-9]{32}$', target['workspace']):
+        workspace_ids[0] = target['workspace']
+    df_workspaces = pd.DataFrame({
+        'id': workspace_ids,
+        'name': [f'Workspace #{n + 1}' for n in range(workspaces)],
+        'active': 1,
+        'sizeAllowance': 42949672960,
+        'currentSize': rng.integers(10**8, 4 * 10**10, workspaces)})
+
+    # Models, with the target Model always placed in the first Workspace
+    model_rows = []
+    for ws_index, ws_id in enumerate(workspace_ids):
+        model_ids = make_ids(rng, models, upper=True)
+        if ws_index == 0 and re.match(r'^[A-Z0-9]{32}$', target['model']):
+            model_ids[0] = target['model']
+        for mod_index, mod_id in enumerate(model_ids):
+            model_rows.append({
+                'id': mod_id,
+                'name': f'Model {ws_index + 1}.{mod_index + 1}',
+                'activeState': 'ARCHIVED' if rng.random() < 0.05 and mod_id != target['model'] else 'UNLOCKED',
+                'lastSavedSerialNumber': int(rng.integers(1000, 5000000)),
+                'lastModifiedByUserGuid': rng.bytes(16).hex(),
+                'memoryUsage': int(rng.integers(10**6, 10**10)),
+                'currentWorkspaceId': ws_id,
+                'currentWorkspaceName': f'Workspace #{ws_index + 1}',
+                'modelUrl': f'https://core10288.anaplan.com/anaplan/framework.jsp?selectedWorkspaceId={ws_id}&selectedModelId={mod_id}',
+                'isoCreationDate': '2023-02-17T15:00:51.000+0000',
+                'lastModified': '2023-06-21T21:18:17.000+0000'})
+    df_models = pd.DataFrame(model_rows)
+
+    # Actions (imports, exports, actions & processes) and files per Model. Action IDs follow the Anaplan prefixes.
+    action_rows, file_rows = [], []
+    prefixes = {'imports': 112, 'exports': 116, 'actions': 117, 'processes': 118}
+    for row in model_rows:
+        ws_id, mod_id = row['currentWorkspaceId'], row['id']
+        for n in range(actions):
+            kind = list(prefixes)[n % len(prefixes)]
+            action_rows.append({'id': f'{prefixes[kind]}{n + 1:09d}', 'name': f'{kind[:-1].title()} {n + 1}',
+                                'workspace_id': ws_id, 'model_id': mod_id, 'kind': kind})
+        for n in range(files):
+            file_rows.append({'id': f'113{n + 1:09d}', 'name': f'DATA_FILE_{n + 1}.csv',
+                              'workspace_id': ws_id, 'model_id': mod_id})
+
+        # The target Model holds the import files and processes referenced in `settings.json`
+        if mod_id == target['model']:
+            for n, key in enumerate(target['targetModelObjects'].values()):
+                file_rows.append({'id': f'113{900 + n:09d}', 'name': key['importFile'],
+                                  'workspace_id': ws_id, 'model_id': mod_id})
+            for n, process in enumerate([target['process'], target['clearListProcess'], target['clearCtListProcess']]):
+                action_rows.append({'id': f'118{900 + n:09d}', 'name': process,
+                                    'workspace_id': ws_id, 'model_id': mod_id, 'kind': 'processes'})
+    df_actions = pd.DataFrame(action_rows)
+    df_files = pd.DataFrame(file_rows)
+
+    # Users
+    user_ids = make_ids(rng, users)
+    df_users = pd.DataFrame({
+        'id': user_ids,
+        'userName': [f'user.{n + 1}@example.com' for n in range(users)],
+        'displayName': [f'User {n + 1}' for n in range(users)],
+        'lastModified': '2023-03-14T18:34:19.000Z'})
+
+    # CloudWorks integrations
+    cw_models = df_models.sample(n=integrations, replace=True, random_state=int(rng.integers(0, 2**31)))
+    df_cloudworks = pd.DataFrame({
+        'integrationId': make_ids(rng, integrations),
+        'name': [f'Integration {n + 1}' for n in range(integrations)],
+        'integrationType': rng.choice(['Import', 'Export', 'Process'], integrations),
+        'createdBy': 'Synthetic Generator',
+        'creationDate': '2023-03-14T18:34:19.000Z',
+        'modificationDate': '2023-03-14T18:34:19.000Z',
+        'modifiedBy': None,
+        'modelId': cw_models['id'].tolist(),
+        'workspaceId': cw_models['currentWorkspaceId'].tolist(),
+        'nuxVisible': 0,
+        'notificationId': make_ids(rng, integrations),
+        'latestRun.triggeredBy': 'Synthetic Generator',
+        'latestRun.startDate': '2023-05-15T19:57:32.000Z',
+        'latestRun.endDate': '2023-05-15T20:05:48.000Z',
+        'latestRun.success': 1.0,
+        'latestRun.message': 'Success',
+        'latestRun.executionErrorCode': None,
+        'processId': None,
+        'schedule.name': None,
+        'schedule.type': None,
+        'schedule.toTime': None,
+        'schedule.timezone': None,
+        'schedule.fromTime': None,
+        'schedule.startDate': None,
+        'schedule.repeatEvery': None,
+        'schedule.status': None})
+
+    return {'workspaces': df_workspaces, 'models': df_models, 'actions': df_actions,
+            'files': df_files, 'users': df_users, 'cloudworks': df_cloudworks}
+
+
+# === Generate one batch of audit events drawn from the activity codes ===
+def generate_events(rng, tenant, df_codes, start_index, count, start_ms, end_ms, tenant_id):
+    # Pick event codes using the weighted families; every other code gets a small baseline weight
+    codes = df_codes['Event Code'].tolist()
+    weights = np.array([EVENT_WEIGHTS.get(code, 0.05) for code in codes], dtype=float)
+    event_codes = rng.choice(codes, count, p=weights / weights.sum())
+    messages = dict(zip(codes, df_codes['Event Message']))
+    associated = dict(zip(codes, df_codes['Associated Object ID'].fillna('').str.lower()))
+
+    # Pick the actors and the Workspace/Model context of each event
+    users = tenant['users']['id'].to_numpy()
+    models = tenant['models']
+    model_pick = rng.integers(0, len(models), count)
+    model_ids = models['id'].to_numpy()[model_pick]
+    workspace_ids = models['currentWorkspaceId'].to_numpy()[model_pick]
+    user_ids = users[rng.integers(0, len(users), count)]
+    target_users = users[rng.integers(0, len(users), count)]
+    integrations = tenant['cloudworks']['integrationId'].to_numpy()
+    integration_ids = integrations[rng.integers(0, len(integrations), count)]
+
+    # Action IDs are taken from the Model of the event so the enrichment join resolves them
+    actions = tenant['actions']
+    per_model = actions.groupby('model_id')['id'].apply(lambda s: s.to_numpy()).to_dict()
+    action_ids = np.array([per_model[m][rng.integers(0, len(per_model[m]))] if m in per_model else None
+                           for m in model_ids], dtype=object)
+
+    # Event dates are sorted so the stream behaves like the Audit API (ascending `eventDate`) in whole seconds
+    event_dates = np.sort(rng.integers(start_ms // 1000, end_ms // 1000, count)) * 1000
+
+    # Resolve object IDs based on the "Associated Object ID" description of each activity code
+    assoc = np.array([associated[c] for c in event_codes], dtype=object)
+    is_model = np.char.find(assoc.astype(str), 'model id') >= 0
+    is_user = (np.char.find(assoc.astype(str), 'user') >= 0) & ~is_model
+    is_integration = np.char.find(assoc.astype(str), 'integration id') >= 0
+    object_ids = np.where(is_model, model_ids, np.where(is_user, target_users, np.where(is_integration, integration_ids, None)))
+    has_model = is_model | np.isin(event_codes, ['USR-41', 'USR-40'])
+    is_action = np.isin(event_codes, ['USR-20', 'USR-41', 'USR-40', 'USR-36'])
+
+    success = rng.random(count) > 0.02
+    df = pd.DataFrame({
+        'id': rng.integers(10**17, 9 * 10**17, count),
+        'eventTypeId': event_codes,
+        'userId': user_ids,
+        'tenantId': tenant_id,
+        'objectId': object_ids,
+        'message': [messages[c] for c in event_codes],
+        'success': success,
+        'errorNumber': np.where(success, None, rng.integers(1000, 9999, count).astype(str)),
+        'ipAddress': [f'10.{a}.{b}.{c}' for a, b, c in rng.integers(0, 255, (count, 3))],
+        'userAgent': rng.choice(USER_AGENTS, count),
+        'sessionId': None,
+        'hostName': rng.choice(HOST_NAMES, count),
+        'serviceVersion': rng.choice(SERVICE_VERSIONS, count),
+        'eventDate': event_dates,
+        'eventTimeZone': rng.choice(TIME_ZONES, count, p=[0.7, 0.1, 0.1, 0.1]),
+        'createdDate': event_dates + 1000,
+        'createdTimeZone': 'UTC',
+        'checksum': [hashlib.sha256(rng.bytes(16)).hexdigest() for _ in range(count)],
+        'objectTypeId': None,
+        'objectTenantId': None,
+        'additionalAttributes.workspaceId': np.where(has_model, workspace_ids, None),
+        'additionalAttributes.actionId': np.where(is_action, action_ids, None),
+        'additionalAttributes.name': np.where(is_action, 'Synthetic action run', None),
+        'additionalAttributes.type': np.where(is_action, 'ACTION', None),
+        'additionalAttributes.auth_id': None,
+        'additionalAttributes.modelAccessLevel': None,
+        'additionalAttributes.modelId': np.where(has_model, model_ids, None),
+        'additionalAttributes.modelRoleName': None,
+        'additionalAttributes.modelRoleId': None,
+        'additionalAttributes.active': None,
+        'additionalAttributes.actionName': None,
+        'additionalAttributes.nux_visible': None,
+        'additionalAttributes.roleId': None,
+        'additionalAttributes.roleName': None,
+        'additionalAttributes.objectTypeId': None,
+        'additionalAttributes.objectTenantId': None,
+        'additionalAttributes.objectId': None})
+
+    # Continue the index across batches as it feeds the `LOAD_ID` in `audit_query.sql`
+    df.index = pd.RangeIndex(start_index, start_index + count)
+
+    return df
+
+
+# === Generate the full tenant and write it straight into the SQLite schema ===
+def generate(database_file, settings, args):
+    rng = np.random.default_rng(args.seed)
+    targetModelObjects = settings['targetAnaplanModel']['targetModelObjects']
+    start = time.time()
+
+    # Start from an empty database
+    for key in targetModelObjects.values():
+        db.drop_table(database_file=database_file, table=key['table'])
+
+    # Activity codes
+    df_codes = pd.read_csv(f'{globals.Paths.scripts}/activity_events.csv')
+    db.update_table(database_file=database_file, table=targetModelObjects['activityCodesData']['table'],
+                    df=df_codes, mode='replace')
+
+    # Tenant metadata written with the same table layout the pipeline creates
+    tenant = generate_tenant(rng, settings, args.workspaces, args.models, args.actions, args.files, args.users, args.integrations)
+    for name, df in tenant.items():
+        if name == 'actions':
+            df = df.drop(columns=['kind'])
+        db.update_table(database_file=database_file, table=name, df=df, mode='replace')
+        print(f'{len(df.index)} {name} records generated')
+        logger.info(f'{len(df.index)} {name} records generated')
+
+    # Audit events in batches to keep memory flat
+    tenant_id = rng.bytes(16).hex()
+    end_ms = int(time.time()) * 1000
+    start_ms = end_ms - args.days * 86400 * 1000
+    span = (end_ms - start_ms) / max(args.events, 1)
+    written = 0
+    while written < args.events:
+        count = min(args.batch_size, args.events - written)
+        batch_start = int(start_ms + written * span)
+        batch_end = int(start_ms + (written + count) * span) + 1000
+        df = generate_events(rng, tenant, df_codes, written, count, batch_start, batch_end, tenant_id)
+        db.update_table(database_file=database_file, table=targetModelObjects['auditData']['table'],
+                        df=df, mode='append', add_unique_id=False)
+        written += count
+        print(f'{written} of {args.events} audit events generated')
+
+    logger.info(f'Synthetic tenant written to {database_file} in {time.time() - start:.1f} seconds')
+    print(f'Synthetic tenant written to {database_file} in {time.time() - start:.1f} seconds')
+
+
+# === SCIM representation of a user row ===
+def scim_user(row):
+    return {'id': row['id'], 'userName': row['userName'], 'displayName': row['displayName'],
+            'meta': {'resourceType': 'User', 'lastModified': row.get('lastModified')}}
+
+
+# === Mock Anaplan API backed by a generated database ===
+class mock_api_handler(BaseHTTPRequestHandler):
+    database_file = None
+    batch_list = {}
+
+    # Silence the default access log on the console
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def query(self, sql, params=()):
+        connection = sqlite3.connect(self.database_file)
+        connection.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in connection.execute(sql, params).fetchall()]
+        finally:
+            connection.close()
+
+    def paged(self, key, sql, params, url, size=1000):
+        query = parse_qs(url.query)
+        offset = int(query.get('offset', [0])[0])
+        total = self.query(f'SELECT count(*) AS n FROM ({sql})', params)[0]['n']
+        rows = self.query(f'{sql} LIMIT {size} OFFSET {offset}', params)
+        payload = {'meta': {'paging': {'currentPageSize': len(rows), 'offset': offset, 'totalSize': total}}, 'status': {'code': 200}}
+        if rows:
+            payload[key] = rows
+        return payload
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        try:
+            if path.endswith('/Users'):
+                query = parse_qs(url.query)
+                start_index = int(query.get('startIndex', [1])[0])
+                count = int(query.get('count', [100])[0])
+                # Like SCIM, the users can be filtered by `meta.lastModified gt "<date and time>"`
+                where, params = '1', ()
+                if 'filter' in query:
+                    match = re.fullmatch(r'meta\.lastModified gt "([^"]+)"', query['filter'][0])
+                    if not match:
+                        self.send_json({'schemas': ['urn:ietf:params:scim:api:messages:2.0:Error'], 'status': '400',
+                                        'scimType': 'invalidFilter', 'detail': f'Unsupported filter {query["filter"][0]}'}, status=400)
+                        return
+                    where, params = 'julianday(lastModified) > julianday(?)', (match[1],)
+                total = self.query(f'SELECT count(*) AS n FROM users WHERE {where}', params)[0]['n']
+                rows = self.query(f'SELECT * FROM users WHERE {where} ORDER BY id LIMIT ? OFFSET ?', (*params, count, start_index - 1))
+                self.send_json({'totalResults': total, 'itemsPerPage': len(rows), 'startIndex': start_index,
+                                'Resources': [scim_user(row) for row in rows]})
+            elif match := re.search(r'/Users/(\w+)$', path):
+                rows = self.query('SELECT * FROM users WHERE id = ?', (match[1],))
+                if rows:
+                    self.send_json(scim_user(rows[0]))
+                else:
+                    self.send_json({'schemas': ['urn:ietf:params:scim:api:messages:2.0:Error'], 'status': '404',
+                                    'detail': f'User {match[1]} not found'}, status=404)
+            elif path.endswith('/workspaces'):
+                self.send_json(self.paged('workspaces', 'SELECT * FROM workspaces', (), url))
+            elif match := re.search(r'/workspaces/(\w+)/models$', path):
+                self.send_json(self.paged('models', 'SELECT *, "[]" AS categoryValues FROM models WHERE currentWorkspaceId = ?', (match[1],), url))
+            # Like the Integration API, requests for the objects of a deleted Model fail
+            elif (match := re.search(r'/workspaces/(\w+)/models/(\w+)/\w+$', path)) and not self.query(
+                    'SELECT 1 FROM models WHERE currentWorkspaceId = ? AND id = ?', (match[1], match[2])):
+                self.send_json({'status': {'code': 404, 'message': f'Model {match[2]} not found'}}, status=404)
+            elif match := re.search(r'/workspaces/(\w+)/models/(\w+)/(imports|exports|actions|processes)$', path):
+                prefix = {'imports': '112', 'exports': '116', 'actions': '117', 'processes': '118'}[match[3]]
+                self.send_json(self.paged(match[3], 'SELECT id, name FROM actions WHERE workspace_id = ? AND model_id = ? AND id LIKE ?',
+                                          (match[1], match[2], f'{prefix}%'), url))
+            elif match := re.search(r'/workspaces/(\w+)/models/(\w+)/files$', path):
+                self.send_json(self.paged('files', 'SELECT id, name FROM files WHERE workspace_id = ? AND model_id = ?', (match[1], match[2]), url))
+            elif path.endswith('/integrations'):
+                rows = self.paged('integrations', 'SELECT * FROM cloudworks', (), url)
+                for row in rows.get('integrations', []):
+                    row['schedule.daysOfWeek'] = None
+                self.send_json(rows)
+            elif path.endswith('/lineItems'):
+                self.send_json({'items': [{'id': '218000000001', 'name': 'Time Stamp', 'moduleId': '102000000001'},
+                                          {'id': '218000000002', 'name': 'Audit Records Loaded', 'moduleId': '102000000001'}]})
+            elif path.endswith('/lists'):
+                self.send_json({'lists': [{'id': '101000000001', 'name': 'BATCH_ID'}]})
+            elif re.search(r'/tasks/[\w-]+$', path):
+                self.send_json({'task': {'taskState': 'COMPLETE', 'result': {'nestedResults': []}}})
+            else:
+                self.send_json({'status': {'code': 404, 'message': f'No mock for {path}'}}, status=404)
+        except Exception as err:
+            logger.error(f'{err} in mock GET {path}')
+            self.send_json({'status': {'code': 500, 'message': str(err)}}, status=500)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        path = url.path
+        try:
+            body = json.loads(self.read_body() or b'{}')
+            if path.endswith('/events/search'):
+                query = parse_qs(url.query)
+                limit = int(query.get('limit', [1000])[0])
+                offset = int(query.get('offset', [0])[0])
+                where, params = search_filter(body)
+                total = self.query(f'SELECT count(*) AS n FROM events WHERE {where}', params)[0]['n']
+                rows = self.query(f'SELECT * FROM events WHERE {where} ORDER BY eventDate, "index" LIMIT ? OFFSET ?',
+                                  (*params, limit, offset))
+                payload = {'meta': {'paging': {'currentPageSize': len(rows), 'offset': offset, 'totalSize': total}},
+                           'response': [unflatten_event(row) for row in rows]}
+                if offset + limit < total:
+                    payload['meta']['paging']['nextUrl'] = f'http://{self.headers["Host"]}{url.path}?limit={limit}&offset={offset + limit}'
+                self.send_json(payload)
+            elif path.endswith('/authenticate') or path.endswith('/refresh'):
+                self.send_json({'status': 'SUCCESS', 'tokenInfo': {'tokenValue': rng_token(), 'expiresAt': int(time.time() + 2100) * 1000,
+                                                                  'tokenId': rng_token(), 'refreshTokenId': rng_token()}})
+            elif path.endswith('/tasks'):
+                self.send_json({'task': {'taskId': rng_token()}})
+            else:
+                # File chunk counts, list items and module data are accepted as-is
+                self.send_json({'status': {'code': 200}})
+        except Exception as err:
+            logger.error(f'{err} in mock POST {path}')
+            self.send_json({'status': {'code': 500, 'message': str(err)}}, status=500)
+
+    def do_PUT(self):
+        # File chunk uploads are read and discarded
+        self.read_body()
+        self.send_response(204)
+        self.end_headers()
+
+
+# === WHERE clause of an event search. Workspace and Model IDs only filter the events that carry one. ===
+def search_filter(body):
+    where, params = ['eventDate >= ?'], [body.get('from', 0)]
+    for field, column in (('eventTypeIds', 'eventTypeId'), ('workspaceIds', 'additionalAttributes.workspaceId'),
+                          ('modelIds', 'additionalAttributes.modelId')):
+        if body.get(field):
+            condition = f'"{column}" IN ({", ".join("?" * len(body[field]))})'
+            where.append(condition if field == 'eventTypeIds' else f'("{column}" IS NULL OR {condition})')
+            params.extend(body[field])
+    return ' AND '.join(where), tuple(params)
+
+
+# === Random token value for the mock authentication endpoints ===
+def rng_token():
+    return hashlib.sha256(str(time.time_ns()).encode('utf-8')).hexdigest()
+
+
+# === Convert a flattened `events` row back into the Audit API JSON shape ===
+def unflatten_event(row):
+    event = {}
+    for key, value in row.items():
+        if key == 'index' or value is None:
+            continue
+        if key.startswith('additionalAttributes.'):
+            event.setdefault('additionalAttributes', {})[key.split('.', 1)[1]] = value
+        elif key == 'success':
+            event[key] = bool(value)
+        else:
+            event[key] = value
+    return event
+
+
+# === Start the mock API ===
+def serve(database_file, host, port):
+    mock_api_handler.database_file = database_file
+    server = ThreadingHTTPServer((host, port), mock_api_handler)
+    base = f'http://{host}:{port}'
+    print(f'Mock Anaplan API serving {database_file} on {base}. Point the `uris` in `settings.json` at it:')
+    print(json.dumps({"authenticationApi": f'{base}/token', "integrationApi": f'{base}/2/0', "auditApi": f'{base}/audit/api/1',
+                      "scimApi": f'{base}/scim/1/0/v2', "cloudworksApi": f'{base}/cloudworks/2/0'}, indent=4))
+    logger.info(f'Mock Anaplan API started on {base}')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print('Mock Anaplan API stopped')
+
+
+def main():
+    utils.initialize()
+    settings = utils.read_configuration_settings()
+    args = read_cli_arguments()
+    database_file = f'{globals.Paths.databases}/{args.database}'
+
+    if not args.skip_generate:
+        generate(database_file=database_file, settings=settings, args=args)
+
+    if args.serve:
+        serve(database_file=database_file, host=args.host, port=args.port)
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
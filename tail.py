@@ -0,0 +1,206 @@
+# ===============================================================================
+# Description:    Tail mode: stream new audit events, enriched from the cached metadata, as NDJSON to local sinks
+# ===============================================================================
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import statistics
+
+import globals
+import utils
+import anaplan_ops
+import event_filters
+import event_frames
+import database_ops as db
+
+# Heavy dependencies are loaded on first use
+pd = utils.lazy_import('pandas')
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `tail` block in `settings.json`. `file` and `socket` are relative to the project folder.
+DEFAULT_SETTINGS = {
+    "pollInterval": 15,
+    "sink": "stdout",
+    "file": "audit-events.ndjson",
+    "socket": "audit-events.sock"
+}
+
+SINKS = ['stdout', 'file', 'socket']
+
+# `pipeline_state` key holding the latest `eventDate` (epoch milliseconds) emitted to the sink
+WATERMARK_KEY = 'tail_watermark'
+
+# Each page of new events is enriched through `audit_query.sql` from this scratch table
+SCRATCH_TABLE = 'tail_events'
+
+
+# ===  Tail settings merged with the defaults  ===
+def tail_settings(settings):
+    return {**DEFAULT_SETTINGS, **settings.get('tail', {})}
+
+
+# ===  Append to a file and sync it to disk before the watermark moves  ===
+class file_sink:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, lines):
+        self.file.write(''.join(lines))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+# ===  Send to a listening Unix socket (e.g. a log shipper). Reconnects on the next write after a failure.  ===
+class socket_sink:
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def write(self, lines):
+        try:
+            if self.connection is None:
+                self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.connection.connect(self.path)
+            self.connection.sendall(''.join(lines).encode('utf-8'))
+        except OSError as err:
+            self.close()
+            raise OSError(f'Unable to write to the socket `{self.path}`: {err}') from err
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+# ===  Write to standard output. `main` sends the console messages to standard error while tailing to it.  ===
+class stdout_sink:
+    def __init__(self, stream):
+        self.path = '<stdout>'
+        self.stream = stream
+
+    def write(self, lines):
+        self.stream.write(''.join(lines))
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+def open_sink(config, sink, stream):
+    match sink:
+        case 'file':
+            return file_sink(os.path.join(globals.Paths.databases, config['file']))
+        case 'socket':
+            return socket_sink(os.path.join(globals.Paths.databases, config['socket']))
+        case 'stdout':
+            return stdout_sink(stream)
+        case _:
+            raise ValueError(f'Unknown tail sink "{sink}". Use one of {", ".join(SINKS)}')
+
+
+# ===  Where to resume: the tail watermark, else the last ingested event, else now  ===
+def start_watermark(settings, database_file):
+    watermark = db.read_state(database_file=database_file, key=WATERMARK_KEY)
+    if watermark is None:
+        watermark = max(db.read_state(database_file=database_file, key=anaplan_ops.INGEST_WATERMARK_KEY,
+                                      default=settings['lastRun']), settings['lastRun'])
+    return watermark or int(time.time() * 1000)
+
+
+# ===  Enrich one page of events with `audit_query.sql` and return them as dictionaries  ===
+def enrich(settings, database_file, events):
+    df = pd.concat([anaplan_ops.initialize_data_frame(), event_frames.records_frame(events)], ignore_index=True)
+
+    # Release the `sqlite3` connection's transaction before writing through APSW
+    db.connect(database_file).commit()
+    db.bulk_write(connection=db.bulk_connect(database_file), table=SCRATCH_TABLE, df=df, mode='replace', index=True)
+
+    sql, _ = anaplan_ops.build_audit_query(tenant_name=settings['anaplanTenantName'], last_run=-2, source=SCRATCH_TABLE,
+                                           extra_columns='e.eventDate AS EVENT_DATE_MS')
+    cursor = db.connect(database_file).execute(sql)
+    columns = [desc[0] for desc in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+# ===  Emit every event after the tail watermark, page by page  ===
+# A page is written to the sink before the watermark moves past it (at-least-once delivery).
+def poll(settings, database_file, sink):
+    utils.set_time_stamps()
+    watermark = db.read_state(database_file=database_file, key=WATERMARK_KEY)
+    uri = f'{settings["uris"]["auditApi"]}/events/search?limit={settings["auditBatchSize"]}'
+    filters = event_filters.filter_settings(settings)
+    body = event_filters.request_body(filters=filters, start=watermark + 1)
+    latencies = []
+
+    while uri is not None:
+        res = anaplan_ops.anaplan_api(uri=uri, verb='POST', body=body, token_type="AnaplanAuthToken ").json()
+        uri = res.get('meta', {}).get('paging', {}).get('nextUrl')
+        events = res.get('response') or []
+        if not events:
+            break
+
+        kept = event_filters.apply(filters=filters, events=events)
+        records = enrich(settings=settings, database_file=database_file, events=kept) if kept else []
+        sink.write([json.dumps(record, default=str) + '\n' for record in records])
+
+        # Latency from the event time to the moment the event was handed to the sink
+        emitted_at = time.time() * 1000
+        latencies.extend((emitted_at - record['EVENT_DATE_MS']) / 1000 for record in records)
+        watermark = max(watermark, max(event['eventDate'] for event in events))
+        db.write_state(database_file=database_file, key=WATERMARK_KEY, value=watermark)
+
+    if latencies:
+        print(f'{len(latencies)} audit events emitted to {sink.path}. Latency: median {statistics.median(latencies):.1f} s, '
+              f'max {max(latencies):.1f} s')
+        logger.info(f'{len(latencies)} audit events emitted to {sink.path}',
+                    extra={'tail': {'events': len(latencies), 'latencyMedian': round(statistics.median(latencies), 3),
+                                    'latencyMax': round(max(latencies), 3), 'watermark': watermark}})
+
+
+# ===  Tail loop  ===
+def run(settings, interval=None, sink=None):
+    config = tail_settings(settings)
+    poll_interval = interval or config['pollInterval']
+    database_file = f'{globals.Paths.databases}/{settings["database"]}'
+    output = open_sink(config=config, sink=sink or config['sink'], stream=sys.__stdout__)
+
+    # The enrichment only reads the cached metadata, which is crawled once if it has never been synced
+    targetModelObjects = settings['targetAnaplanModel']['targetModelObjects']
+    if not db.table_exists(database_file=database_file, table=targetModelObjects['usersData']['table']):
+        anaplan_ops.sync_metadata(settings=settings, database_file=database_file, uris=settings['uris'],
+                                  targetModelObjects=targetModelObjects)
+
+    watermark = start_watermark(settings=settings, database_file=database_file)
+    db.write_state(database_file=database_file, key=WATERMARK_KEY, value=watermark)
+    print(f'Tailing audit events after {watermark} to {output.path} every {poll_interval} seconds')
+    logger.info(f'Tailing audit events after {watermark} to {output.path} every {poll_interval} seconds')
+
+    try:
+        while True:
+            cycle_start = time.time()
+            try:
+                poll(settings=settings, database_file=database_file, sink=output)
+            except (Exception, SystemExit) as err:
+                # Nothing after the last emitted page is lost; the next poll resumes from the watermark
+                print(f'Tail poll failed: {err}')
+                logger.error(f'Tail poll failed: {err}')
+            time.sleep(max(cycle_start + poll_interval - time.time(), 0))
+
+    except KeyboardInterrupt:
+        print('Tail stopped')
+        logger.info('Tail stopped')
+        output.close()
+        if globals.Auth.token_provider is not None:
+            globals.Auth.token_provider.stop()
+        db.close_connections()
+        sys.exit(0)
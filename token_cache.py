@@ -0,0 +1,103 @@
+# ===============================================================================
+# Description:    Encrypted on-disk cache of the Basic & Cert Auth `access_token`, reused across runs
+# ===============================================================================
+
+import os
+import time
+import hashlib
+import logging
+
+import utils
+
+# Loaded on first use
+apsw = utils.lazy_import('apsw')
+AES = utils.lazy_import('Crypto.Cipher.AES')
+KDF = utils.lazy_import('Crypto.Protocol.KDF')
+Random = utils.lazy_import('Crypto.Random')
+SHA512 = utils.lazy_import('Crypto.Hash.SHA512')
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# PBKDF2 work factor. The secret for Basic Auth is a password, so the key derivation must be slow to brute force.
+KDF_ITERATIONS = 100000
+
+
+# ===  Token cache for one identity (authentication mode, URI and user or certificate)  ===
+# Tokens are encrypted with AES-GCM. The key is derived from a secret only the caller can supply on each run (the
+# password, or the private key and its passphrase), so the cache file alone does not reveal a usable token.
+class TokenCache:
+    def __init__(self, database, identity, secret):
+        self.database = database
+        # Only a hash of the identity is stored
+        self.identity = hashlib.sha256(identity.encode('utf-8')).hexdigest()
+        self.secret = secret
+
+    def connect(self):
+        # Forward SQLite logs to the logging module
+        utils.forward_sqlite_logs()
+        connection = apsw.Connection(self.database)
+        connection.execute("create table if not exists auth_tokens (identity text primary key, salt blob, nonce blob, "
+                           "tag blob, ciphertext blob, issued_at real, expires_at real)")
+        return connection
+
+    def derive_key(self, salt):
+        return KDF.PBKDF2(self.secret, salt, dkLen=32, count=KDF_ITERATIONS, hmac_hash_module=SHA512)
+
+    # Returns (`access_token`, issued at, expires at) or `None` if there is no usable cache entry
+    def load(self):
+        if not os.path.isfile(self.database):
+            return None
+        try:
+            row = self.connect().execute(
+                "select salt, nonce, tag, ciphertext, issued_at, expires_at from auth_tokens where identity=?",
+                (self.identity,)).fetchone()
+            if row is None:
+                return None
+            salt, nonce, tag, ciphertext, issued_at, expires_at = row
+            if expires_at <= time.time():
+                logger.info("Cached Access Token has expired")
+                return None
+            cipher = AES.new(self.derive_key(salt), AES.MODE_GCM, nonce=nonce)
+            access_token = cipher.decrypt_and_verify(ciphertext, tag).decode('utf-8')
+            return access_token, issued_at, expires_at
+        except (ValueError, apsw.Error) as err:
+            # A changed password or key fails verification. Fall back to a full authentication.
+            logger.warning(f'Unable to read the cached Access Token: {err}')
+            return None
+
+    def store(self, access_token, expires_at):
+        try:
+            salt = Random.get_random_bytes(16)
+            cipher = AES.new(self.derive_key(salt), AES.MODE_GCM)
+            ciphertext, tag = cipher.encrypt_and_digest(access_token.encode('utf-8'))
+            self.connect().execute(
+                "insert or replace into auth_tokens values(?, ?, ?, ?, ?, ?, ?)",
+                (self.identity, salt, cipher.nonce, tag, ciphertext, time.time(), expires_at))
+            logger.info("Cached Access Token updated")
+        except apsw.Error as err:
+            # The cache is an optimisation only
+            logger.warning(f'Unable to cache the Access Token: {err}')
+
+    def clear(self):
+        if os.path.isfile(self.database):
+            self.connect().execute("delete from auth_tokens where identity=?", (self.identity,))
+
+
+# ===  Cache for Basic Auth. The key is derived from the username and password  ===
+def basic_cache(database, uri, username, password):
+    return TokenCache(database=database, identity=f'basic:{uri}:{username}',
+                      secret=f'{username}:{password}'.encode('utf-8'))
+
+
+# ===  Cache for Cert Auth. The key is derived from the private key file and its passphrase  ===
+def cert_cache(database, uri, public_cert_path, private_key_path):
+    private_key_path_parts = private_key_path.split(':')
+    with open(private_key_path_parts[0], 'rb') as key_file:
+        secret = key_file.read()
+    if len(private_key_path_parts) > 1:
+        secret += private_key_path_parts[1].encode('utf-8')
+    with open(public_cert_path, 'rb') as cert_file:
+        certificate = cert_file.read()
+    return TokenCache(database=database, identity=f'cert_auth:{uri}:{hashlib.sha256(certificate).hexdigest()}',
+                      secret=secret)
@@ -0,0 +1,153 @@
+# ===============================================================================
+# Description:    Expiry-aware, thread-safe provider of the Anaplan `access_token`
+# ===============================================================================
+
+import sys
+import time
+import random
+import logging
+import threading
+import contextvars
+
+import globals
+import utils
+
+# Loaded on first use
+jwt = utils.lazy_import('jwt')
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+
+# ===  Read the expiry (epoch seconds) from a JWT `access_token`. Returns `None` for opaque tokens  ===
+def jwt_expiry(access_token):
+    try:
+        return float(jwt.decode(access_token, options={"verify_signature": False})['exp'])
+    except Exception:
+        return None
+
+
+# ===  Token provider  ===
+# Holds one consistent `access_token` for all workers. The background thread refreshes it proactively (with jitter)
+# before it expires. Workers that receive a 401 call `force_refresh` and only one refresh is performed per stale token.
+class TokenProvider:
+    def __init__(self, refresh_function, token_ttl, refresh_ratio=0.8, jitter_ratio=0.05, on_refresh=None):
+        # `refresh_function(access_token)` returns a tuple of (`access_token`, expiry in epoch seconds or `None`)
+        self.refresh_function = refresh_function
+        # Optional `on_refresh(access_token, expires_at)` called after each refresh (e.g. to update the token cache)
+        self.on_refresh = on_refresh
+        self.token_ttl = token_ttl
+        self.refresh_ratio = refresh_ratio
+        self.jitter_ratio = jitter_ratio
+        self.state_lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.access_token = None
+        self.issued_at = 0
+        self.expires_at = 0
+        self.refresh_count = 0
+        self.last_error = None
+        self.thread = None
+
+    # Store a new token. The expiry is taken from the token response, then the JWT `exp` claim, then the configured TTL.
+    def set_token(self, access_token, expires_at=None):
+        now = time.time()
+        expires_at = expires_at or jwt_expiry(access_token) or now + self.token_ttl
+        with self.state_lock:
+            self.access_token = access_token
+            self.issued_at = now
+            self.expires_at = expires_at
+            globals.Auth.access_token = access_token
+        logger.info(f'Access Token valid for {int(expires_at - now)} seconds')
+
+    # Seconds until the current token expires
+    def time_to_expiry(self):
+        with self.state_lock:
+            return self.expires_at - time.time()
+
+    # Current token. If it has already expired (e.g. the background refresh kept failing) refresh synchronously.
+    def get_token(self):
+        with self.state_lock:
+            access_token, expires_at = self.access_token, self.expires_at
+        if access_token is not None and time.time() < expires_at - 5:
+            return access_token
+        return self.force_refresh(stale_token=access_token, exit_on_error=True)
+
+    # Refresh the token unless another worker already replaced the stale token
+    def force_refresh(self, stale_token, exit_on_error=True):
+        with self.refresh_lock:
+            with self.state_lock:
+                if self.access_token is not None and self.access_token != stale_token:
+                    return self.access_token
+            try:
+                self.refresh()
+            except Exception as err:
+                print(f'Unable to refresh the Access Token: {err}')
+                logger.error(f'Unable to refresh the Access Token: {err}')
+                if exit_on_error:
+                    sys.exit(1)
+                raise
+            return self.access_token
+
+    def refresh(self):
+        with self.state_lock:
+            current = self.access_token
+        access_token, expires_at = self.refresh_function(current)
+        self.set_token(access_token, expires_at)
+        with self.state_lock:
+            self.refresh_count += 1
+            self.last_error = None
+            expires_at = self.expires_at
+        if self.on_refresh is not None:
+            self.on_refresh(access_token, expires_at)
+
+    # Time of the next proactive refresh. A random jitter spreads refreshes of concurrent providers.
+    def next_refresh_at(self):
+        with self.state_lock:
+            lifetime = max(self.expires_at - self.issued_at, 1)
+            return self.issued_at + lifetime * self.refresh_ratio - random.uniform(0, lifetime * self.jitter_ratio)
+
+    # Background loop. Failures are logged and retried with a back-off while the current token is still valid;
+    # the thread never exits the process.
+    def run(self):
+        retry_delay = 5
+        while not self.stop_event.is_set():
+            delay = max(self.next_refresh_at() - time.time(), 0)
+            if self.stop_event.wait(delay):
+                break
+            try:
+                with self.refresh_lock:
+                    self.refresh()
+                logger.info('Access Token refreshed by the background thread')
+                retry_delay = 5
+            except BaseException as err:
+                with self.state_lock:
+                    self.last_error = str(err)
+                logger.error(f'Background Access Token refresh failed: {err}. Retrying in {retry_delay} seconds.')
+                if self.stop_event.wait(retry_delay):
+                    break
+                retry_delay = min(retry_delay * 2, max(self.time_to_expiry() / 2, 5))
+
+    # The thread runs in a copy of the current context so it updates the `access_token` of its own tenant
+    def start(self):
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.run,),
+                                       name='Refresh Token', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# ===  Access Token for an API call, from the provider when one is configured  ===
+def get_access_token():
+    provider = globals.Auth.token_provider
+    return provider.get_token() if provider is not None else globals.Auth.access_token
+
+
+# ===  Force a refresh after a 401. Returns `False` when there is no provider to refresh with  ===
+def force_refresh(stale_token):
+    provider = globals.Auth.token_provider
+    if provider is None:
+        return False
+    provider.force_refresh(stale_token=stale_token)
+    return True
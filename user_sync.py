@@ -0,0 +1,235 @@
+# ===============================================================================
+# Description:    Incremental SCIM user sync from a `meta.lastModified` watermark, with lookups of unknown user IDs
+# ===============================================================================
+
+import sys
+import time
+import logging
+import sqlite3
+import contextvars
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+import anaplan_ops
+import metadata_crawl
+import event_frames
+import http_session
+import database_ops as db
+
+# Enable logger
+logger = logging.getLogger(__name__)
+
+# Defaults for the optional `userSync` block in `settings.json`. With `"mode": "incremental"` only the users modified
+# since the previous sync are requested and upserted. A full listing still runs every `fullSyncHours` (SCIM does not
+# report deleted users), and when more than `maxLookups` user IDs of the new events are unknown.
+DEFAULT_SETTINGS = {
+    "mode": "incremental",
+    "fullSyncHours": 24,
+    "maxLookups": 100
+}
+
+MODES = ['full', 'incremental']
+
+# `pipeline_state` keys holding the time (epoch seconds) the users were last requested from, the time (epoch
+# milliseconds) of the last full listing and the latest `eventDate` (epoch milliseconds) whose user IDs have been resolved
+WATERMARK_KEY = 'users_watermark'
+FULL_SYNC_KEY = 'users_full_sync'
+EVENT_WATERMARK_KEY = 'users_event_watermark'
+
+# The next sync requests the users modified this many seconds before the previous one started, to allow for clock skew
+# between this host and SCIM. Users modified in the overlap are upserted again, which changes nothing.
+OVERLAP_SECONDS = 300
+
+# Columns stored in the users table
+USER_COLUMNS = ['id', 'userName', 'displayName']
+
+
+# ===  User sync settings merged with the defaults  ===
+def user_settings(settings):
+    config = {**DEFAULT_SETTINGS, **settings.get('userSync', {})}
+    if config['mode'] not in MODES:
+        raise ValueError(f'Unknown user sync mode "{config["mode"]}". Use one of {", ".join(MODES)}')
+    return config
+
+
+# ===  True when the users table is kept between crawls and updated in place  ===
+def incremental(settings):
+    return user_settings(settings)['mode'] == 'incremental'
+
+
+# ===  SCIM date and time (UTC) of epoch seconds  ===
+def scim_time(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def full_sync_due(settings, database_file, table):
+    config = user_settings(settings)
+    if config['mode'] == 'full' or not db.table_exists(database_file=database_file, table=table):
+        return True
+    if db.read_state(database_file=database_file, key=WATERMARK_KEY) is None:
+        return True
+    last_full_sync = db.read_state(database_file=database_file, key=FULL_SYNC_KEY, default=0)
+    return time.time() * 1000 - last_full_sync >= config['fullSyncHours'] * 3600 * 1000
+
+
+# ===  Users modified since `since` (epoch seconds), or `None` when SCIM rejects the filter  ===
+def changed_users(uris, since):
+    scim_filter = f'meta.lastModified gt "{scim_time(since)}"'
+    uri = f'{uris["scimApi"]}/Users?filter={quote(scim_filter)}'
+    logger.debug(f'API Endpoint: {uri}')
+    res = anaplan_ops.anaplan_api(uri=uri, verb="GET", token_type="Bearer ", exit_on_error=False)
+    if res is None:
+        return None
+
+    # SCIM `startIndex` is 1-based
+    res = res.json()
+    users = res.get('Resources') or []
+    page_size, first_index, total_results = res.get('itemsPerPage', 0), res.get('startIndex', 1), res.get('totalResults', 0)
+    page_uris = [f'{uri}&startIndex={index}'
+                 for index in range(first_index + page_size, first_index + total_results, page_size)] if page_size else []
+    for page in anaplan_ops.fetch_pages(page_uris):
+        users.extend(page.get('Resources') or [])
+    return users
+
+
+# ===  Users looked up one by one. Returns the users found, the IDs SCIM does not know and the IDs whose lookup failed  ===
+# Only a `404` means the user does not exist. A lookup that failed otherwise (e.g. a timeout) is retried on the next sync.
+def lookup_users(uris, user_ids):
+    def lookup(user_id):
+        uri = f'{uris["scimApi"]}/Users/{user_id}'
+        logger.debug(f'API Endpoint: {uri}')
+        return anaplan_ops.anaplan_api(uri=uri, verb="GET", token_type="Bearer ", exit_on_error=False, allowed_statuses=(404,))
+
+    # Each lookup runs in a copy of the caller's context so it uses the tenant's token
+    workers = max(min(anaplan_ops.PAGE_WORKERS, http_session.POOL_SIZE, len(user_ids)), 1)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Lookup') as executor:
+        futures = [executor.submit(contextvars.copy_context().run, lookup, user_id) for user_id in user_ids]
+        responses = [future.result() for future in futures]
+
+    found, deleted, failed = [], [], []
+    for user_id, res in zip(user_ids, responses):
+        if res is None:
+            failed.append(user_id)
+        elif res.status_code == 404:
+            deleted.append(user_id)
+        else:
+            found.append(res.json())
+    return found, deleted, failed
+
+
+# ===  Replace the stored rows of the given users in one transaction  ===
+def upsert_users(database_file, table, users, add_unique_id):
+    if not users:
+        return
+    df = event_frames.records_frame(users).reindex(columns=USER_COLUMNS)
+
+    # Release the `sqlite3` connection's transaction before writing through APSW. The old rows are only removed if
+    # the new rows are written as well.
+    db.connect(database_file).commit()
+    connection = db.bulk_connect(database_file)
+    with connection:
+        connection.executemany(f'DELETE FROM {db.quote(table)} WHERE id = ?', [(user_id,) for user_id in df['id']])
+        db.bulk_write(connection=connection, table=table, df=df, mode='append', index=not add_unique_id)
+    db.bump_table_version(database_file, table)
+
+
+# ===  Earliest `eventDate` after `watermark` of the events of the given users  ===
+def first_event(database_file, events_table, user_ids, watermark, up_to):
+    connection = db.connect(database_file)
+    return connection.execute(
+        f'SELECT min(eventDate) FROM {db.quote(events_table)} WHERE eventDate > ? AND eventDate <= ? '
+        f'AND userId IN ({", ".join("?" * len(user_ids))})', (watermark, up_to, *user_ids)).fetchone()[0]
+
+
+# ===  User IDs of the new events that are neither stored nor cached as deleted  ===
+def unresolved_user_ids(database_file, events_table, table, watermark, up_to):
+    connection = db.connect(database_file)
+    return [row[0] for row in metadata_crawl.unresolved(
+        connection=connection, events_table=events_table, watermark=watermark, up_to=up_to, object_type='user',
+        id_column='e.userId', scope_column="''", table=table, match='t.id = e.userId')]
+
+
+# ===  Sync the users table: a full listing when due, else the users modified since the last sync  ===
+# User IDs of the new events that are still unknown afterwards are looked up by ID, and those SCIM does not know are
+# cached as deleted.
+def sync_users(settings, database_file, uris, targetModelObjects):
+    config = user_settings(settings)
+    table = targetModelObjects['usersData']['table']
+    add_unique_id = targetModelObjects['usersData']['addUniqueId']
+    events_table = targetModelObjects['auditData']['table']
+
+    # In the `full` mode the users are listed on every crawl, as before
+    if config['mode'] == 'full':
+        anaplan_ops.get_users(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects)
+        return
+
+    try:
+        start = time.time()
+        full = full_sync_due(settings=settings, database_file=database_file, table=table)
+        changed = None
+        if not full:
+            since = db.read_state(database_file=database_file, key=WATERMARK_KEY) - OVERLAP_SECONDS
+            changed = changed_users(uris=uris, since=since)
+            if changed is None:
+                print('SCIM rejected the `meta.lastModified` filter. Listing all users instead')
+                logger.warning('SCIM rejected the `meta.lastModified` filter. Listing all users instead')
+                full = True
+        if full:
+            anaplan_ops.get_users(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects)
+            db.write_state(database_file=database_file, key=FULL_SYNC_KEY, value=int(start * 1000))
+        else:
+            upsert_users(database_file=database_file, table=table, users=changed, add_unique_id=add_unique_id)
+            print(f'{len(changed)} user(s) modified since {scim_time(since)} upserted into `{table}`')
+            logger.info(f'{len(changed)} user(s) modified since {scim_time(since)} upserted into `{table}`')
+
+        # User IDs of the events ingested since the previous sync that are still unknown
+        lookups, missing, failed = 0, [], []
+        up_to = metadata_crawl.latest_event(database_file=database_file, events_table=events_table)
+        if up_to is not None:
+            metadata_crawl.prepare_deleted_cache(settings=settings, database_file=database_file)
+            watermark = db.read_state(database_file=database_file, key=EVENT_WATERMARK_KEY, default=0)
+            missing = unresolved_user_ids(database_file=database_file, events_table=events_table, table=table,
+                                          watermark=watermark, up_to=up_to)
+
+            # A full listing has just returned every user, and beyond `maxLookups` one listing is cheaper than lookups
+            if missing and not full and len(missing) > config['maxLookups']:
+                print(f'{len(missing)} unknown user IDs in the new events. Listing all users instead of looking them up')
+                logger.info(f'{len(missing)} unknown user IDs in the new events. Listing all users instead of looking them up')
+                anaplan_ops.get_users(uris=uris, database_file=database_file, targetModelObjects=targetModelObjects)
+                db.write_state(database_file=database_file, key=FULL_SYNC_KEY, value=int(start * 1000))
+                full = True
+                missing = unresolved_user_ids(database_file=database_file, events_table=events_table, table=table,
+                                              watermark=watermark, up_to=up_to)
+            elif missing and not full:
+                found, missing, failed = lookup_users(uris=uris, user_ids=missing)
+                upsert_users(database_file=database_file, table=table, users=found, add_unique_id=add_unique_id)
+                lookups = len(found) + len(missing) + len(failed)
+                print(f'{len(found)} unknown user ID(s) of the new events looked up')
+                logger.info(f'{len(found)} unknown user ID(s) of the new events looked up')
+            metadata_crawl.cache_deleted(database_file=database_file, object_type='user',
+                                         keys=[(user_id, '') for user_id in missing])
+
+            # The events of users whose lookup failed are looked at again on the next sync
+            if failed:
+                up_to = first_event(database_file=database_file, events_table=events_table, user_ids=failed,
+                                    watermark=watermark, up_to=up_to) - 1
+                print(f'The lookup of {len(failed)} user ID(s) failed and is retried on the next sync')
+                logger.warning(f'The lookup of {len(failed)} user ID(s) failed and is retried on the next sync')
+            db.write_state(database_file=database_file, key=EVENT_WATERMARK_KEY, value=up_to)
+
+        db.write_state(database_file=database_file, key=WATERMARK_KEY, value=int(start))
+
+        seconds = round(time.time() - start, 2)
+        logger.info(f'Users synced in {seconds} seconds',
+                    extra={'userSync': {'full': full, 'changed': None if changed is None else len(changed),
+                                        'lookups': lookups, 'deleted': len(missing), 'failed': len(failed),
+                                        'seconds': seconds}})
+
+    except sqlite3.Error as err:
+        print(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'SQL error: {err.args} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
+    except Exception as err:
+        print(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        logger.error(f'{err} in function "{sys._getframe().f_code.co_name}"')
+        sys.exit(1)
@@ -10,50 +10,102 @@ import time
 import argparse
 import json
 import pathlib
+import datetime
+import importlib
+import threading
+import types
 import globals
+import structured_logging
 
 # === Clear Console ===
 def clear_console():
+    # Not when the output is piped, e.g. events streamed by `--tail`
+    if not sys.stdout.isatty():
+        return
     if os.name == "nt":
         os.system("cls")
     else:
         os.system("clear")
 
-# === Set Paths ===
-operating_path = str(pathlib.Path(__file__).parent.resolve())
-globals.Paths.scripts = operating_path
-globals.Paths.databases = operating_path
-globals.Paths.logs = operating_path
 
-# === Setup Logger ===
-# Dynamically set logfile name based upon current date.
-local_time = time.strftime("%Y%m%d", time.localtime())
-log_file = f'{globals.Paths.logs}/{local_time}-ANAPLAN-RUN.LOG'
-log_file_level = logging.INFO  # Options: INFO, WARNING, DEBUG, INFO, ERROR, CRITICAL
-logging.basicConfig(filename=log_file,
-                    filemode='a',  # Append to Log
-                    format='%(asctime)s  :  %(levelname)s  :  %(message)s',
-                    level=log_file_level)
-logging.info("************** Logger Started ****************")
+# === Lazy Import ===
+# Returns a module that is only loaded on first attribute access, so heavy dependencies (e.g. pandas) are only paid
+# for by the phases that use them. Unlike `importlib.util.LazyLoader` this is safe when several threads trigger the
+# load at the same time.
+class lazy_module(types.ModuleType):
+    lock = threading.RLock()
+
+    def __getattr__(self, attribute):
+        # Only called for attributes not yet copied from the real module
+        with lazy_module.lock:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return lazy_module(name)
+
+
+# === Forward SQLite (APSW) logs to the logging module. Called before the first APSW connection is opened ===
+sqlite_logs_forwarded = False
+def forward_sqlite_logs():
+    global sqlite_logs_forwarded
+    if not sqlite_logs_forwarded:
+        import apsw.ext
+        apsw.ext.log_sqlite()
+        sqlite_logs_forwarded = True
+
+
+# === Set Paths and Setup Logger ===
+# Called once by each entry point (safe to call again)
+def initialize():
+    if getattr(globals.Paths, 'scripts', None) is not None:
+        return
+
+    # Set Paths
+    operating_path = str(pathlib.Path(__file__).parent.resolve())
+    globals.Paths.scripts = operating_path
+    globals.Paths.databases = operating_path
+    globals.Paths.logs = operating_path
+    globals.Paths.settings = f'{operating_path}/settings.json'
+
+    # Dynamically set logfile name based upon current date.
+    local_time = time.strftime("%Y%m%d", time.localtime())
+    log_file = f'{globals.Paths.logs}/{local_time}-ANAPLAN-RUN.LOG'
+    log_file_level = logging.INFO  # Options: INFO, WARNING, DEBUG, INFO, ERROR, CRITICAL
+    # JSON lines (appended), written by a background thread
+    structured_logging.start(log_file=log_file, level=log_file_level)
+    logging.info("************** Logger Started ****************")
+
+
+# === Set the current time stamps used for the Batch ID and the Refresh Log ===
+def set_time_stamps():
+    import pytz
+    ts = datetime.datetime.now(pytz.timezone("US/Eastern"))
+    globals.Timestamps.local_time_stamp = ts.strftime("%d-%m-%Y %H:%M:%S %Z")
+    globals.Timestamps.gmt_epoch = str(int(time.time()))
 
 
 # === Read in configuration ===
 def read_configuration_settings():
     try:
-        with open(f'{globals.Paths.scripts}/settings.json', 'r') as settings_file:
+        with open(globals.Paths.settings, 'r') as settings_file:
             settings = json.load(settings_file)
         logging.info("Configuration read in successfully")
         return settings
 
     except:
-        print("Unable to open the `settings.json` file. Please ensure the file is in the path of this Python module")
+        print(f'Unable to open the `{globals.Paths.settings}` file. Please ensure the file is in the path of this Python module')
         # Exit with a non-zero exit code
         sys.exit(1)
 
 # === Update configuration file ===
 def update_configuration_settings(object, value, key):
     try:
-        with open(f'{globals.Paths.scripts}/settings.json', 'w') as settings_file:
+        with open(globals.Paths.settings, 'w') as settings_file:
             object[f'{key}'] = value
             json.dump(object, settings_file, indent=4)
         logging.info("Configuration updated successfully")
@@ -67,6 +119,10 @@ def update_configuration_settings(object, value, key):
 # === Read CLI Arguments ===
 def read_cli_arguments():
     parser = argparse.ArgumentParser()
+    # Stages can be run on their own, e.g. `ingest` every few minutes and `sync-metadata enrich publish` hourly
+    stages = ['run', 'ingest', 'sync-metadata', 'enrich', 'publish']
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help=f'Stages to run in order, any of {", ".join(stages)} (default: `run`, the full refresh)')
     parser.add_argument('-r', '--register', action='store_true',
                         help="OAuth device registration")
     parser.add_argument('-c', '--client_id', action='store',
@@ -77,5 +133,24 @@ def read_cli_arguments():
                         type=str, help='Username for basic authentication')
     parser.add_argument('-p', '--password', action='store',
                         type=str, help='Password for basic authentication')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='Run continuously, polling the Audit API and keeping tokens, connections and caches warm')
+    parser.add_argument('-f', '--tail', action='store_true',
+                        help='Stream new audit events as enriched NDJSON to the `tail.sink` until interrupted')
+    parser.add_argument('-s', '--sink', action='store', choices=['stdout', 'file', 'socket'],
+                        type=str, help='Tail sink (overrides `tail.sink`)')
+    parser.add_argument('-i', '--interval', action='store',
+                        type=int, help='Daemon or tail polling interval in seconds (overrides `daemon.pollInterval` or `tail.pollInterval`)')
+    parser.add_argument('--profile', action='store', nargs='?', const='', metavar='directory',
+                        type=str, help='Profile each phase (cProfile and tracemalloc) and write the reports to `directory` (default: `profiles/<time>`)')
+    parser.add_argument('-m', '--tenants', action='store',
+                        type=str, help='Tenants file listing the `settings.json` of each tenant to run concurrently')
+    parser.add_argument('-w', '--workers', action='store',
+                        type=int, help='Number of tenants run at the same time (overrides `maxWorkers` in the tenants file)')
     args = parser.parse_args()
+
+    # `choices` cannot be combined with an optional list of positional arguments
+    invalid = [stage for stage in args.stages if stage not in stages]
+    if invalid:
+        parser.error(f'invalid stage {", ".join(invalid)} (choose from {", ".join(stages)})')
     return args